@@ -1,6 +1,10 @@
 // Q6: visits with CT attachment links
+// The leading $match uses idx_visit_attachment_modality; $filter only runs on the 10 visits kept.
 
 db.visits.aggregate([
+  { $match: { "attachments.modality": "CT" } },
+  { $sort: { visit_id: 1 } },
+  { $limit: 10 },
   {
     $addFields: {
       ct_attachments: {
@@ -12,7 +16,6 @@ db.visits.aggregate([
       }
     }
   },
-  { $match: { "ct_attachments.0": { $exists: true } } },
   {
     $project: {
       _id: 0,
@@ -22,7 +25,14 @@ db.visits.aggregate([
       ct_count: { $size: "$ct_attachments" },
       ct_uris: "$ct_attachments.storage_uri"
     }
-  },
-  { $sort: { visit_id: 1 } },
-  { $limit: 10 }
+  }
+]);
+
+// Q6c: CT imaging volume by site, covered by the partial index idx_visit_ct_counts
+
+db.visits.aggregate([
+  { $match: { "attachment_counts.CT": { $gte: 1 } } },
+  { $group: { _id: "$site_id", ct_visits: { $sum: 1 }, ct_images: { $sum: "$attachment_counts.CT" } } },
+  { $project: { _id: 0, site_id: "$_id", ct_visits: 1, ct_images: 1 } },
+  { $sort: { site_id: 1 } }
 ]);
@@ -0,0 +1,210 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import random
+import time
+
+import pymongo
+from bson.json_util import dumps
+from pymongo.errors import PyMongoError
+
+from bench_queries import latency_summary
+from common import get_async_db, get_settings
+from queries import (
+    DEMO_QUERIES,
+    QUERY_SPECS,
+    VISIT_LAYOUT_STATE,
+    add_variant_arguments,
+    layout_from_state,
+    resolve_queries,
+    route_variants,
+    selected_variants,
+)
+
+PREVIEW_DOCS = 5
+
+
+async def open_cursor(db, spec: dict, batch_size: int):
+    collection = db[spec["collection"]]
+    options = {"batchSize": batch_size} if batch_size else {}
+    if "pipeline" in spec:
+        return await collection.aggregate(spec["pipeline"], **options)
+    cursor = collection.find(spec["filter"], spec.get("projection"))
+    if "sort" in spec:
+        cursor = cursor.sort(spec["sort"])
+    if "limit" in spec:
+        cursor = cursor.limit(spec["limit"])
+    if batch_size:
+        cursor = cursor.batch_size(batch_size)
+    return cursor
+
+
+async def stream_query(db, name: str, timeout: float, batch_size: int = 0, preview: int = PREVIEW_DOCS) -> dict:
+    # Documents are consumed batch by batch as the server returns them; only the preview is kept.
+    spec = QUERY_SPECS[name]
+    result = {"name": name, "title": spec["title"], "count": 0, "preview": [], "status": "ok"}
+    started = time.perf_counter()
+    try:
+        with pymongo.timeout(timeout):
+            cursor = await open_cursor(db, spec, batch_size)
+            async for doc in cursor:
+                if len(result["preview"]) < preview:
+                    result["preview"].append(doc)
+                result["count"] += 1
+    except PyMongoError as exc:
+        result["status"] = "timeout" if exc.timeout else "error"
+        result["error"] = str(exc)
+    result["ms"] = (time.perf_counter() - started) * 1000
+    return result
+
+
+def print_result(result: dict) -> None:
+    status = "" if result["status"] == "ok" else f", {result['status']}"
+    print(f"\n=== {result['title']} (count={result['count']}, {result['ms']:.1f} ms{status}) ===")
+    if "error" in result:
+        print(result["error"])
+    for doc in result["preview"]:
+        print(dumps(doc, ensure_ascii=False))
+    if result["count"] > len(result["preview"]):
+        print("...")
+
+
+async def fan_out(db, names: list[str], concurrency: int, timeout: float, batch_size: int) -> list[dict]:
+    limit = asyncio.Semaphore(concurrency)
+
+    async def limited(name: str) -> dict:
+        async with limit:
+            return await stream_query(db, name, timeout, batch_size)
+
+    results = []
+    for finished in asyncio.as_completed([limited(name) for name in names]):
+        result = await finished
+        print_result(result)
+        results.append(result)
+    return results
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.strip().partition("=")
+        weights[name] = float(weight or 1)
+    unknown = [name for name in weights if name not in QUERY_SPECS]
+    if unknown:
+        raise ValueError(f"unknown queries in mix: {unknown}; choose from {sorted(QUERY_SPECS)}")
+    if any(weight < 0 for weight in weights.values()) or not sum(weights.values()):
+        raise ValueError("mix weights must be >= 0 with a positive total")
+    return weights
+
+
+async def load_step(
+    db, mix: dict[str, float], qps: float, duration: float, concurrency: int, timeout: float, rng: random.Random
+) -> dict:
+    # Open-loop arrivals: queries are scheduled at the target rate whether or not earlier ones
+    # finished, and latency is measured from the scheduled start so queueing shows up in it.
+    limit = asyncio.Semaphore(concurrency)
+    names, weights = list(mix), list(mix.values())
+    latencies: dict[str, list[float]] = {name: [] for name in names}
+    failures = {"timeout": 0, "error": 0}
+
+    async def issue(name: str, scheduled: float) -> None:
+        async with limit:
+            result = await stream_query(db, name, timeout, preview=0)
+        if result["status"] == "ok":
+            latencies[name].append((time.perf_counter() - scheduled) * 1000)
+        else:
+            failures[result["status"]] += 1
+
+    loop_started = time.perf_counter()
+    tasks = []
+    for sent in range(int(qps * duration)):
+        scheduled = loop_started + sent / qps
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(issue(rng.choices(names, weights)[0], scheduled)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - loop_started
+
+    completed = sum(len(values) for values in latencies.values())
+    return {
+        "target_qps": qps,
+        "achieved_qps": round(completed / elapsed, 2),
+        "sent": len(tasks),
+        "completed": completed,
+        **failures,
+        "latency_ms": {name: latency_summary(values) for name, values in latencies.items() if values},
+    }
+
+
+def print_load_step(step: dict) -> None:
+    print(
+        f"\ntarget {step['target_qps']:.0f} qps -> achieved {step['achieved_qps']:.1f} qps "
+        f"({step['completed']}/{step['sent']} ok, {step['timeout']} timeouts, {step['error']} errors)"
+    )
+    for name, latency in step["latency_ms"].items():
+        print(f"  {name:<5} p50 {latency['p50']:>9.3f}  p95 {latency['p95']:>9.3f}  p99 {latency['p99']:>9.3f} ms")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run the demo queries concurrently on the asyncio driver.")
+    parser.add_argument("--queries", default=",".join(DEMO_QUERIES), help="Comma-separated query names.")
+    add_variant_arguments(parser)
+    parser.add_argument("--concurrency", type=int, default=6, help="Maximum queries in flight.")
+    parser.add_argument("--timeout", type=float, default=10.0, help="Per-query timeout in seconds.")
+    parser.add_argument("--batch-size", type=int, default=0, help="Cursor batch size (0 = server default).")
+    parser.add_argument(
+        "--load",
+        action="store_true",
+        help="Generate load at --qps with the --mix query mix instead of running each query once.",
+    )
+    parser.add_argument(
+        "--qps",
+        default="50",
+        help="Target queries per second; a comma-separated list runs one step per rate to find the limit.",
+    )
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per load step.")
+    parser.add_argument("--mix", default="Q1=4,Q2=1,Q3=1,Q4=2,Q5=1,Q6=1", help="Weighted query mix for --load.")
+    parser.add_argument("--seed", type=int, default=491, help="Seed for picking queries from the mix.")
+    return parser.parse_args()
+
+
+async def run(args: argparse.Namespace) -> None:
+    settings = get_settings()
+    db, client = get_async_db(settings)
+    try:
+        # queries.current_layout on the asyncio driver.
+        state = await db[VISIT_LAYOUT_STATE].find_one({"_id": "visits"})
+        layout = layout_from_state(state, await db.visits.estimated_document_count(), await db.list_collection_names())
+        variants = route_variants(selected_variants(args), layout)
+        if args.load:
+            mix = parse_mix(args.mix)
+            mix = dict(zip(resolve_queries(list(mix), variants), mix.values()))
+            rng = random.Random(args.seed)
+            for qps in (float(value) for value in args.qps.split(",")):
+                step = await load_step(db, mix, qps, args.duration, args.concurrency, args.timeout, rng)
+                print_load_step(step)
+        else:
+            names = resolve_queries([name.strip() for name in args.queries.split(",") if name.strip()], variants)
+            unknown = [name for name in names if name not in QUERY_SPECS]
+            if unknown:
+                raise ValueError(f"unknown queries: {unknown}; choose from {sorted(QUERY_SPECS)}")
+            started = time.perf_counter()
+            results = await fan_out(db, names, args.concurrency, args.timeout, args.batch_size)
+            wall_ms = (time.perf_counter() - started) * 1000
+            serial_ms = sum(result["ms"] for result in results)
+            print(f"\nWall time {wall_ms:.1f} ms for {len(results)} queries (sum of query times {serial_ms:.1f} ms)")
+    finally:
+        await client.close()
+
+
+def main() -> None:
+    args = parse_args()
+    if args.concurrency <= 0 or args.timeout <= 0 or args.batch_size < 0 or args.duration <= 0:
+        raise ValueError("concurrency, timeout and duration must be > 0, batch-size >= 0")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
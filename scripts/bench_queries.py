@@ -0,0 +1,184 @@
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+from common import PROJECT_ROOT, get_db, get_settings
+from queries import (
+    DEMO_QUERIES,
+    QUERY_SPECS,
+    add_variant_arguments,
+    current_layout,
+    explain_query,
+    resolve_queries,
+    route_variants,
+    run_query,
+    selected_variants,
+    summarize_explain,
+)
+
+BENCH_DIR = PROJECT_ROOT / "data" / "generated" / "bench"
+
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    rank = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return ordered[rank]
+
+
+def latency_summary(latencies_ms: list[float]) -> dict:
+    return {
+        "p50": round(percentile(latencies_ms, 50), 3),
+        "p95": round(percentile(latencies_ms, 95), 3),
+        "p99": round(percentile(latencies_ms, 99), 3),
+        "mean": round(sum(latencies_ms) / len(latencies_ms), 3),
+        "min": round(min(latencies_ms), 3),
+        "max": round(max(latencies_ms), 3),
+    }
+
+
+def time_calls(call, iterations: int) -> dict:
+    latencies = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        call()
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latency_summary(latencies)
+
+
+def timed_run(db, spec: dict, batch_size: int = 0) -> tuple[float, int]:
+    started = time.perf_counter()
+    returned = sum(1 for _ in run_query(db, spec, batch_size))
+    return (time.perf_counter() - started) * 1000, returned
+
+
+def bench_query(db, spec: dict, iterations: int, warmup: int, concurrency: int, batch_size: int = 0) -> dict:
+    for _ in range(warmup):
+        timed_run(db, spec, batch_size)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        runs = list(pool.map(lambda _: timed_run(db, spec, batch_size), range(iterations)))
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency for latency, _ in runs]
+    return {
+        "title": spec["title"],
+        "iterations": iterations,
+        "concurrency": concurrency,
+        "result_count": runs[-1][1],
+        "latency_ms": latency_summary(latencies),
+        "throughput_qps": round(iterations / elapsed, 2),
+    }
+
+
+def dataset_counts(db) -> dict:
+    return {name: db[name].estimated_document_count() for name in ("participants", "visits", "clinical_notes")}
+
+
+def compare_with_baseline(results: dict, baseline: dict, threshold: float) -> list[str]:
+    regressions = []
+    for name, current in results["queries"].items():
+        previous = baseline.get("queries", {}).get(name)
+        if previous is None:
+            continue
+        before = previous["latency_ms"]["p95"]
+        after = current["latency_ms"]["p95"]
+        ratio = after / before if before else float("inf")
+        marker = ""
+        if ratio > 1 + threshold:
+            marker = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<5} p95 {before:>9.3f} -> {after:>9.3f} ms  x{ratio:.2f}{marker}")
+    return regressions
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the demo queries with latency percentiles and explain capture."
+    )
+    parser.add_argument("--queries", default=",".join(DEMO_QUERIES), help="Comma-separated query names.")
+    add_variant_arguments(parser)
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=0, help="Cursor batch size (0 = server default).")
+    parser.add_argument("--no-explain", action="store_true", help="Skip explain('executionStats') capture.")
+    parser.add_argument("--out", type=Path, help="Result JSON path (default: data/generated/bench/).")
+    parser.add_argument("--baseline", type=Path, help="Earlier result JSON to compare p95 latency against.")
+    parser.add_argument(
+        "--regression-threshold",
+        type=float,
+        default=0.25,
+        help="Flag queries whose p95 grew by more than this fraction versus --baseline.",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    if args.iterations <= 0 or args.concurrency <= 0 or args.warmup < 0 or args.batch_size < 0:
+        raise ValueError("iterations and concurrency must be > 0, warmup and batch-size >= 0")
+    settings = get_settings()
+    db, client = get_db(settings)
+
+    variants = route_variants(selected_variants(args), current_layout(db))
+    names = resolve_queries([name.strip() for name in args.queries.split(",") if name.strip()], variants)
+    unknown = [name for name in names if name not in QUERY_SPECS]
+    if unknown:
+        raise ValueError(f"unknown queries: {unknown}; choose from {sorted(QUERY_SPECS)}")
+
+    counts = dataset_counts(db)
+    results = {
+        "generated_at_utc": datetime.now(timezone.utc).isoformat(),
+        "db": db.name,
+        "dataset": counts,
+        "config": {
+            "iterations": args.iterations,
+            "warmup": args.warmup,
+            "concurrency": args.concurrency,
+            "batch_size": args.batch_size,
+        },
+        "queries": {},
+    }
+    print(f"{'query':<5} {'p50':>9} {'p95':>9} {'p99':>9} {'qps':>9} {'docsExam':>10} {'keysExam':>10}  index")
+    for name in names:
+        spec = QUERY_SPECS[name]
+        result = bench_query(db, spec, args.iterations, args.warmup, args.concurrency, args.batch_size)
+        if not args.no_explain:
+            result["explain"] = summarize_explain(explain_query(db, spec))
+        results["queries"][name] = result
+
+        explain = result.get("explain", {})
+        latency = result["latency_ms"]
+        print(
+            f"{name:<5} {latency['p50']:>9.3f} {latency['p95']:>9.3f} {latency['p99']:>9.3f} "
+            f"{result['throughput_qps']:>9.1f} {explain.get('docs_examined', '-'):>10} "
+            f"{explain.get('keys_examined', '-'):>10}  {','.join(explain.get('indexes_used', [])) or '-'}"
+        )
+
+    client.close()
+
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    out_path = args.out or BENCH_DIR / f"bench-p{counts['participants']}-{stamp}.json"
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    out_path.write_text(json.dumps(results, indent=2), encoding="utf-8")
+    print(f"\nResults written to {out_path}")
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+        print(f"\nCompared with {args.baseline} (dataset {baseline.get('dataset')}):")
+        regressions = compare_with_baseline(results, baseline, args.regression_threshold)
+        if regressions:
+            print(f"BENCH REGRESSION: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import mmap
+import shutil
+import struct
+import sys
+from array import array
+from collections.abc import Iterator
+from datetime import datetime, timezone
+from pathlib import Path
+
+from bson.raw_bson import RawBSONDocument
+
+from common import PROJECT_ROOT
+from manifest import COUNT_KEYS, MANIFEST_COLLECTIONS, ManifestBuilder
+
+DUMP_DIR = PROJECT_ROOT / "data" / "generated" / "bson"
+DUMP_META = DUMP_DIR / "dump.json"
+# Everything that changes the generated documents or the manifest digest blocks.
+DATASET_KEYS = (
+    "seed",
+    "participants",
+    "min_visits",
+    "max_visits",
+    "min_notes",
+    "max_notes",
+    "denormalize",
+    "generator",
+    "shard_size",
+)
+# Bumped whenever seed_data changes the shape of generated documents, so older dumps are regenerated.
+DOCUMENT_FORMAT = 2
+# encode_document appends content_hash last: type byte, key, int32 length, 64 hex chars + NUL.
+HASH_ELEMENT = b"\x02content_hash\x00"
+HASH_ELEMENT_SIZE = len(HASH_ELEMENT) + 4 + 65
+
+
+def dataset_settings(args: argparse.Namespace) -> dict:
+    return {**{key: getattr(args, key) for key in DATASET_KEYS}, "document_format": DOCUMENT_FORMAT}
+
+
+def write_index(path: Path, offsets: array, block_starts: array) -> None:
+    # <file>.idx: doc count, block count, doc offsets (+ end), block start ordinals (+ end); uint64 little-endian.
+    values = array("Q", [len(offsets) - 1, len(block_starts) - 1]) + offsets + block_starts
+    if sys.byteorder == "big":
+        values.byteswap()
+    path.write_bytes(values.tobytes())
+
+
+def read_index(path: Path) -> tuple[array, array]:
+    values = array("Q")
+    values.frombytes(path.read_bytes())
+    if sys.byteorder == "big":
+        values.byteswap()
+    docs, blocks = values[0], values[1]
+    return values[2 : docs + 3], values[docs + 3 : docs + blocks + 4]
+
+
+class DumpWriter:
+    # Appends the raw BSON of every generated document to <collection>/<first participant>.bson and
+    # records each document's offset plus where every manifest digest block starts in <...>.idx.
+    # Each seeding process (or worker shard) writes its own files; restore reads them in name order.
+    def __init__(self, start: int, block_participants: int) -> None:
+        self.block_participants = block_participants
+        self.participants = 0
+        self.files = {}
+        self.offsets = {name: array("Q", [0]) for name in MANIFEST_COLLECTIONS}
+        self.block_starts = {name: array("Q", [0]) for name in MANIFEST_COLLECTIONS}
+        for name in MANIFEST_COLLECTIONS:
+            (DUMP_DIR / name).mkdir(parents=True, exist_ok=True)
+            self.files[name] = (DUMP_DIR / name / f"{start:09d}.bson").open("wb")
+
+    def add(self, participant: RawBSONDocument, visits: list, notes: list) -> None:
+        for name, docs in (("participants", [participant]), ("visits", visits), ("clinical_notes", notes)):
+            offsets = self.offsets[name]
+            for doc in docs:
+                self.files[name].write(doc.raw)
+                offsets.append(offsets[-1] + len(doc.raw))
+        self.participants += 1
+        if self.participants % self.block_participants == 0:
+            self.end_block()
+
+    def end_block(self) -> None:
+        for name in MANIFEST_COLLECTIONS:
+            self.block_starts[name].append(len(self.offsets[name]) - 1)
+
+    def close(self) -> None:
+        if self.participants % self.block_participants:
+            self.end_block()
+        for name, handle in self.files.items():
+            handle.close()
+            write_index(Path(handle.name).with_suffix(".idx"), self.offsets[name], self.block_starts[name])
+
+    def __enter__(self) -> DumpWriter:
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+
+def dump_records(records: Iterator[tuple], start: int, block_participants: int) -> Iterator[tuple]:
+    with DumpWriter(start, block_participants) as dump:
+        for record in records:
+            dump.add(*record)
+            yield record
+
+
+def clear_dump() -> None:
+    if DUMP_DIR.exists():
+        shutil.rmtree(DUMP_DIR)
+
+
+def write_dump_meta(args: argparse.Namespace, manifest: dict) -> None:
+    meta = {
+        "dumped_at_utc": datetime.now(timezone.utc).isoformat(),
+        "dataset": dataset_settings(args),
+        "manifest": manifest,
+    }
+    DUMP_META.write_text(json.dumps(meta, indent=2), encoding="utf-8")
+
+
+def load_dump_meta() -> dict | None:
+    if not DUMP_META.exists():
+        return None
+    return json.loads(DUMP_META.read_text(encoding="utf-8"))
+
+
+def dump_matches(args: argparse.Namespace) -> bool:
+    meta = load_dump_meta()
+    return meta is not None and meta["dataset"] == dataset_settings(args)
+
+
+def iter_dump_files(collection_name: str) -> Iterator[tuple[mmap.mmap, array, array]]:
+    for path in sorted((DUMP_DIR / collection_name).glob("*.bson")):
+        offsets, block_starts = read_index(path.with_suffix(".idx"))
+        if path.stat().st_size != offsets[-1]:
+            raise ValueError(f"{path} is {path.stat().st_size} bytes, its index expects {offsets[-1]}")
+        if not offsets[-1]:
+            yield b"", offsets, block_starts
+            continue
+        with path.open("rb") as handle, mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped, offsets, block_starts
+
+
+def iter_dump(collection_name: str) -> Iterator[RawBSONDocument]:
+    # Slices of the mapped file are wrapped as-is; nothing is decoded into Python objects.
+    for mapped, offsets, _ in iter_dump_files(collection_name):
+        for ordinal in range(len(offsets) - 1):
+            yield RawBSONDocument(mapped[offsets[ordinal] : offsets[ordinal + 1]])
+
+
+def stored_hash(raw: bytes) -> str | None:
+    element = raw[-HASH_ELEMENT_SIZE - 1 : -1]
+    if not element.startswith(HASH_ELEMENT):
+        return None
+    return element[-65:-1].decode("ascii")
+
+
+def body_hash(raw: bytes) -> str:
+    # The document as it was hashed: the same bytes without the trailing content_hash element.
+    body = struct.pack("<i", len(raw) - HASH_ELEMENT_SIZE) + raw[4 : -HASH_ELEMENT_SIZE - 1] + b"\x00"
+    return hashlib.sha256(body).hexdigest()
+
+
+def validate_dump(meta: dict, shallow: bool = False) -> list[str]:
+    # Rehash every document body against the content_hash stored at its end and rebuild the
+    # manifest digest from those; shallow trusts the stored content_hash and skips the rehash.
+    manifest = meta["manifest"]
+    problems = []
+    blocks: dict[str, list[str]] = {}
+    counts = {key: manifest["counts"][key] for key in COUNT_KEYS}
+    for name in MANIFEST_COLLECTIONS:
+        blocks[name] = []
+        docs = corrupt = 0
+        for mapped, offsets, block_starts in iter_dump_files(name):
+            for block in range(len(block_starts) - 1):
+                block_hash = hashlib.sha256()
+                for ordinal in range(block_starts[block], block_starts[block + 1]):
+                    raw = mapped[offsets[ordinal] : offsets[ordinal + 1]]
+                    digest = stored_hash(raw)
+                    if digest is None or (not shallow and body_hash(raw) != digest):
+                        corrupt += 1
+                        digest = body_hash(raw)
+                    block_hash.update(bytes.fromhex(digest))
+                blocks[name].append(block_hash.hexdigest())
+            docs += len(offsets) - 1
+        counts[name] = docs
+        if corrupt:
+            problems.append(f"{name}: {corrupt} documents do not match their content_hash")
+        if docs != manifest["counts"][name]:
+            problems.append(f"{name}: {docs} documents in dump, manifest expects {manifest['counts'][name]}")
+    builder = ManifestBuilder(manifest["digest"]["block_participants"])
+    builder.merge({"counts": counts, "blocks": blocks})
+    actual = builder.build(manifest["db"])
+    for name in MANIFEST_COLLECTIONS:
+        if actual["digest"]["collections"][name] != manifest["digest"]["collections"][name]:
+            problems.append(f"{name}: digest mismatch")
+    if actual["sha256"] != manifest["sha256"]:
+        problems.append(f"sha256 recomputed {actual['sha256']}, manifest {manifest['sha256']}")
+    return problems
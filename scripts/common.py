@@ -1,9 +1,16 @@
 from __future__ import annotations
 
 import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 
-from pymongo import MongoClient
+import bson
+from bson.raw_bson import RawBSONDocument
+from pymongo import AsyncMongoClient, DeleteMany, InsertOne, MongoClient, ReplaceOne
+from pymongo.errors import BulkWriteError, ConnectionFailure, OperationFailure, WriteConcernError
+from pymongo.write_concern import WriteConcern
 
 PROJECT_ROOT = Path(__file__).resolve().parents[1]
 
@@ -35,6 +42,16 @@ def get_settings() -> dict:
     return {
         "mongo_uri": os.getenv("MONGO_URI", "mongodb://localhost:27017"),
         "mongo_db": os.getenv("MONGO_DB", "clinical_synth_demo"),
+        "max_pool_size": int(os.getenv("MONGO_MAX_POOL_SIZE", "100")),
+        "min_pool_size": int(os.getenv("MONGO_MIN_POOL_SIZE", "0")),
+        "max_idle_time_ms": int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "0")),
+        "compressors": os.getenv("MONGO_COMPRESSORS", ""),
+        "mongo_w": os.getenv("MONGO_W", ""),
+        "read_preference": os.getenv("MONGO_READ_PREFERENCE", "primary"),
+        "metrics": os.getenv("MONGO_METRICS", "off"),
+        "metrics_path": os.getenv("MONGO_METRICS_PATH", ""),
+        "slow_ms": float(os.getenv("MONGO_SLOW_MS", "100")),
+        "metrics_bytes": _as_bool(os.getenv("MONGO_METRICS_BYTES"), default=False),
         "seed": int(os.getenv("SEED", "491")),
         "participants": int(os.getenv("PARTICIPANTS", "100")),
         "min_visits": int(os.getenv("MIN_VISITS", "3")),
@@ -42,9 +59,261 @@ def get_settings() -> dict:
         "min_notes": int(os.getenv("MIN_NOTES", "1")),
         "max_notes": int(os.getenv("MAX_NOTES", "4")),
         "drop_existing": _as_bool(os.getenv("DROP_EXISTING"), default=True),
+        "incremental": _as_bool(os.getenv("INCREMENTAL"), default=False),
+        "defer_indexes": _as_bool(os.getenv("DEFER_INDEXES"), default=False),
+        "denormalize": _as_bool(os.getenv("DENORMALIZE"), default=False),
+        "visit_layout": os.getenv("VISIT_LAYOUT", "documents"),
+        "batch_size": int(os.getenv("BATCH_SIZE", "0")),
+        "query_cache": os.getenv("QUERY_CACHE", "off"),
+        "query_cache_ttl": float(os.getenv("QUERY_CACHE_TTL", "3600")),
+        "raw_bson": _as_bool(os.getenv("RAW_BSON"), default=False),
+        "generator": os.getenv("GENERATOR", "python"),
+        "workers": int(os.getenv("WORKERS", "0")),
+        "write_w": os.getenv("WRITE_W", "1"),
+        "write_journal": _as_bool(os.getenv("WRITE_JOURNAL"), default=False),
+        "max_in_flight": int(os.getenv("MAX_IN_FLIGHT", "4")),
+        "sharding": os.getenv("SHARDING", "off"),
+        "shard_chunks": int(os.getenv("SHARD_CHUNKS_PER_SHARD", "4")),
     }
 
 
+def client_options(settings: dict) -> dict:
+    options = {
+        "serverSelectionTimeoutMS": 5000,
+        "maxPoolSize": settings["max_pool_size"],
+        "minPoolSize": settings["min_pool_size"],
+        "readPreference": settings["read_preference"],
+    }
+    if settings["max_idle_time_ms"] > 0:
+        options["maxIdleTimeMS"] = settings["max_idle_time_ms"]
+    if settings["compressors"]:
+        options["compressors"] = settings["compressors"]
+    if settings["mongo_w"]:
+        options["w"] = int(settings["mongo_w"]) if settings["mongo_w"].isdigit() else settings["mongo_w"]
+    return options
+
+
+def monitoring_options(settings: dict) -> dict:
+    if settings["metrics"] == "off":
+        return {}
+    # Imported on first use: instrumentation builds on this module.
+    from instrumentation import install_metrics
+
+    return {"event_listeners": [install_metrics(settings)]}
+
+
+_clients: dict[tuple, MongoClient] = {}
+_clients_lock = threading.Lock()
+
+
+def _forget_clients() -> None:
+    # A MongoClient must not be used across fork(); the child drops the inherited
+    # clients without closing them (their sockets belong to the parent) and reconnects.
+    global _clients_lock
+    _clients.clear()
+    _clients_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_clients)
+
+
+def get_client(settings: dict) -> MongoClient:
+    options = client_options(settings)
+    key = (settings["mongo_uri"], tuple(sorted(options.items())))
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = MongoClient(settings["mongo_uri"], **options, **monitoring_options(settings))
+            _clients[key] = client
+    return client
+
+
 def get_db(settings: dict):
-    client = MongoClient(settings["mongo_uri"], serverSelectionTimeoutMS=5000)
+    client = get_client(settings)
+    return client[settings["mongo_db"]], client
+
+
+def get_async_db(settings: dict):
+    # Async clients are bound to the event loop that uses them, so they are not cached.
+    client = AsyncMongoClient(settings["mongo_uri"], **client_options(settings), **monitoring_options(settings))
     return client[settings["mongo_db"]], client
+
+
+def parse_write_concern(w: str, journal: bool) -> WriteConcern:
+    return WriteConcern(w=int(w) if w.isdigit() else w, j=journal)
+
+
+class BulkWriteStats:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.docs = 0
+        self.bytes = 0
+        self.batches = 0
+        self.retried_batches = 0
+
+    def record(self, docs: int, nbytes: int, retried: bool) -> None:
+        with self.lock:
+            self.docs += docs
+            self.bytes += nbytes
+            self.batches += 1
+            self.retried_batches += int(retried)
+
+    def merge(self, summary: dict) -> None:
+        with self.lock:
+            self.docs += summary["docs"]
+            self.bytes += summary["bytes"]
+            self.batches += summary["batches"]
+            self.retried_batches += summary["retried_batches"]
+
+    def summary(self) -> dict:
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        return {
+            "docs": self.docs,
+            "bytes": self.bytes,
+            "batches": self.batches,
+            "retried_batches": self.retried_batches,
+            "seconds": round(elapsed, 3),
+            "docs_per_s": round(self.docs / elapsed, 1),
+            "mb_per_s": round(self.bytes / elapsed / 1_000_000, 2),
+        }
+
+
+class BulkWriter:
+    # Buffers inserts, keyed upserts and keyed deletes per collection and writes them as
+    # unordered bulk batches from a thread pool. A batch is flushed at `batch_docs` operations
+    # or `batch_bytes` BSON bytes, and at most `max_in_flight` batches are outstanding.
+    # Only transient failures are retried: network errors, errors labelled RetryableWriteError,
+    # write concern errors and the retryable write error codes below. Their outcome is unknown
+    # (an insert may have been applied before the acknowledgement was lost), so inserts are resent
+    # as ReplaceOne upserts on the natural key. Anything else, such as a duplicate key (11000) or a
+    # validation failure (121), is a real error in the data and is raised on the first attempt.
+    TRANSIENT_ERRORS = (ConnectionFailure, WriteConcernError)
+    # NotWritablePrimary, PrimarySteppedDown, ShutdownInProgress, network and interruption codes.
+    RETRYABLE_CODES = frozenset({6, 7, 89, 91, 134, 189, 262, 9001, 10107, 11600, 11602, 13435, 13436})
+
+    def __init__(
+        self,
+        db,
+        key_fields: dict[str, tuple[str, ...]],
+        *,
+        batch_docs: int = 1000,
+        batch_bytes: int = 8 * 1024 * 1024,
+        write_concern: WriteConcern | None = None,
+        max_in_flight: int = 4,
+        max_retries: int = 3,
+    ) -> None:
+        self.db = db
+        self.key_fields = key_fields
+        self.batch_docs = batch_docs
+        self.batch_bytes = batch_bytes
+        self.write_concern = write_concern
+        self.max_retries = max_retries
+        self.stats = BulkWriteStats()
+        self.buffers: dict[str, list[tuple[str, dict]]] = {name: [] for name in key_fields}
+        self.buffer_bytes = {name: 0 for name in key_fields}
+        self.pool = ThreadPoolExecutor(max_workers=max_in_flight)
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.futures: list[Future] = []
+
+    def add(self, collection_name: str, doc: dict) -> None:
+        self._buffer(collection_name, "insert", doc)
+
+    def upsert(self, collection_name: str, doc: dict) -> None:
+        self._buffer(collection_name, "upsert", doc)
+
+    def delete(self, collection_name: str, key: dict) -> None:
+        self._buffer(collection_name, "delete", key)
+
+    def flush(self, collection_name: str) -> None:
+        entries = self.buffers[collection_name]
+        if not entries:
+            return
+        nbytes = self.buffer_bytes[collection_name]
+        self.buffers[collection_name] = []
+        self.buffer_bytes[collection_name] = 0
+
+        self._raise_failed()
+        self.slots.acquire()
+        future = self.pool.submit(self._write_batch, collection_name, entries, nbytes)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+
+    def close(self) -> dict:
+        try:
+            for collection_name in self.buffers:
+                self.flush(collection_name)
+            for future in self.futures:
+                future.result()
+        finally:
+            self.pool.shutdown(wait=True)
+        return self.stats.summary()
+
+    def __enter__(self) -> BulkWriter:
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+
+    def _buffer(self, collection_name: str, kind: str, doc: dict) -> None:
+        nbytes = len(doc.raw) if isinstance(doc, RawBSONDocument) else len(bson.encode(doc))
+        entries = self.buffers[collection_name]
+        if entries and self.buffer_bytes[collection_name] + nbytes > self.batch_bytes:
+            self.flush(collection_name)
+            entries = self.buffers[collection_name]
+        entries.append((kind, doc))
+        self.buffer_bytes[collection_name] += nbytes
+        if len(entries) >= self.batch_docs:
+            self.flush(collection_name)
+
+    def _raise_failed(self) -> None:
+        pending = []
+        for future in self.futures:
+            if not future.done():
+                pending.append(future)
+            elif future.exception() is not None:
+                raise future.exception()
+        self.futures = pending
+
+    def _key_filter(self, collection_name: str, doc: dict) -> dict:
+        return {field: doc[field] for field in self.key_fields[collection_name]}
+
+    def _operation(self, collection_name: str, kind: str, doc: dict, retry: bool):
+        if kind == "delete":
+            return DeleteMany(self._key_filter(collection_name, doc))
+        if kind == "insert" and not retry:
+            return InsertOne(doc)
+        replacement = {key: value for key, value in doc.items() if key != "_id"}
+        return ReplaceOne(self._key_filter(collection_name, doc), replacement, upsert=True)
+
+    def _write_batch(self, collection_name: str, entries: list[tuple[str, dict]], nbytes: int) -> None:
+        collection = self.db.get_collection(collection_name, write_concern=self.write_concern)
+        pending = entries
+        for attempt in range(self.max_retries + 1):
+            operations = [self._operation(collection_name, kind, doc, attempt > 0) for kind, doc in pending]
+            try:
+                collection.bulk_write(operations, ordered=False)
+                self.stats.record(len(entries), nbytes, retried=attempt > 0)
+                return
+            except BulkWriteError as exc:
+                errors = exc.details.get("writeErrors", [])
+                if any(error.get("code") not in self.RETRYABLE_CODES for error in errors):
+                    raise
+                if errors:
+                    pending = [pending[index] for index in sorted({error["index"] for error in errors})]
+                elif not exc.details.get("writeConcernErrors"):
+                    raise
+                last_error: Exception = exc
+            except self.TRANSIENT_ERRORS as exc:
+                last_error = exc
+            except OperationFailure as exc:
+                if not exc.has_error_label("RetryableWriteError"):
+                    raise
+                last_error = exc
+            if attempt == self.max_retries:
+                raise last_error
+            time.sleep(0.1 * 2**attempt)
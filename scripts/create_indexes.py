@@ -1,57 +1,125 @@
 from __future__ import annotations
 
-from pymongo import ASCENDING, DESCENDING, TEXT
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+from pymongo.errors import OperationFailure
 
 from common import get_db, get_settings
 
+# IndexOptionsConflict, IndexKeySpecsConflict
+INDEX_CONFLICT_CODES = (85, 86)
+INDEX_SPECS = {
+    "participants": [
+        {"name": "uid_participant_id", "keys": [("participant_id", ASCENDING)], "unique": True},
+        {"name": "idx_site_arm_age", "keys": [("site_id", ASCENDING), ("arm", ASCENDING), ("age", ASCENDING)]},
+    ],
+    "visits": [
+        {
+            "name": "uid_participant_visit",
+            "keys": [("participant_id", ASCENDING), ("visit_no", ASCENDING)],
+            "unique": True,
+        },
+        {
+            # The trailing _id makes (visit_date, _id) unique for keyset pages (pagination.py).
+            "name": "idx_visit_site_date",
+            "keys": [("site_id", ASCENDING), ("visit_date", DESCENDING), ("_id", ASCENDING)],
+        },
+        {
+            "name": "idx_visit_attachment_modality",
+            "keys": [("attachments.modality", ASCENDING), ("visit_date", DESCENDING)],
+        },
+        {
+            # Only visits with attachments carry attachment_counts (seed_data.attachment_counts), so the
+            # index skips the rest. Q6c's {$gte: 1} implies the partial filter, which lets the planner use it.
+            "name": "idx_visit_ct_counts",
+            "keys": [("attachment_counts.CT", ASCENDING), ("site_id", ASCENDING)],
+            "partialFilterExpression": {"attachment_counts.CT": {"$gte": 0}},
+        },
+        {
+            # Backs Q3d over the embedded participant snapshot; symptom_score keeps it covering.
+            "name": "idx_visit_arm_visitno_score",
+            "keys": [("participant.arm", ASCENDING), ("visit_no", ASCENDING), ("symptom_score", ASCENDING)],
+        },
+    ],
+    "clinical_notes": [
+        {"name": "txt_note_text", "keys": [("note_text", TEXT)], "default_language": "english"},
+        {
+            # The trailing _id makes (created_at, _id) unique for keyset pages (pagination.py).
+            "name": "idx_note_participant_created",
+            "keys": [("participant_id", ASCENDING), ("created_at", DESCENDING), ("_id", ASCENDING)],
+        },
+        {
+            # Multikey keyword index for symptom searches routed away from $text (keyword_search.py).
+            "name": "idx_note_tags_site_created",
+            "keys": [("tags", ASCENDING), ("site_id", ASCENDING), ("created_at", DESCENDING)],
+        },
+    ],
+}
+
+
+def index_model(spec: dict) -> IndexModel:
+    options = {key: value for key, value in spec.items() if key != "keys"}
+    return IndexModel(spec["keys"], **options)
+
+
+def drop_secondary_indexes(db, specs: dict = INDEX_SPECS, keep_field: str | None = None) -> list[str]:
+    # keep_field keeps the indexes whose first key is that field (a shard key cannot lose its index).
+    dropped = []
+    existing_collections = set(db.list_collection_names())
+    for collection_name in specs:
+        if collection_name not in existing_collections:
+            continue
+        names = [
+            name
+            for name, index in db[collection_name].index_information().items()
+            if name != "_id_" and next(iter(index["key"]))[0] != keep_field
+        ]
+        for name in names:
+            db[collection_name].drop_index(name)
+        dropped.extend(f"{collection_name}.{name}" for name in names)
+    return dropped
+
+
+def build_index(db, collection_name: str, spec: dict) -> dict:
+    started = time.perf_counter()
+    try:
+        db[collection_name].create_indexes([index_model(spec)])
+    except OperationFailure as exc:
+        if exc.code not in INDEX_CONFLICT_CODES:
+            raise
+        # An index whose keys or options changed under the same name is rebuilt from the current spec.
+        db[collection_name].drop_index(spec["name"])
+        db[collection_name].create_indexes([index_model(spec)])
+    return {
+        "collection": collection_name,
+        "name": spec["name"],
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+def build_indexes(db, specs: dict = INDEX_SPECS, max_workers: int | None = None) -> list[dict]:
+    jobs = [(collection_name, spec) for collection_name, col_specs in specs.items() for spec in col_specs]
+    with ThreadPoolExecutor(max_workers=max_workers or len(jobs)) as pool:
+        futures = [pool.submit(build_index, db, collection_name, spec) for collection_name, spec in jobs]
+        return [future.result() for future in futures]
+
+
+def print_index_timings(timings: list[dict]) -> None:
+    for timing in timings:
+        print(f"- {timing['collection']}.{timing['name']}: {timing['seconds']}s")
+
 
 def main() -> None:
     settings = get_settings()
     db, client = get_db(settings)
 
-    created = {
-        "participants": [
-            db.participants.create_index(
-                [("participant_id", ASCENDING)],
-                unique=True,
-                name="uid_participant_id",
-            ),
-            db.participants.create_index(
-                [("site_id", ASCENDING), ("arm", ASCENDING), ("age", ASCENDING)],
-                name="idx_site_arm_age",
-            ),
-        ],
-        "visits": [
-            db.visits.create_index(
-                [("participant_id", ASCENDING), ("visit_no", ASCENDING)],
-                unique=True,
-                name="uid_participant_visit",
-            ),
-            db.visits.create_index(
-                [("site_id", ASCENDING), ("visit_date", DESCENDING)],
-                name="idx_visit_site_date",
-            ),
-            db.visits.create_index(
-                [("attachments.modality", ASCENDING), ("visit_date", DESCENDING)],
-                name="idx_visit_attachment_modality",
-            ),
-        ],
-        "clinical_notes": [
-            db.clinical_notes.create_index(
-                [("note_text", TEXT)],
-                default_language="english",
-                name="txt_note_text",
-            ),
-            db.clinical_notes.create_index(
-                [("participant_id", ASCENDING), ("created_at", DESCENDING)],
-                name="idx_note_participant_created",
-            ),
-        ],
-    }
+    started = time.perf_counter()
+    timings = build_indexes(db)
 
-    print("Indexes created:")
-    for col, names in created.items():
-        print(f"- {col}: {', '.join(names)}")
+    print(f"Indexes created in {time.perf_counter() - started:.3f}s:")
+    print_index_timings(timings)
 
     client.close()
 
@@ -1,177 +1,75 @@
 from __future__ import annotations
 
+import argparse
+
 from bson.json_util import dumps
 
 from common import get_db, get_settings
+from pagination import DEFAULT_PARAMS, PAGED_LISTINGS, iter_pages
+from query_cache import add_cache_arguments, open_cache
+from queries import (
+    DEMO_QUERIES,
+    QUERY_SPECS,
+    add_variant_arguments,
+    current_layout,
+    preview_query,
+    resolve_queries,
+    route_variants,
+    selected_variants,
+)
 
 
-def print_block(title: str, docs: list[dict]) -> None:
-    print(f"\n=== {title} (count={len(docs)}) ===")
-    preview = docs[:5]
+def print_block(title: str, preview: list[dict], count: int, cached: bool = False) -> None:
+    print(f"\n=== {title} (count={count}{', cached' if cached else ''}) ===")
     for doc in preview:
         print(dumps(doc, ensure_ascii=False))
-    if len(docs) > 5:
+    if count > len(preview):
         print("...")
 
 
-def main() -> None:
-    settings = get_settings()
-    db, client = get_db(settings)
-
-    q1 = list(
-        db.participants.find(
-            {"arm": "drug_a", "site_id": "SITE-03", "age": {"$gte": 40, "$lte": 65}},
-            {"_id": 0, "participant_id": 1, "age": 1, "arm": 1, "site_id": 1},
-        ).sort("age", 1)
+def parse_args(defaults: dict) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run the demo queries.")
+    add_variant_arguments(parser)
+    parser.add_argument("--preview", type=int, default=5, help="Documents to print per query.")
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=0,
+        help="Cursor batch size for previews (0 = one batch of --preview documents; server default for pipelines).",
     )
-    print_block("Q1 structured filter participants", q1)
-
-    q2 = list(
-        db.participants.aggregate(
-            [
-                {
-                    "$group": {
-                        "_id": "$arm",
-                        "total": {"$sum": 1},
-                        "completed": {
-                            "$sum": {"$cond": [{"$eq": ["$status", "completed"]}, 1, 0]}
-                        },
-                    }
-                },
-                {
-                    "$project": {
-                        "_id": 0,
-                        "arm": "$_id",
-                        "total": 1,
-                        "completed": 1,
-                        "completion_rate": {
-                            "$round": [{"$divide": ["$completed", "$total"]}, 3]
-                        },
-                    }
-                },
-                {"$sort": {"arm": 1}},
-            ]
-        )
+    parser.add_argument(
+        "--pages",
+        type=int,
+        default=0,
+        help="Also walk this many keyset pages (of --preview documents) of each paged listing.",
     )
-    print_block("Q2 completion rate by arm", q2)
+    add_cache_arguments(parser, defaults)
+    return parser.parse_args()
 
-    q3 = list(
-        db.visits.aggregate(
-            [
-                {
-                    "$lookup": {
-                        "from": "participants",
-                        "localField": "participant_id",
-                        "foreignField": "participant_id",
-                        "as": "p",
-                    }
-                },
-                {"$unwind": "$p"},
-                {
-                    "$group": {
-                        "_id": {"arm": "$p.arm", "visit_no": "$visit_no"},
-                        "avg_symptom_score": {"$avg": "$symptom_score"},
-                        "n": {"$sum": 1},
-                    }
-                },
-                {
-                    "$project": {
-                        "_id": 0,
-                        "arm": "$_id.arm",
-                        "visit_no": "$_id.visit_no",
-                        "avg_symptom_score": {"$round": ["$avg_symptom_score", 2]},
-                        "n": 1,
-                    }
-                },
-                {"$sort": {"arm": 1, "visit_no": 1}},
-            ]
-        )
-    )
-    print_block("Q3 symptom trend by arm", q3)
 
-    q4 = list(
-        db.clinical_notes.find(
-            {"$text": {"$search": "fatigue nausea"}},
-            {
-                "_id": 0,
-                "participant_id": 1,
-                "visit_id": 1,
-                "note_text": 1,
-                "score": {"$meta": "textScore"},
-            },
-        )
-        .sort([("score", {"$meta": "textScore"})])
-        .limit(10)
-    )
-    print_block("Q4 text search notes", q4)
+def main() -> None:
+    settings = get_settings()
+    args = parse_args(settings)
+    if args.preview <= 0 or args.batch_size < 0 or args.pages < 0:
+        raise ValueError("preview must be > 0, batch-size and pages >= 0")
+    cache = open_cache(args)
+    db, client = get_db(settings)
 
-    q5 = list(
-        db.clinical_notes.aggregate(
-            [
-                {"$match": {"$text": {"$search": "\"chest discomfort\" fatigue"}}},
-                {
-                    "$lookup": {
-                        "from": "participants",
-                        "localField": "participant_id",
-                        "foreignField": "participant_id",
-                        "as": "p",
-                    }
-                },
-                {"$unwind": "$p"},
-                {"$match": {"p.arm": "drug_a", "p.age": {"$gte": 50}}},
-                {
-                    "$group": {
-                        "_id": "$p.site_id",
-                        "note_hits": {"$sum": 1},
-                        "participants": {"$addToSet": "$participant_id"},
-                    }
-                },
-                {
-                    "$project": {
-                        "_id": 0,
-                        "site_id": "$_id",
-                        "note_hits": 1,
-                        "unique_participants": {"$size": "$participants"},
-                    }
-                },
-                {"$sort": {"note_hits": -1}},
-            ]
-        )
-    )
-    print_block("Q5 hybrid text + structured filter", q5)
+    variants = route_variants(selected_variants(args), current_layout(db))
+    for name in resolve_queries(DEMO_QUERIES, variants):
+        spec = QUERY_SPECS[name]
+        if cache is None:
+            print_block(spec["title"], *preview_query(db, spec, args.preview, args.batch_size))
+        else:
+            print_block(spec["title"], *cache.preview(db, spec, args.preview, args.batch_size))
 
-    q6 = list(
-        db.visits.aggregate(
-            [
-                {
-                    "$addFields": {
-                        "ct_attachments": {
-                            "$filter": {
-                                "input": "$attachments",
-                                "as": "attachment",
-                                "cond": {"$eq": ["$$attachment.modality", "CT"]},
-                            }
-                        }
-                    }
-                },
-                {"$match": {"ct_attachments.0": {"$exists": True}}},
-                {
-                    "$project": {
-                        "_id": 0,
-                        "visit_id": 1,
-                        "participant_id": 1,
-                        "site_id": 1,
-                        "ct_count": {"$size": "$ct_attachments"},
-                        "ct_uris": "$ct_attachments.storage_uri",
-                    }
-                },
-                {"$sort": {"visit_id": 1}},
-                {"$limit": 10},
-            ]
-        )
-    )
-    print_block("Q6 visits with CT attachment links", q6)
+    for name, listing in PAGED_LISTINGS.items() if args.pages else ():
+        for page, (items, token) in enumerate(iter_pages(db, name, DEFAULT_PARAMS, args.preview, args.pages), 1):
+            print_block(f"{listing['title']}, page {page}{'' if token else ', last'}", items, len(items))
 
+    if cache is not None:
+        cache.save()
+        print(f"\nQuery cache: {cache.summary()}")
     client.close()
 
 
@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import argparse
+import time
+
+from pymongo import UpdateMany
+
+from common import get_db, get_settings
+from manifest import bump_generation
+from rollups import refresh_rollups, rollups_enabled
+from visit_layout import refresh_visit_layout
+
+SNAPSHOT_FIELDS = ("arm", "age", "sex_at_birth", "status")
+SNAPSHOT_COLLECTIONS = ("visits", "clinical_notes")
+# How long watch waits for more changes before refreshing the batch it has.
+WATCH_IDLE_MS = 1000
+
+
+def participant_snapshot(participant: dict) -> dict:
+    return {field: participant[field] for field in SNAPSHOT_FIELDS}
+
+
+def snapshot_operations(participant: dict) -> list[UpdateMany]:
+    return [
+        UpdateMany(
+            {"participant_id": participant["participant_id"]},
+            {"$set": {"participant": participant_snapshot(participant)}},
+        )
+    ]
+
+
+def propagate_snapshot(db, participant: dict) -> None:
+    for collection_name in SNAPSHOT_COLLECTIONS:
+        db[collection_name].bulk_write(snapshot_operations(participant), ordered=False)
+
+
+def update_participant(db, participant_id: str, changes: dict) -> dict | None:
+    # Participant updates go through here so the embedded snapshots never drift.
+    participant = db.participants.find_one_and_update(
+        {"participant_id": participant_id},
+        {"$set": changes},
+        projection={"_id": 0, "participant_id": 1, **{field: 1 for field in SNAPSHOT_FIELDS}},
+        return_document=True,
+    )
+    if participant is not None and set(changes) & set(SNAPSHOT_FIELDS):
+        propagate_snapshot(db, participant)
+        refresh_visit_layout(db, [participant_id])
+    if participant is not None and rollups_enabled(db):
+        refresh_rollups(db, [participant_id])
+    if participant is not None:
+        bump_generation()
+    return participant
+
+
+def backfill(db, batch_size: int) -> dict:
+    projection = {"_id": 0, "participant_id": 1, **{field: 1 for field in SNAPSHOT_FIELDS}}
+    updated = {name: 0 for name in SNAPSHOT_COLLECTIONS}
+    participants = 0
+    operations: list[UpdateMany] = []
+
+    def flush() -> None:
+        for collection_name in SNAPSHOT_COLLECTIONS:
+            result = db[collection_name].bulk_write(operations, ordered=False)
+            updated[collection_name] += result.modified_count
+        operations.clear()
+
+    for participant in db.participants.find({}, projection, batch_size=batch_size):
+        operations.extend(snapshot_operations(participant))
+        participants += 1
+        if len(operations) >= batch_size:
+            flush()
+    if operations:
+        flush()
+    return {"participants": participants, "modified": updated}
+
+
+def refresh_derived(db, participant_ids: list[str]) -> None:
+    # The visit layout and rollups are refreshed once per batch of changed participants.
+    refresh_visit_layout(db, participant_ids)
+    if rollups_enabled(db):
+        refresh_rollups(db, participant_ids)
+    bump_generation()
+
+
+def watch(db, batch_size: int) -> None:
+    # Change streams need a replica set or Atlas; a standalone mongod rejects this.
+    pipeline = [{"$match": {"operationType": {"$in": ["update", "replace"]}}}]
+    with db.participants.watch(pipeline, full_document="updateLookup", max_await_time_ms=WATCH_IDLE_MS) as stream:
+        print("Watching participants for snapshot changes (Ctrl+C to stop)")
+        pending: list[str] = []
+        while stream.alive:
+            change = stream.try_next()
+            participant = change and change.get("fullDocument")
+            touched = set(change.get("updateDescription", {}).get("updatedFields", {})) if change else set()
+            if participant and (change["operationType"] == "replace" or touched & set(SNAPSHOT_FIELDS)):
+                propagate_snapshot(db, participant)
+                if participant["participant_id"] not in pending:
+                    pending.append(participant["participant_id"])
+                print(f"- propagated snapshot for {participant['participant_id']}")
+            # A batch ends when it is full or the stream has gone quiet (try_next returned None).
+            if pending and (change is None or len(pending) >= batch_size):
+                refresh_derived(db, sorted(pending))
+                print(f"- refreshed visit layout and rollups for {len(pending)} participants")
+                pending = []
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Maintain the participant snapshot (arm, age, sex_at_birth, status) embedded in visits and notes."
+    )
+    parser.add_argument("command", choices=["backfill", "watch"])
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        help="Participants per backfill bulk write, and per visit layout and rollup refresh in watch.",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    settings = get_settings()
+    db, client = get_db(settings)
+
+    if args.command == "backfill":
+        started = time.perf_counter()
+        result = backfill(db, args.batch_size)
+        refresh_visit_layout(db)
+        bump_generation()
+        print(
+            f"Backfilled snapshots for {result['participants']} participants in "
+            f"{time.perf_counter() - started:.2f}s: "
+            + ", ".join(f"{name}={count}" for name, count in result["modified"].items())
+        )
+    else:
+        try:
+            watch(db, args.batch_size)
+        except KeyboardInterrupt:
+            pass
+
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
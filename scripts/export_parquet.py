@@ -0,0 +1,295 @@
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import shutil
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from bench_queries import time_calls
+from common import PROJECT_ROOT, get_db, get_settings
+from manifest import MANIFEST_PATH
+from queries import QUERY_SPECS, run_query
+from seed_data import ATTACHMENT_MODALITIES
+
+EXPORT_DIR = PROJECT_ROOT / "data" / "generated" / "parquet"
+TIMESTAMP = pa.timestamp("ms", tz="UTC")
+VITALS = ("systolic_bp", "diastolic_bp", "heart_rate")
+# Columns follow docs/DATA_MODEL.md. site_id is the hive partition key (site_id=SITE-01/),
+# so it lives in the directory names rather than inside the files.
+SCHEMAS = {
+    "participants": pa.schema(
+        [
+            ("participant_id", pa.string()),
+            ("trial_id", pa.string()),
+            ("arm", pa.string()),
+            ("age", pa.int16()),
+            ("sex_at_birth", pa.string()),
+            ("enrollment_date", TIMESTAMP),
+            ("status", pa.string()),
+            ("synthetic_flag", pa.bool_()),
+            ("content_hash", pa.string()),
+        ]
+    ),
+    "visits": pa.schema(
+        [
+            ("visit_id", pa.string()),
+            ("participant_id", pa.string()),
+            ("visit_no", pa.int16()),
+            ("visit_date", TIMESTAMP),
+            *[(f"vitals_{name}", pa.int16()) for name in VITALS],
+            ("symptom_score", pa.int8()),
+            ("protocol_deviation", pa.bool_()),
+            (
+                "attachments",
+                pa.list_(
+                    pa.struct(
+                        [
+                            ("attachment_id", pa.string()),
+                            ("modality", pa.string()),
+                            ("file_type", pa.string()),
+                            ("storage_uri", pa.string()),
+                            ("description", pa.string()),
+                            ("captured_at", TIMESTAMP),
+                            ("synthetic_flag", pa.bool_()),
+                        ]
+                    )
+                ),
+            ),
+            ("attachment_counts", pa.struct([(modality, pa.int16()) for modality in ATTACHMENT_MODALITIES])),
+            ("synthetic_flag", pa.bool_()),
+            ("content_hash", pa.string()),
+        ]
+    ),
+    "clinical_notes": pa.schema(
+        [
+            ("note_id", pa.string()),
+            ("participant_id", pa.string()),
+            ("visit_id", pa.string()),
+            ("note_type", pa.string()),
+            ("author_role", pa.string()),
+            ("note_text", pa.string()),
+            ("tags", pa.list_(pa.string())),
+            ("created_at", TIMESTAMP),
+            ("synthetic_flag", pa.bool_()),
+            ("content_hash", pa.string()),
+        ]
+    ),
+}
+
+
+def flatten_visit(doc: dict) -> dict:
+    vitals = doc.pop("vitals", None) or {}
+    for name in VITALS:
+        doc[f"vitals_{name}"] = vitals.get(name)
+    doc.setdefault("attachments", [])
+    return doc
+
+
+ROW_BUILDERS = {"visits": flatten_visit}
+
+
+def source_field(column: str) -> str:
+    return "vitals" if column.startswith("vitals_") else column
+
+
+class PartitionWriter:
+    # One open ParquetWriter per site; rows are buffered per site and converted to an
+    # Arrow record batch every `batch_rows`, so memory is bounded by sites x batch_rows.
+    def __init__(self, root: Path, schema: pa.Schema, batch_rows: int) -> None:
+        self.root = root
+        self.schema = schema
+        self.batch_rows = batch_rows
+        self.buffers: dict[str, list[dict]] = {}
+        self.writers: dict[str, pq.ParquetWriter] = {}
+        self.rows = 0
+
+    def add(self, site_id: str, row: dict) -> None:
+        buffer = self.buffers.setdefault(site_id, [])
+        buffer.append(row)
+        if len(buffer) >= self.batch_rows:
+            self.flush(site_id)
+
+    def flush(self, site_id: str) -> None:
+        buffer = self.buffers.get(site_id)
+        if not buffer:
+            return
+        if site_id not in self.writers:
+            partition = self.root / f"site_id={site_id}"
+            partition.mkdir(parents=True, exist_ok=True)
+            self.writers[site_id] = pq.ParquetWriter(partition / "part-0.parquet", self.schema, compression="zstd")
+        self.writers[site_id].write_batch(pa.RecordBatch.from_pylist(buffer, schema=self.schema))
+        self.rows += len(buffer)
+        buffer.clear()
+
+    def close(self) -> None:
+        for site_id in list(self.buffers):
+            self.flush(site_id)
+        for writer in self.writers.values():
+            writer.close()
+
+
+def export_collection(db, collection_name: str, out_dir: Path, batch_rows: int) -> dict:
+    schema = SCHEMAS[collection_name]
+    root = out_dir / collection_name
+    if root.exists():
+        shutil.rmtree(root)
+    projection = {"_id": 0, "site_id": 1, **{source_field(field.name): 1 for field in schema}}
+    build_row = ROW_BUILDERS.get(collection_name, dict)
+    writer = PartitionWriter(root, schema, batch_rows)
+    started = time.perf_counter()
+    try:
+        for doc in db[collection_name].find({}, projection, batch_size=batch_rows):
+            site_id = doc.pop("site_id")
+            writer.add(site_id, build_row(doc))
+    finally:
+        writer.close()
+    return {
+        "rows": writer.rows,
+        "partitions": sorted(writer.writers),
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+def load_table(out_dir: Path, collection_name: str, columns: list[str]) -> pa.Table:
+    dataset = ds.dataset(out_dir / collection_name, format="parquet", partitioning="hive")
+    return dataset.to_table(columns=columns)
+
+
+def completion_by_arm(out_dir: Path) -> list[dict]:
+    participants = load_table(out_dir, "participants", ["arm", "status"])
+    completed = pc.cast(pc.equal(participants["status"], "completed"), pa.int64())
+    grouped = (
+        participants.append_column("completed", completed)
+        .group_by("arm")
+        .aggregate([("arm", "count"), ("completed", "sum")])
+        .sort_by("arm")
+    )
+    rates = pc.round(pc.divide(pc.cast(grouped["completed_sum"], pa.float64()), grouped["arm_count"]), 3)
+    return [
+        {"total": total, "completed": completed, "arm": arm, "completion_rate": rate}
+        for arm, total, completed, rate in zip(
+            grouped["arm"].to_pylist(),
+            grouped["arm_count"].to_pylist(),
+            grouped["completed_sum"].to_pylist(),
+            rates.to_pylist(),
+        )
+    ]
+
+
+def symptom_trend(out_dir: Path) -> list[dict]:
+    participants = load_table(out_dir, "participants", ["participant_id", "arm"])
+    visits = load_table(out_dir, "visits", ["participant_id", "visit_no", "symptom_score"])
+    grouped = (
+        visits.join(participants, "participant_id", join_type="inner")
+        .group_by(["arm", "visit_no"])
+        .aggregate([("symptom_score", "mean"), ("symptom_score", "count")])
+        .sort_by([("arm", "ascending"), ("visit_no", "ascending")])
+    )
+    averages = pc.round(grouped["symptom_score_mean"], 2)
+    return [
+        {"n": n, "arm": arm, "visit_no": visit_no, "avg_symptom_score": average}
+        for arm, visit_no, n, average in zip(
+            grouped["arm"].to_pylist(),
+            grouped["visit_no"].to_pylist(),
+            grouped["symptom_score_count"].to_pylist(),
+            averages.to_pylist(),
+        )
+    ]
+
+
+FILE_QUERIES = {"Q2": completion_by_arm, "Q3": symptom_trend}
+
+
+def same_rows(expected: list[dict], actual: list[dict]) -> bool:
+    if len(expected) != len(actual):
+        return False
+    for left, right in zip(expected, actual):
+        for key, value in left.items():
+            other = right.get(key)
+            if isinstance(value, float) or isinstance(other, float):
+                # Both sides round half-to-even; allow one unit in the last place at the boundary.
+                if other is None or not math.isclose(value, other, abs_tol=0.01):
+                    return False
+            elif value != other:
+                return False
+    return True
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Export collections to partitioned Parquet and run Q2/Q3 offline.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export = subparsers.add_parser("export", help="Stream collections into Parquet files partitioned by site_id.")
+    export.add_argument("--collections", default=",".join(SCHEMAS), help="Comma-separated collections to export.")
+    export.add_argument("--out", type=Path, default=EXPORT_DIR)
+    export.add_argument("--batch-rows", type=int, default=50000, help="Rows per Arrow record batch and cursor batch.")
+    analyze = subparsers.add_parser("analyze", help="Run Q2/Q3 over the Parquet files and time them against MongoDB.")
+    analyze.add_argument("--out", type=Path, default=EXPORT_DIR)
+    analyze.add_argument("--iterations", type=int, default=10)
+    analyze.add_argument("--no-db", action="store_true", help="Only run the file path; skip the MongoDB comparison.")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+
+    if args.command == "export":
+        names = [name.strip() for name in args.collections.split(",") if name.strip()]
+        unknown = [name for name in names if name not in SCHEMAS]
+        if unknown:
+            raise ValueError(f"unknown collections: {unknown}; choose from {list(SCHEMAS)}")
+        if args.batch_rows <= 0:
+            raise ValueError("batch-rows must be > 0")
+        settings = get_settings()
+        db, client = get_db(settings)
+        summary = {
+            "db": db.name,
+            "exported_at_utc": datetime.now(timezone.utc).isoformat(),
+            "manifest_sha256": json.loads(MANIFEST_PATH.read_text(encoding="utf-8"))["sha256"]
+            if MANIFEST_PATH.exists()
+            else None,
+            "collections": {},
+        }
+        for name in names:
+            result = export_collection(db, name, args.out, args.batch_rows)
+            summary["collections"][name] = result
+            print(f"- {name}: {result['rows']} rows, {len(result['partitions'])} partitions, {result['seconds']}s")
+        client.close()
+        args.out.mkdir(parents=True, exist_ok=True)
+        (args.out / "_export.json").write_text(json.dumps(summary, indent=2), encoding="utf-8")
+        print(f"Parquet export written to {args.out}")
+        return
+
+    db = client = None
+    if not args.no_db:
+        db, client = get_db(get_settings())
+    mismatched = []
+    print(f"{'query':<5} {'path':<8} {'p50':>9} {'p95':>9} {'rows':>6}")
+    for name, file_query in FILE_QUERIES.items():
+        rows = file_query(args.out)
+        latency = time_calls(lambda: file_query(args.out), args.iterations)
+        print(f"{name:<5} {'parquet':<8} {latency['p50']:>9.3f} {latency['p95']:>9.3f} {len(rows):>6}")
+        if db is not None:
+            spec = QUERY_SPECS[name]
+            expected = list(run_query(db, spec))
+            latency = time_calls(lambda: list(run_query(db, spec)), args.iterations)
+            print(f"{name:<5} {'mongodb':<8} {latency['p50']:>9.3f} {latency['p95']:>9.3f} {len(expected):>6}")
+            if not same_rows(expected, rows):
+                mismatched.append(name)
+    if client is not None:
+        client.close()
+    if mismatched:
+        print(f"PARQUET MISMATCH: {', '.join(mismatched)} differ from the database; re-run export")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import argparse
+import sys
+import time
+
+from pymongo import UpdateOne
+
+from common import get_db, get_settings
+from create_indexes import INDEX_SPECS, build_index
+from manifest import bump_generation
+from queries import QUERY_SPECS, explain_query, run_query, summarize_explain
+from seed_data import attachment_counts
+from visit_layout import refresh_visit_layout
+
+CT_COUNTS_INDEX = next(spec for spec in INDEX_SPECS["visits"] if spec["name"] == "idx_visit_ct_counts")
+# Before (Q6s) and after (Q6) of the CT attachment query, plus the covered count (Q6c).
+EXPLAIN_QUERIES = ("Q6s", "Q6", "Q6c")
+
+
+def backfill(db, batch_size: int) -> dict:
+    # Visits loaded before attachment_counts existed get them computed exactly as the seeder does.
+    operations: list[UpdateOne] = []
+    visits = modified = 0
+    cursor = db.visits.find({"attachments.0": {"$exists": True}}, {"attachments.modality": 1}, batch_size=batch_size)
+    for visit in cursor:
+        counts = attachment_counts(visit["attachments"])
+        operations.append(UpdateOne({"_id": visit["_id"]}, {"$set": {"attachment_counts": counts}}))
+        visits += 1
+        if len(operations) >= batch_size:
+            modified += db.visits.bulk_write(operations, ordered=False).modified_count
+            operations.clear()
+    if operations:
+        modified += db.visits.bulk_write(operations, ordered=False).modified_count
+    return {"visits": visits, "modified": modified}
+
+
+def explain_rows(db) -> dict:
+    rows = {}
+    for name in EXPLAIN_QUERIES:
+        spec = QUERY_SPECS[name]
+        rows[name] = {**summarize_explain(explain_query(db, spec)), "rows": list(run_query(db, spec))}
+    return rows
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Maintain per-visit attachment counts and explain the Q6 rewrite.")
+    parser.add_argument(
+        "command",
+        choices=["backfill", "explain"],
+        help="backfill: add attachment_counts to loaded visits and build idx_visit_ct_counts; "
+        "explain: docs/keys examined by Q6s (before), Q6 (after) and Q6c (covered).",
+    )
+    parser.add_argument("--batch-size", type=int, default=1000, help="Visits per backfill bulk write.")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    if args.batch_size <= 0:
+        raise ValueError("batch-size must be > 0")
+    settings = get_settings()
+    db, client = get_db(settings)
+
+    if args.command == "backfill":
+        started = time.perf_counter()
+        result = backfill(db, args.batch_size)
+        build_index(db, "visits", CT_COUNTS_INDEX)
+        refresh_visit_layout(db)
+        bump_generation()
+        print(
+            f"attachment_counts set on {result['modified']} of {result['visits']} visits with attachments "
+            f"in {time.perf_counter() - started:.2f}s; {CT_COUNTS_INDEX['name']} built"
+        )
+    else:
+        visits = db.visits.estimated_document_count()
+        rows = explain_rows(db)
+        print(f"visits: {visits}")
+        print(f"{'query':<5} {'docsExam':>10} {'keysExam':>10} {'rows':>6}  plan")
+        for name, row in rows.items():
+            print(
+                f"{name:<5} {row['docs_examined']:>10} {row['keys_examined']:>10} {len(row['rows']):>6}  "
+                f"{' | '.join(row['stage_tree']) or '-'}"
+            )
+        if rows["Q6"]["rows"] != rows["Q6s"]["rows"]:
+            print("Q6 MISMATCH: the rewrite returns different visits than the original pipeline")
+            client.close()
+            sys.exit(1)
+
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+from __future__ import annotations
+
+import argparse
+import json
+from pathlib import Path
+
+from pymongo.errors import OperationFailure
+
+from bench_queries import bench_query
+from common import get_db, get_settings
+from create_indexes import build_index
+from queries import (
+    DEMO_QUERIES,
+    QUERY_SPECS,
+    add_variant_arguments,
+    current_layout,
+    explain_query,
+    resolve_queries,
+    route_variants,
+    run_query,
+    selected_variants,
+    summarize_explain,
+)
+
+EQUALITY_OPERATORS = {"$eq", "$in"}
+
+
+def access_pattern(spec: dict) -> tuple[dict, list[tuple[str, int]]]:
+    # The part of a query an index can serve: the find filter and sort, or the leading
+    # $match stages of a pipeline and a $sort directly after them.
+    if "pipeline" not in spec:
+        return spec["filter"], list(spec.get("sort", []))
+    clauses, sort = [], []
+    for stage in spec["pipeline"]:
+        if "$match" in stage:
+            clauses.append(stage["$match"])
+            continue
+        if "$sort" in stage:
+            sort = list(stage["$sort"].items())
+        break
+    if len(clauses) > 1:
+        return {"$and": clauses}, sort
+    return (clauses[0] if clauses else {}), sort
+
+
+def classify_predicates(query: dict) -> tuple[list[str], list[str], bool]:
+    # Splits filter fields into equality and range predicates; reports whether $text is involved.
+    equality, ranges, text = [], [], False
+    for field, condition in query.items():
+        if field == "$and":
+            for clause in condition:
+                more_equality, more_ranges, more_text = classify_predicates(clause)
+                equality += more_equality
+                ranges += more_ranges
+                text = text or more_text
+        elif field == "$text":
+            text = True
+        elif field.startswith("$"):
+            # $or / $nor / $expr need an index per branch; the advisor leaves them alone.
+            continue
+        elif isinstance(condition, dict) and any(key.startswith("$") for key in condition):
+            (equality if set(condition) <= EQUALITY_OPERATORS else ranges).append(field)
+        else:
+            equality.append(field)
+    return list(dict.fromkeys(equality)), list(dict.fromkeys(ranges)), text
+
+
+def esr_plan(spec: dict) -> dict:
+    query, sort = access_pattern(spec)
+    equality, ranges, text = classify_predicates(query)
+    # textScore and other $meta sorts cannot come from a B-tree index.
+    sort = [(field, direction) for field, direction in sort if direction in (1, -1) and field not in equality]
+    sorted_fields = {field for field, _ in sort}
+    ranges = [field for field in ranges if field not in equality and field not in sorted_fields]
+    return {"collection": spec["collection"], "equality": equality, "sort": sort, "range": ranges, "text": text}
+
+
+def esr_keys(plan: dict) -> list[tuple[str, int]]:
+    # Equality first (any order), then the sort in its own order and direction, then ranges.
+    return [(field, 1) for field in plan["equality"]] + plan["sort"] + [(field, 1) for field in plan["range"]]
+
+
+def satisfies(index_keys: list[tuple[str, int]], plan: dict) -> bool:
+    fields = [field for field, _ in index_keys]
+    equality_end = len(plan["equality"])
+    sort_end = equality_end + len(plan["sort"])
+    if set(fields[:equality_end]) != set(plan["equality"]):
+        return False
+    sort_keys = index_keys[equality_end:sort_end]
+    if [field for field, _ in sort_keys] != [field for field, _ in plan["sort"]]:
+        return False
+    directions = [direction * wanted for (_, direction), (_, wanted) in zip(sort_keys, plan["sort"])]
+    if len(set(directions)) > 1:
+        # Mixed directions only work if every sort key is flipped the same way.
+        return False
+    return set(plan["range"]) <= set(fields[sort_end:])
+
+
+def existing_indexes(db, collection_name: str) -> dict[str, list[tuple[str, int]]]:
+    return {
+        name: [(field, direction) for field, direction in info["key"]]
+        for name, info in db[collection_name].index_information().items()
+    }
+
+
+def index_ops(db, collection_names: set[str]) -> dict[tuple[str, str], dict]:
+    usage = {}
+    for collection_name in sorted(collection_names):
+        for stats in db[collection_name].aggregate([{"$indexStats": {}}]):
+            usage[(collection_name, stats["name"])] = {
+                "ops": stats["accesses"]["ops"],
+                "unique": bool(stats.get("spec", {}).get("unique")),
+            }
+    return usage
+
+
+def replay(db, names: list[str], repeat: int) -> None:
+    for _ in range(repeat):
+        for name in names:
+            for _ in run_query(db, QUERY_SPECS[name]):
+                pass
+
+
+def findings_for(name: str, explain: dict, plan: dict, max_ratio: float) -> list[dict]:
+    findings = []
+    indexable = bool(plan["equality"] or plan["range"])
+    if "COLLSCAN" in explain["plan_stages"]:
+        if indexable:
+            findings.append({"query": name, "kind": "collscan", "severity": "error", "detail": "COLLSCAN on a filter"})
+        else:
+            detail = "COLLSCAN, no leading $match (reads the whole collection by design)"
+            findings.append({"query": name, "kind": "collscan", "severity": "info", "detail": detail})
+    if "SORT" in explain["plan_stages"]:
+        findings.append({"query": name, "kind": "sort", "severity": "warn", "detail": "in-memory SORT"})
+    examined = max(explain["keys_examined"], explain["docs_examined"])
+    ratio = examined / max(explain["n_returned"], 1)
+    if ratio > max_ratio:
+        detail = f"examined {examined} keys/docs for {explain['n_returned']} returned (x{ratio:.1f})"
+        findings.append({"query": name, "kind": "ratio", "severity": "warn", "detail": detail})
+    return findings
+
+
+def analyze_workload(db, names: list[str], repeat: int = 3, max_ratio: float = 10.0) -> dict:
+    collections = {QUERY_SPECS[name]["collection"] for name in names}
+    before = index_ops(db, collections) if repeat else {}
+    replay(db, names, repeat)
+    after = index_ops(db, collections) if repeat else {}
+
+    report = {"queries": {}, "findings": [], "proposals": [], "unused": []}
+    proposed = set()
+    for name in names:
+        spec = QUERY_SPECS[name]
+        plan = esr_plan(spec)
+        try:
+            explain = summarize_explain(explain_query(db, spec))
+        except OperationFailure as exc:
+            report["findings"].append({"query": name, "kind": "failed", "severity": "error", "detail": str(exc)})
+            continue
+        findings = findings_for(name, explain, plan, max_ratio)
+        report["queries"][name] = {"explain": explain, "plan": plan}
+        report["findings"] += findings
+        if plan["text"] or not esr_keys(plan) or not any(f["severity"] != "info" for f in findings):
+            continue
+        indexes = existing_indexes(db, spec["collection"])
+        served_by = [index for index, keys in indexes.items() if satisfies(keys, plan)]
+        if served_by:
+            # An index with the right shape exists but the planner did not pick it (or it was not enough).
+            detail = f"ESR index {', '.join(served_by)} exists but the plan still shows the issue"
+            report["findings"].append({"query": name, "kind": "planner", "severity": "warn", "detail": detail})
+            continue
+        keys = esr_keys(plan)
+        if (spec["collection"], tuple(keys)) in proposed:
+            continue
+        proposed.add((spec["collection"], tuple(keys)))
+        report["proposals"].append(
+            {
+                "collection": spec["collection"],
+                "name": "idx_adv_" + "_".join(field.replace(".", "_") for field, _ in keys),
+                "keys": keys,
+                "queries": [name],
+                "esr": {key: plan[key] for key in ("equality", "sort", "range")},
+            }
+        )
+
+    for key, usage in sorted(after.items()):
+        collection_name, index_name = key
+        if index_name == "_id_" or usage["unique"]:
+            continue
+        if usage["ops"] - before.get(key, {"ops": 0})["ops"] == 0:
+            report["unused"].append(f"{collection_name}.{index_name}")
+    return report
+
+
+def workload_queries(db, args: argparse.Namespace | None = None) -> list[str]:
+    names = DEMO_QUERIES
+    variants: set[str] = set()
+    if args is not None:
+        names = [name.strip() for name in args.queries.split(",") if name.strip()]
+        variants = selected_variants(args)
+    names = resolve_queries(names, route_variants(variants, current_layout(db)))
+    unknown = [name for name in names if name not in QUERY_SPECS]
+    if unknown:
+        raise ValueError(f"unknown queries: {unknown}; choose from {sorted(QUERY_SPECS)}")
+    return names
+
+
+def print_report(report: dict) -> None:
+    print(f"{'query':<5} {'docsExam':>10} {'keysExam':>10} {'returned':>9}  plan")
+    for name, result in report["queries"].items():
+        explain = result["explain"]
+        print(
+            f"{name:<5} {explain['docs_examined']:>10} {explain['keys_examined']:>10} {explain['n_returned']:>9}  "
+            f"{' | '.join(explain['stage_tree']) or '-'}"
+        )
+    print("\nFindings:")
+    for finding in report["findings"] or [{"severity": "-", "query": "-", "detail": "none"}]:
+        print(f"- [{finding['severity']}] {finding['query']}: {finding['detail']}")
+    print("\nProposed indexes (equality, sort, range):")
+    for proposal in report["proposals"] or [None]:
+        if proposal is None:
+            print("- none")
+            continue
+        esr = proposal["esr"]
+        print(
+            f"- {proposal['collection']}.{proposal['name']} {proposal['keys']} for {', '.join(proposal['queries'])} "
+            f"(E={esr['equality']} S={[field for field, _ in esr['sort']]} R={esr['range']})"
+        )
+    if report["unused"]:
+        print("\nIndexes not used by this workload (other paths may still need them; unique indexes are skipped):")
+        for name in report["unused"]:
+            print(f"- {name}")
+
+
+def apply_proposals(db, report: dict, iterations: int) -> list[dict]:
+    # Time the affected queries, build the proposed indexes, then time and explain them again.
+    affected = sorted({name for proposal in report["proposals"] for name in proposal["queries"]})
+    before = {name: bench_query(db, QUERY_SPECS[name], iterations, 2, 1)["latency_ms"] for name in affected}
+    for proposal in report["proposals"]:
+        timing = build_index(db, proposal["collection"], {"name": proposal["name"], "keys": proposal["keys"]})
+        print(f"Built {proposal['collection']}.{proposal['name']} in {timing['seconds']}s")
+    results = []
+    for name in affected:
+        explain = summarize_explain(explain_query(db, QUERY_SPECS[name]))
+        after = bench_query(db, QUERY_SPECS[name], iterations, 2, 1)["latency_ms"]
+        old = report["queries"][name]["explain"]
+        results.append(
+            {
+                "query": name,
+                "p50_ms": [before[name]["p50"], after["p50"]],
+                "p95_ms": [before[name]["p95"], after["p95"]],
+                "docs_examined": [old["docs_examined"], explain["docs_examined"]],
+                "keys_examined": [old["keys_examined"], explain["keys_examined"]],
+                "plan": explain["stage_tree"],
+            }
+        )
+    return results
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Replay the demo workload, inspect plans and $indexStats, and propose ESR-ordered indexes."
+    )
+    parser.add_argument("--queries", default=",".join(DEMO_QUERIES), help="Comma-separated query names.")
+    add_variant_arguments(parser)
+    parser.add_argument("--repeat", type=int, default=3, help="Workload replays between the $indexStats snapshots.")
+    parser.add_argument("--max-ratio", type=float, default=10.0, help="Flag plans examining more per result returned.")
+    parser.add_argument("--apply", action="store_true", help="Build the proposed indexes and re-benchmark.")
+    parser.add_argument("--iterations", type=int, default=20, help="Benchmark iterations per query for --apply.")
+    parser.add_argument("--out", type=Path, help="Also write the report as JSON.")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    if args.repeat < 0 or args.max_ratio <= 0 or args.iterations <= 0:
+        raise ValueError("repeat must be >= 0, max-ratio and iterations > 0")
+    settings = get_settings()
+    db, client = get_db(settings)
+
+    names = workload_queries(db, args)
+    print(f"Workload: {', '.join(names)} (x{args.repeat})\n")
+    report = analyze_workload(db, names, args.repeat, args.max_ratio)
+    print_report(report)
+    if args.apply and report["proposals"]:
+        print()
+        report["applied"] = apply_proposals(db, report, args.iterations)
+        print(f"\n{'query':<5} {'p50 before':>11} {'p50 after':>10} {'docsExam':>17} {'keysExam':>17}")
+        for row in report["applied"]:
+            print(
+                f"{row['query']:<5} {row['p50_ms'][0]:>11.3f} {row['p50_ms'][1]:>10.3f} "
+                f"{row['docs_examined'][0]:>8} -> {row['docs_examined'][1]:<6} "
+                f"{row['keys_examined'][0]:>8} -> {row['keys_examined'][1]:<6}"
+            )
+        print("Add the indexes you keep to INDEX_SPECS in scripts/create_indexes.py so `make indexes` recreates them.")
+    if args.out:
+        args.out.parent.mkdir(parents=True, exist_ok=True)
+        args.out.write_text(json.dumps(report, indent=2, default=str), encoding="utf-8")
+        print(f"\nReport written to {args.out}")
+
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
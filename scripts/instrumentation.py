@@ -0,0 +1,433 @@
+from __future__ import annotations
+
+import atexit
+import json
+import multiprocessing
+import queue
+import sys
+import threading
+import time
+from bisect import bisect_left
+from datetime import datetime, timezone
+from pathlib import Path
+
+import bson
+from pymongo import monitoring
+
+from common import PROJECT_ROOT
+
+METRICS_DIR = PROJECT_ROOT / "data" / "generated" / "metrics"
+METRICS_FORMATS = ("off", "json", "prometheus")
+BUCKETS_MS = (0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# Command fields that describe what an operation asked for. The slow-op log masks the literal values
+# in the first group and copies the second (sort directions, projections, index names) verbatim.
+SHAPE_KEYS = ("filter", "query", "pipeline", "updates", "deletes")
+PLAN_KEYS = ("sort", "projection", "hint")
+SLOWEST_KEPT = 20
+POOL_COUNTERS = ("connections_created", "connections_closed", "checkout_failures", "pool_cleared")
+
+
+def query_shape(value):
+    # Field names, operators and "$field" paths are kept; every literal becomes "?".
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        if value and all(isinstance(item, dict) for item in value):
+            return [query_shape(item) for item in value]
+        return ["?"] if value else []
+    if isinstance(value, str) and value.startswith("$"):
+        return value
+    return "?"
+
+
+def command_shape(command: dict) -> dict:
+    shape = {}
+    for key in SHAPE_KEYS:
+        if key not in command:
+            continue
+        value = command[key]
+        if key in ("updates", "deletes"):
+            # Bulk statements share one shape; the first stands for all of them.
+            shape["statements"] = len(value)
+            value = value[:1]
+        shape[key] = query_shape(value)
+    shape.update({key: command[key] for key in PLAN_KEYS if key in command})
+    if "documents" in command:
+        shape["documents"] = len(command["documents"])
+    return shape
+
+
+def target_collection(event) -> str:
+    target = event.command.get(event.command_name)
+    if event.command_name == "getMore":
+        target = event.command.get("collection")
+    return target if isinstance(target, str) else "-"
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def state(self) -> dict:
+        return {"buckets": list(self.buckets), "count": self.count, "total_ms": self.total_ms, "max_ms": self.max_ms}
+
+    def merge(self, state: dict) -> None:
+        self.buckets = [mine + theirs for mine, theirs in zip(self.buckets, state["buckets"])]
+        self.count += state["count"]
+        self.total_ms += state["total_ms"]
+        self.max_ms = max(self.max_ms, state["max_ms"])
+
+    def observe(self, ms: float) -> None:
+        self.buckets[bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket holding the q-th observation (max for the overflow bucket).
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS_MS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max_ms)
+        return self.max_ms
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "sum_ms": round(self.total_ms, 3),
+            "mean_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "max_ms": round(self.max_ms, 3),
+            "p50_ms": self.quantile(0.5),
+            "p95_ms": self.quantile(0.95),
+            "p99_ms": self.quantile(0.99),
+            "buckets": {
+                **{f"le_{bound}": count for bound, count in zip(BUCKETS_MS, self.buckets)},
+                "le_inf": self.buckets[-1],
+            },
+        }
+
+    def prometheus(self, name: str, labels: str) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(BUCKETS_MS, self.buckets):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound / 1000:g}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.total_ms / 1000:.6f}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+class CommandStats:
+    COUNTERS = ("request_bytes", "response_bytes", "failures", "retries")
+
+    def __init__(self) -> None:
+        self.latency = Histogram()
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.failures = 0
+        self.retries = 0
+
+    def state(self) -> dict:
+        return {"latency": self.latency.state(), **{name: getattr(self, name) for name in self.COUNTERS}}
+
+    def merge(self, state: dict) -> None:
+        self.latency.merge(state["latency"])
+        for name in self.COUNTERS:
+            setattr(self, name, getattr(self, name) + state[name])
+
+
+class SlowOpLog:
+    # Slow operations are appended by a background thread, so the driver thread that finished the
+    # command only enqueues. Each drained batch is one O_APPEND write, which keeps lines from
+    # --workers processes sharing the file whole.
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.thread: threading.Thread | None = None
+        self.lock = threading.Lock()
+
+    def put(self, entry: dict) -> None:
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._drain, name="slow-op-log", daemon=True)
+                self.thread.start()
+        self.queue.put(entry)
+
+    def _drain(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open("ab", buffering=0) as handle:
+            done = False
+            while not done:
+                entries = [self.queue.get()]
+                while not self.queue.empty():
+                    entries.append(self.queue.get())
+                done = None in entries
+                lines = [json.dumps(entry, default=str) + "\n" for entry in entries if entry is not None]
+                if lines:
+                    handle.write("".join(lines).encode("utf-8"))
+
+    def close(self) -> None:
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join()
+
+
+class Metrics(monitoring.CommandListener, monitoring.ConnectionPoolListener):
+    # One registry per process, fed by every instrumented client. Listener callbacks run on the
+    # driver's threads, so all updates go through one lock.
+    def __init__(self, slow_ms: float, slow_log: Path, measure_bytes: bool = False) -> None:
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.slow_ms = slow_ms
+        self.slow_log = SlowOpLog(slow_log)
+        # pymongo's events do not carry the wire size, so measuring bytes means re-encoding every
+        # command and reply; it is opt-in (MONGO_METRICS_BYTES).
+        self.measure_bytes = measure_bytes
+        self.commands: dict[tuple[str, str], CommandStats] = {}
+        self.pending: dict[tuple, tuple[str, dict]] = {}
+        self.failed_operations: set[int] = set()
+        self.checkout: dict[str, Histogram] = {}
+        self.pool = dict.fromkeys(POOL_COUNTERS, 0)
+        self.slow_ops = 0
+        self.slowest: list[dict] = []
+
+    def _stats(self, command_name: str, collection: str) -> CommandStats:
+        key = (command_name, collection)
+        if key not in self.commands:
+            self.commands[key] = CommandStats()
+        return self.commands[key]
+
+    def started(self, event) -> None:
+        size = len(bson.encode(event.command)) if self.measure_bytes else 0
+        collection = target_collection(event)
+        with self.lock:
+            stats = self._stats(event.command_name, collection)
+            stats.request_bytes += size
+            if event.operation_id in self.failed_operations:
+                # Retryable reads and writes resend under the operation_id of the failed attempt.
+                self.failed_operations.discard(event.operation_id)
+                stats.retries += 1
+            self.pending[(event.connection_id, event.request_id)] = (collection, event.command)
+
+    def succeeded(self, event) -> None:
+        self._finish(event, len(bson.encode(event.reply)) if self.measure_bytes else 0, failed=False)
+
+    def failed(self, event) -> None:
+        self._finish(event, 0, failed=True)
+
+    def _finish(self, event, reply_size: int, failed: bool) -> None:
+        ms = event.duration_micros / 1000
+        with self.lock:
+            collection, command = self.pending.pop((event.connection_id, event.request_id), ("-", {}))
+            stats = self._stats(event.command_name, collection)
+            stats.latency.observe(ms)
+            stats.response_bytes += reply_size
+            if failed:
+                stats.failures += 1
+                self.failed_operations.add(event.operation_id)
+            if ms < self.slow_ms:
+                return
+            self.slow_ops += 1
+        entry = {
+            "at_utc": datetime.now(timezone.utc).isoformat(),
+            "script": Path(sys.argv[0]).name,
+            "command": event.command_name,
+            "collection": collection,
+            "ms": round(ms, 3),
+            "failed": failed,
+            "shape": command_shape(command),
+        }
+        with self.lock:
+            self._keep_slowest([entry])
+        self.slow_log.put(entry)
+
+    def _keep_slowest(self, entries: list[dict]) -> None:
+        self.slowest.extend(entries)
+        self.slowest.sort(key=lambda item: item["ms"], reverse=True)
+        del self.slowest[SLOWEST_KEPT:]
+
+    def drain(self) -> dict:
+        # Hands the counts gathered so far to the caller and starts again from zero; --workers
+        # processes send this back with each shard so the parent can merge it.
+        with self.lock:
+            state = {
+                "commands": [(key, stats.state()) for key, stats in self.commands.items()],
+                "checkout": {address: histogram.state() for address, histogram in self.checkout.items()},
+                "pool": dict(self.pool),
+                "slow_ops": self.slow_ops,
+                "slowest": list(self.slowest),
+            }
+            self.commands, self.checkout = {}, {}
+            self.pool = dict.fromkeys(POOL_COUNTERS, 0)
+            self.slow_ops, self.slowest = 0, []
+        return state
+
+    def merge(self, state: dict) -> None:
+        with self.lock:
+            for (command_name, collection), stats in state["commands"]:
+                self._stats(command_name, collection).merge(stats)
+            for address, histogram in state["checkout"].items():
+                self.checkout.setdefault(address, Histogram()).merge(histogram)
+            for name, value in state["pool"].items():
+                self.pool[name] += value
+            self.slow_ops += state["slow_ops"]
+            self._keep_slowest(state["slowest"])
+
+    def connection_checked_out(self, event) -> None:
+        with self.lock:
+            address = f"{event.address[0]}:{event.address[1]}"
+            self.checkout.setdefault(address, Histogram()).observe(event.duration * 1000)
+
+    def connection_check_out_failed(self, event) -> None:
+        with self.lock:
+            self.pool["checkout_failures"] += 1
+
+    def connection_created(self, event) -> None:
+        with self.lock:
+            self.pool["connections_created"] += 1
+
+    def connection_closed(self, event) -> None:
+        with self.lock:
+            self.pool["connections_closed"] += 1
+
+    def pool_cleared(self, event) -> None:
+        with self.lock:
+            self.pool["pool_cleared"] += 1
+
+    # The remaining pool events carry nothing that is aggregated here.
+    def pool_created(self, event) -> None:
+        pass
+
+    def pool_ready(self, event) -> None:
+        pass
+
+    def pool_closed(self, event) -> None:
+        pass
+
+    def connection_ready(self, event) -> None:
+        pass
+
+    def connection_check_out_started(self, event) -> None:
+        pass
+
+    def connection_checked_in(self, event) -> None:
+        pass
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {
+                "script": Path(sys.argv[0]).name,
+                "started_at_utc": datetime.fromtimestamp(self.started_at, timezone.utc).isoformat(),
+                "seconds": round(time.time() - self.started_at, 3),
+                "commands": [
+                    {
+                        "command": command_name,
+                        "collection": collection,
+                        "latency": stats.latency.summary(),
+                        **(
+                            {"request_bytes": stats.request_bytes, "response_bytes": stats.response_bytes}
+                            if self.measure_bytes
+                            else {}
+                        ),
+                        "failures": stats.failures,
+                        "retries": stats.retries,
+                    }
+                    for (command_name, collection), stats in sorted(self.commands.items())
+                ],
+                "pool": {**self.pool, "checkout_wait": {address: h.summary() for address, h in self.checkout.items()}},
+                "slow_ms": self.slow_ms,
+                "slow_ops": self.slow_ops,
+                "slowest": list(self.slowest),
+            }
+
+    def prometheus(self) -> str:
+        lines = [
+            "# HELP mongo_command_duration_seconds Server command round-trip time.",
+            "# TYPE mongo_command_duration_seconds histogram",
+        ]
+        with self.lock:
+            items = sorted(self.commands.items())
+            for (command_name, collection), stats in items:
+                lines += stats.latency.prometheus(
+                    "mongo_command_duration_seconds", f'command="{command_name}",collection="{collection}"'
+                )
+            counters = {
+                "mongo_command_failures_total": ("Commands that failed.", "failures"),
+                "mongo_command_retries_total": ("Commands resent after a failed attempt.", "retries"),
+            }
+            if self.measure_bytes:
+                counters = {
+                    "mongo_command_request_bytes_total": ("Encoded command size.", "request_bytes"),
+                    "mongo_command_response_bytes_total": ("Encoded reply size.", "response_bytes"),
+                    **counters,
+                }
+            for name, (help_text, attribute) in counters.items():
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+                for (command_name, collection), stats in items:
+                    labels = f'command="{command_name}",collection="{collection}"'
+                    lines.append(f"{name}{{{labels}}} {getattr(stats, attribute)}")
+            lines += [
+                "# HELP mongo_pool_checkout_wait_seconds Time to check a connection out of the pool.",
+                "# TYPE mongo_pool_checkout_wait_seconds histogram",
+            ]
+            for address, histogram in sorted(self.checkout.items()):
+                lines += histogram.prometheus("mongo_pool_checkout_wait_seconds", f'address="{address}"')
+            for name, value in self.pool.items():
+                lines += [f"# TYPE mongo_pool_{name}_total counter", f"mongo_pool_{name}_total {value}"]
+            lines += ["# TYPE mongo_slow_operations_total counter", f"mongo_slow_operations_total {self.slow_ops}"]
+        return "\n".join(lines) + "\n"
+
+
+_metrics: Metrics | None = None
+_metrics_lock = threading.Lock()
+
+
+def metrics_path(settings: dict) -> Path:
+    if settings["metrics_path"]:
+        return Path(settings["metrics_path"])
+    suffix = "json" if settings["metrics"] == "json" else "prom"
+    return METRICS_DIR / f"{Path(sys.argv[0]).stem}.{suffix}"
+
+
+def write_metrics(settings: dict) -> None:
+    # Only the main process writes; worker processes hand their counts over with drain_metrics().
+    if _metrics is None:
+        return
+    _metrics.slow_log.close()
+    if multiprocessing.parent_process() is not None:
+        return
+    path = metrics_path(settings)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if settings["metrics"] == "json":
+        path.write_text(json.dumps(_metrics.summary(), indent=2, default=str), encoding="utf-8")
+    else:
+        path.write_text(_metrics.prometheus(), encoding="utf-8")
+    print(f"MongoDB metrics written to {path}")
+
+
+def install_metrics(settings: dict) -> Metrics:
+    global _metrics
+    if settings["metrics"] not in METRICS_FORMATS:
+        raise ValueError(f"MONGO_METRICS must be one of {METRICS_FORMATS}, got {settings['metrics']!r}")
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics(settings["slow_ms"], METRICS_DIR / "slow_ops.jsonl", settings["metrics_bytes"])
+            atexit.register(write_metrics, settings)
+    return _metrics
+
+
+def drain_metrics() -> dict | None:
+    return _metrics.drain() if _metrics is not None else None
+
+
+def merge_metrics(settings: dict, state: dict | None) -> None:
+    if state is not None:
+        install_metrics(settings).merge(state)
@@ -0,0 +1,268 @@
+from __future__ import annotations
+
+import argparse
+import re
+import time
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from bson.json_util import dumps
+
+from bench_queries import time_calls
+from common import get_db, get_settings
+from queries import run_query
+from seed_data import SYMPTOMS
+
+VOCABULARY = set(SYMPTOMS)
+MULTIWORD_TERMS = {tuple(term.split()) for term in SYMPTOMS if " " in term}
+NOTE_PROJECTION = {"_id": 0, "participant_id": 1, "visit_id": 1, "note_text": 1, "tags": 1, "created_at": 1}
+BENCH_SEARCHES = [
+    {"query": "fatigue nausea", "mode": "any"},
+    {"query": '"chest discomfort" fatigue', "mode": "any"},
+    {"query": "fatigue nausea", "mode": "all"},
+    {"query": "insomnia", "mode": "any", "site_id": "SITE-03"},
+]
+
+
+def parse_terms(query: str) -> tuple[list[str], list[str]]:
+    phrases = [match.lower() for match in re.findall(r'"([^"]+)"', query)]
+    words = re.sub(r'"[^"]*"', " ", query).lower().split()
+    terms = []
+    position = 0
+    while position < len(words):
+        pair = tuple(words[position : position + 2])
+        if pair in MULTIWORD_TERMS:
+            terms.append(" ".join(pair))
+            position += 2
+        else:
+            terms.append(words[position])
+            position += 1
+    return phrases, terms
+
+
+def plan_search(query: str, mode: str = "any") -> dict:
+    # Symptom searches are answered from the multikey tags index. Anything outside the
+    # generated vocabulary still needs the stemmed $text index.
+    phrases, terms = parse_terms(query)
+    outside = [term for term in phrases + terms if term not in VOCABULARY]
+    if not phrases and not terms:
+        raise ValueError("empty search")
+    if outside:
+        return {"engine": "text", "phrases": phrases, "terms": terms, "reason": f"not in symptom vocabulary: {outside}"}
+    # Like $text: when phrases are given only they must match; otherwise any term matches.
+    if mode == "all":
+        required, any_of = phrases + terms, []
+    elif phrases:
+        required, any_of = phrases, []
+    else:
+        required, any_of = [], terms
+    return {"engine": "tags", "phrases": phrases, "terms": terms, "required": required, "any_of": any_of}
+
+
+def parse_since(value: str) -> datetime:
+    # Stored dates come back from the driver as naive UTC, so offsets are converted and dropped here.
+    since = datetime.fromisoformat(value)
+    if since.tzinfo is not None:
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    return since
+
+
+def search_spec(plan: dict, site_id: str | None = None, since: datetime | None = None, limit: int = 10) -> dict:
+    if plan["engine"] == "tags":
+        query_filter = {}
+        if plan["required"]:
+            query_filter["tags"] = {"$all": plan["required"]}
+        else:
+            query_filter["tags"] = {"$in": plan["any_of"]}
+        sort = [("created_at", -1)]
+        projection = NOTE_PROJECTION
+    else:
+        quoted = [f'"{term}"' for term in plan["phrases"]]
+        query_filter = {"$text": {"$search": " ".join(quoted + plan["terms"])}}
+        sort = [("score", {"$meta": "textScore"})]
+        projection = {**NOTE_PROJECTION, "score": {"$meta": "textScore"}}
+    if site_id:
+        query_filter["site_id"] = site_id
+    if since:
+        query_filter["created_at"] = {"$gte": since}
+    spec = {
+        "title": f"keyword search via {plan['engine']}",
+        "collection": "clinical_notes",
+        "filter": query_filter,
+        "projection": projection,
+        "sort": sort,
+    }
+    if limit:
+        spec["limit"] = limit
+    return spec
+
+
+def text_plan(query: str, mode: str = "any") -> dict:
+    phrases, terms = parse_terms(query)
+    if mode == "all":
+        return {"engine": "text", "phrases": phrases + terms, "terms": []}
+    return {"engine": "text", "phrases": phrases, "terms": terms}
+
+
+class InvertedIndex:
+    # term -> sorted posting list of note ordinals, built by streaming over clinical_notes.
+    # Sites are indexed as "site:<site_id>" terms so site filters are just another intersection.
+    def __init__(self, cache_size: int = 256) -> None:
+        self.note_ids: list = []
+        self.created_at: list[datetime] = []
+        self.postings: dict[str, array] = {}
+        self.cache_size = cache_size
+        self.cache: OrderedDict[tuple, list[int]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def build(cls, db, batch_size: int = 5000, cache_size: int = 256) -> InvertedIndex:
+        index = cls(cache_size)
+        projection = {"_id": 1, "tags": 1, "site_id": 1, "created_at": 1}
+        for note in db.clinical_notes.find({}, projection, batch_size=batch_size):
+            index.add(note)
+        return index
+
+    def add(self, note: dict) -> None:
+        ordinal = len(self.note_ids)
+        self.note_ids.append(note["_id"])
+        self.created_at.append(note["created_at"])
+        for term in (*note.get("tags", []), f"site:{note['site_id']}"):
+            self.postings.setdefault(term, array("L")).append(ordinal)
+        self.cache.clear()
+
+    def match(self, plan: dict, site_id: str | None = None) -> list[int]:
+        key = (tuple(sorted(plan["required"])), tuple(sorted(plan["any_of"])), site_id)
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        self.misses += 1
+
+        lists = [self.postings.get(term, array("L")) for term in plan["required"]]
+        if plan["any_of"]:
+            union = set()
+            for term in plan["any_of"]:
+                union.update(self.postings.get(term, ()))
+            lists.append(sorted(union))
+        if site_id:
+            lists.append(self.postings.get(f"site:{site_id}", array("L")))
+        # Intersect smallest-first so every step only probes the shortest surviving list.
+        lists.sort(key=len)
+        matched = set(lists[0])
+        for postings in lists[1:]:
+            if not matched:
+                break
+            matched.intersection_update(postings)
+        result = sorted(matched)
+
+        self.cache[key] = result
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return result
+
+    def search(self, db, plan: dict, site_id: str | None = None, since: datetime | None = None, limit: int = 10):
+        ordinals = self.match(plan, site_id)
+        if since:
+            ordinals = [ordinal for ordinal in ordinals if self.created_at[ordinal] >= since]
+        newest = sorted(ordinals, key=self.created_at.__getitem__, reverse=True)
+        if limit:
+            newest = newest[:limit]
+        ids = [self.note_ids[ordinal] for ordinal in newest]
+        docs = {doc["_id"]: doc for doc in db.clinical_notes.find({"_id": {"$in": ids}}, {**NOTE_PROJECTION, "_id": 1})}
+        return [docs[note_id] for note_id in ids if note_id in docs], len(ordinals)
+
+
+def run_bench(db, iterations: int, limit: int) -> None:
+    started = time.perf_counter()
+    index = InvertedIndex.build(db)
+    print(
+        f"Inverted index: {len(index.note_ids)} notes, {len(index.postings)} terms, "
+        f"built in {time.perf_counter() - started:.2f}s"
+    )
+    print(f"{'search':<32} {'engine':<14} {'p50':>9} {'p95':>9} {'matches':>8}")
+    for search in BENCH_SEARCHES:
+        plan = plan_search(search["query"], search["mode"])
+        site_id = search.get("site_id")
+        label = f"{search['query']} [{search['mode']}{', ' + site_id if site_id else ''}]"
+        text_spec = search_spec(text_plan(search["query"], search["mode"]), site_id, limit=limit)
+        tags_spec = search_spec(plan, site_id, limit=limit)
+
+        counts = {
+            "$text": db.clinical_notes.count_documents(text_spec["filter"]),
+            "tags index": db.clinical_notes.count_documents(tags_spec["filter"]),
+        }
+        runs = {
+            "$text": lambda spec=text_spec: list(run_query(db, spec)),
+            "tags index": lambda spec=tags_spec: list(run_query(db, spec)),
+        }
+        for engine, call in runs.items():
+            latency = time_calls(call, iterations)
+            print(f"{label:<32} {engine:<14} {latency['p50']:>9.3f} {latency['p95']:>9.3f} {counts[engine]:>8}")
+
+        index.cache.clear()
+        cold = time_calls(lambda: index.search(db, plan, site_id, limit=limit), 1)
+        warm = time_calls(lambda: index.search(db, plan, site_id, limit=limit), iterations)
+        matches = index.search(db, plan, site_id, limit=limit)[1]
+        print(f"{label:<32} {'inverted cold':<14} {cold['p50']:>9.3f} {cold['p95']:>9.3f} {matches:>8}")
+        print(f"{label:<32} {'inverted warm':<14} {warm['p50']:>9.3f} {warm['p95']:>9.3f} {matches:>8}")
+        if len({*counts.values(), matches}) > 1:
+            print(f"  MISMATCH: engines disagree on matching notes for {label!r}")
+    print(f"Intersection cache: {index.hits} hits, {index.misses} misses")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Keyword search over clinical note tags, with $text as the fallback.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    search = subparsers.add_parser("search", help="Plan and run one keyword search.")
+    search.add_argument("query", help='Symptom terms; quote phrases, e.g. \'"chest discomfort" fatigue\'.')
+    search.add_argument("--all", action="store_true", help="Require every term instead of any.")
+    search.add_argument("--site", help="Restrict to one site_id.")
+    search.add_argument(
+        "--since",
+        type=parse_since,
+        help="Only notes created at or after this ISO date (UTC unless an offset is given).",
+    )
+    search.add_argument("--limit", type=int, default=10)
+    search.add_argument(
+        "--engine",
+        choices=["auto", "text", "inverted"],
+        default="auto",
+        help="auto lets the planner pick tags index or $text; inverted uses the in-process index.",
+    )
+    bench = subparsers.add_parser("bench", help="Compare $text, the tags index and the inverted index.")
+    bench.add_argument("--iterations", type=int, default=20)
+    bench.add_argument("--limit", type=int, default=10)
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    settings = get_settings()
+    db, client = get_db(settings)
+
+    if args.command == "bench":
+        run_bench(db, args.iterations, args.limit)
+    else:
+        mode = "all" if args.all else "any"
+        plan = text_plan(args.query, mode) if args.engine == "text" else plan_search(args.query, mode)
+        if args.engine == "inverted":
+            if plan["engine"] != "tags":
+                raise ValueError(f"the inverted index only covers the symptom vocabulary ({plan['reason']})")
+            docs, count = InvertedIndex.build(db).search(db, plan, args.site, args.since, args.limit)
+        else:
+            spec = search_spec(plan, args.site, args.since, args.limit)
+            docs = list(run_query(db, spec))
+            count = db.clinical_notes.count_documents(spec["filter"])
+        print(f"Plan: {plan['engine']}" + (f" ({plan['reason']})" if "reason" in plan else ""))
+        print(f"=== {count} matching notes ===")
+        for doc in docs:
+            print(dumps(doc, ensure_ascii=False))
+
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
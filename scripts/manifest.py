@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import struct
+from datetime import datetime, timezone
+
+import bson
+from bson.raw_bson import RawBSONDocument
+
+from common import PROJECT_ROOT
+
+MANIFEST_PATH = PROJECT_ROOT / "data" / "generated" / "manifest.json"
+MANIFEST_COLLECTIONS = ("participants", "visits", "clinical_notes")
+COUNT_KEYS = (
+    "participants",
+    "visits",
+    "clinical_notes",
+    "visits_with_attachments",
+    "attachments",
+    "ct_attachments",
+)
+UNHASHED_FIELDS = {"_id", "content_hash"}
+
+
+def canonical_bson(doc: dict) -> bytes:
+    # Field order is part of the encoding; the server keeps it (only _id moves to the front).
+    return bson.encode({key: value for key, value in doc.items() if key not in UNHASHED_FIELDS})
+
+
+def content_hash(doc: dict) -> str:
+    return hashlib.sha256(canonical_bson(doc)).hexdigest()
+
+
+def append_string(raw: bytes, key: str, value: str) -> bytes:
+    # BSON is int32 length + elements + NUL, so one string element can be appended without re-encoding.
+    encoded = value.encode("utf-8") + b"\x00"
+    elements = raw[4:-1] + b"\x02" + key.encode("utf-8") + b"\x00" + struct.pack("<i", len(encoded)) + encoded
+    return struct.pack("<i", len(elements) + 5) + elements + b"\x00"
+
+
+def encode_document(doc: dict) -> RawBSONDocument:
+    # The single encoding of a generated document: hashed, stamped with content_hash, then
+    # inserted and dumped as is.
+    raw = canonical_bson(doc)
+    digest = hashlib.sha256(raw).hexdigest()
+    return RawBSONDocument(append_string(raw, "content_hash", digest))
+
+
+def document_digest(doc: dict) -> bytes:
+    # Seeded documents carry their content_hash; anything else is hashed on the spot.
+    return bytes.fromhex(doc.get("content_hash") or content_hash(doc))
+
+
+class ManifestBuilder:
+    # Document content hashes are fed one at a time in canonical order (participant
+    # index, then visit_no, then note_no). Each block of `block_participants` participants
+    # gets its own sha256 per collection, and block digests are folded into the collection
+    # digest in order, so shards seeded by different workers combine to the same result.
+    def __init__(self, block_participants: int) -> None:
+        self.block_participants = block_participants
+        self.counts = {key: 0 for key in COUNT_KEYS}
+        self.collection_hashes = {name: hashlib.sha256() for name in MANIFEST_COLLECTIONS}
+        self.blocks: dict[str, list[str]] = {name: [] for name in MANIFEST_COLLECTIONS}
+        self._block_hashes = {name: hashlib.sha256() for name in MANIFEST_COLLECTIONS}
+        self._block_fill = 0
+
+    def add(self, participant: dict, visits: list[dict], notes: list[dict]) -> None:
+        self._block_hashes["participants"].update(document_digest(participant))
+        for visit in visits:
+            self._block_hashes["visits"].update(document_digest(visit))
+            attachments = visit.get("attachments") or []
+            if attachments:
+                self.counts["visits_with_attachments"] += 1
+                self.counts["attachments"] += len(attachments)
+                self.counts["ct_attachments"] += sum(1 for a in attachments if a.get("modality") == "CT")
+        for note in notes:
+            self._block_hashes["clinical_notes"].update(document_digest(note))
+
+        self.counts["participants"] += 1
+        self.counts["visits"] += len(visits)
+        self.counts["clinical_notes"] += len(notes)
+        self._block_fill += 1
+        if self._block_fill == self.block_participants:
+            self.finish_block()
+
+    def finish_block(self) -> None:
+        if not self._block_fill:
+            return
+        for name in MANIFEST_COLLECTIONS:
+            block_digest = self._block_hashes[name].hexdigest()
+            self.blocks[name].append(block_digest)
+            self.collection_hashes[name].update(bytes.fromhex(block_digest))
+            self._block_hashes[name] = hashlib.sha256()
+        self._block_fill = 0
+
+    def state(self) -> dict:
+        self.finish_block()
+        return {"counts": dict(self.counts), "blocks": {name: list(d) for name, d in self.blocks.items()}}
+
+    def merge(self, state: dict) -> None:
+        self.finish_block()
+        for key in COUNT_KEYS:
+            self.counts[key] += state["counts"][key]
+        for name in MANIFEST_COLLECTIONS:
+            for block_digest in state["blocks"][name]:
+                self.blocks[name].append(block_digest)
+                self.collection_hashes[name].update(bytes.fromhex(block_digest))
+
+    def build(self, db_name: str) -> dict:
+        self.finish_block()
+        collection_digests = {name: self.collection_hashes[name].hexdigest() for name in MANIFEST_COLLECTIONS}
+        overall = hashlib.sha256()
+        for name in MANIFEST_COLLECTIONS:
+            overall.update(f"{name}:{collection_digests[name]}\n".encode("utf-8"))
+        return {
+            "db": db_name,
+            "generated_at_utc": datetime.now(timezone.utc).isoformat(),
+            "counts": dict(self.counts),
+            "digest": {
+                "algorithm": "sha256",
+                "block_participants": self.block_participants,
+                "collections": collection_digests,
+            },
+            "sha256": overall.hexdigest(),
+        }
+
+
+def current_generation() -> int:
+    if not MANIFEST_PATH.exists():
+        return 0
+    return json.loads(MANIFEST_PATH.read_text(encoding="utf-8")).get("generation", 0)
+
+
+def write_manifest(manifest: dict) -> None:
+    # generation counts every data change recorded here, so readers (the query cache) can tell
+    # two writes apart even when the dataset sha256 comes out the same.
+    manifest["generation"] = current_generation() + 1
+    MANIFEST_PATH.parent.mkdir(parents=True, exist_ok=True)
+    MANIFEST_PATH.write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+
+
+def bump_generation() -> None:
+    # For writes outside seeding (snapshot propagation, rollups, visit layouts): the documents
+    # no longer match the sha256, but cached query results must be invalidated all the same.
+    if MANIFEST_PATH.exists():
+        write_manifest(load_manifest())
+
+
+def load_manifest() -> dict:
+    if not MANIFEST_PATH.exists():
+        raise FileNotFoundError(f"manifest not found at {MANIFEST_PATH}; run seed_data.py first")
+    return json.loads(MANIFEST_PATH.read_text(encoding="utf-8"))
@@ -0,0 +1,223 @@
+from __future__ import annotations
+
+import argparse
+import base64
+import binascii
+
+import bson
+from bson.errors import InvalidBSON
+from bson.json_util import dumps
+
+from bench_queries import time_calls
+from common import get_db, get_settings
+from queries import explain_query, run_query, summarize_explain
+
+TOKEN_VERSION = 2
+# Each listing walks one existing compound index in index order: `equality` pins the index prefix
+# and `keys` is the rest of it, so any page is a single index seek instead of a skip over earlier pages.
+# `keys` must be unique, so listings over non-unique dates end with _id, which their indexes also carry.
+PAGED_LISTINGS = {
+    "visits": {
+        "title": "Visits by participant and visit number",
+        "collection": "visits",
+        "index": "uid_participant_visit",
+        "equality": (),
+        "keys": [("participant_id", 1), ("visit_no", 1)],
+        "projection": {"_id": 0, "visit_id": 1, "participant_id": 1, "visit_no": 1, "visit_date": 1, "site_id": 1},
+    },
+    "site_visits": {
+        "title": "Visits at one site, newest first",
+        "collection": "visits",
+        "index": "idx_visit_site_date",
+        "equality": ("site_id",),
+        "keys": [("visit_date", -1), ("_id", 1)],
+        "projection": {"visit_id": 1, "participant_id": 1, "site_id": 1, "visit_no": 1, "visit_date": 1},
+    },
+    "participant_notes": {
+        "title": "Notes for one participant, newest first",
+        "collection": "clinical_notes",
+        "index": "idx_note_participant_created",
+        "equality": ("participant_id",),
+        "keys": [("created_at", -1), ("_id", 1)],
+        "projection": {"note_id": 1, "participant_id": 1, "visit_id": 1, "note_type": 1, "created_at": 1},
+    },
+}
+DEFAULT_PARAMS = {"site_id": "SITE-03", "participant_id": "SYN-P-0001"}
+
+
+def listing_params(name: str, params: dict) -> dict:
+    if name not in PAGED_LISTINGS:
+        raise ValueError(f"unknown listing {name!r}; choose from {sorted(PAGED_LISTINGS)}")
+    fields = PAGED_LISTINGS[name]["equality"]
+    missing = [field for field in fields if params.get(field) is None]
+    if missing:
+        raise ValueError(f"listing {name!r} needs {', '.join(missing)}")
+    return {field: params[field] for field in fields}
+
+
+def encode_token(name: str, params: dict, last: list) -> str:
+    state = {"v": TOKEN_VERSION, "listing": name, "params": params, "last": last}
+    return base64.urlsafe_b64encode(bson.encode(state)).rstrip(b"=").decode("ascii")
+
+
+def decode_token(token: str, name: str, params: dict) -> dict:
+    try:
+        state = bson.decode(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except (binascii.Error, InvalidBSON, ValueError) as exc:
+        raise ValueError(f"malformed page token: {exc}") from exc
+    if state.get("v") != TOKEN_VERSION or state.get("listing") != name or state.get("params") != params:
+        raise ValueError(f"page token does not belong to listing {name!r} with {params}")
+    last = state.get("last")
+    if not isinstance(last, list) or len(last) != len(PAGED_LISTINGS[name]["keys"]):
+        raise ValueError("malformed page token")
+    # Token values go straight into the filter, so only plain values are accepted, never operator documents.
+    if any(isinstance(value, (dict, list)) for value in last):
+        raise ValueError("malformed page token")
+    return state
+
+
+def seek_filter(listing: dict, last: list) -> dict:
+    # Everything strictly after `last` in key order; the keys are unique, so nothing is tied with it.
+    keys = listing["keys"]
+    branches = []
+    for position, (field, direction) in enumerate(keys):
+        branch = {key: {"$eq": value} for (key, _), value in zip(keys[:position], last)}
+        branch[field] = {"$gt" if direction == 1 else "$lt": last[position]}
+        branches.append(branch)
+    # The range on the leading key is the index start bound; the $or only trims the tied prefix.
+    leading, direction = keys[0]
+    return {leading: {"$gte" if direction == 1 else "$lte": last[0]}, "$or": branches}
+
+
+def page_spec(name: str, params: dict, page_size: int, state: dict | None = None, skip: int = 0) -> dict:
+    listing = PAGED_LISTINGS[name]
+    query = dict(params)
+    if state is not None:
+        query.update(seek_filter(listing, state["last"]))
+    spec = {
+        "title": listing["title"],
+        "collection": listing["collection"],
+        "filter": query,
+        "projection": listing["projection"],
+        "sort": listing["keys"],
+        "hint": listing["index"],
+        # One extra document tells whether another page follows.
+        "limit": page_size + 1,
+    }
+    if skip:
+        spec["skip"] = skip
+    return spec
+
+
+def fetch_page(
+    db, name: str, params: dict, page_size: int = 20, token: str | None = None
+) -> tuple[list[dict], str | None]:
+    if page_size <= 0:
+        raise ValueError("page-size must be > 0")
+    listing = PAGED_LISTINGS[name]
+    params = listing_params(name, params)
+    state = decode_token(token, name, params) if token else None
+    docs = list(run_query(db, page_spec(name, params, page_size, state)))
+    items, next_token = docs[:page_size], None
+    if len(docs) > page_size:
+        next_token = encode_token(name, params, [items[-1][field] for field, _ in listing["keys"]])
+    if ("_id", 1) in listing["keys"]:
+        # _id is only fetched as the tie-breaker for the token.
+        for doc in items:
+            del doc["_id"]
+    return items, next_token
+
+
+def iter_pages(db, name: str, params: dict, page_size: int = 20, max_pages: int | None = None):
+    token, pages = None, 0
+    while max_pages is None or pages < max_pages:
+        items, token = fetch_page(db, name, params, page_size, token)
+        pages += 1
+        yield items, token
+        if token is None:
+            return
+
+
+def bench_listing(db, name: str, params: dict, page_size: int, depths: list[int], iterations: int) -> list[dict]:
+    params = listing_params(name, params)
+    # Walk once to collect the token that starts each requested page.
+    tokens, page = {1: None}, 1
+    for _, token in iter_pages(db, name, params, page_size, max(depths) - 1):
+        if token is None:
+            break
+        page += 1
+        tokens[page] = token
+    rows = []
+    for depth in depths:
+        if depth not in tokens:
+            print(f"{name}: only {page} pages of {page_size}, skipping page {depth}")
+            continue
+        state = decode_token(tokens[depth], name, params) if tokens[depth] else None
+        specs = {
+            "skip": page_spec(name, params, page_size, skip=(depth - 1) * page_size),
+            "keyset": page_spec(name, params, page_size, state),
+        }
+        for method, spec in specs.items():
+            explain = summarize_explain(explain_query(db, spec))
+            rows.append(
+                {
+                    "listing": name,
+                    "page": depth,
+                    "method": method,
+                    "latency_ms": time_calls(lambda spec=spec: list(run_query(db, spec)), iterations),
+                    "keys_examined": explain["keys_examined"],
+                    "docs_examined": explain["docs_examined"],
+                }
+            )
+    return rows
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Keyset pagination over the visit and note indexes.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    page = subparsers.add_parser("page", help="Fetch one page and print the token for the next one.")
+    page.add_argument("listing", choices=sorted(PAGED_LISTINGS))
+    page.add_argument("--token", help="Resume token printed by the previous page.")
+    bench = subparsers.add_parser("bench", help="Compare skip/limit with keyset pages at increasing depth.")
+    bench.add_argument("--listings", default="visits,site_visits", help="Comma-separated listings.")
+    bench.add_argument("--depths", default="1,10,100,1000", help="Comma-separated page numbers to time.")
+    bench.add_argument("--iterations", type=int, default=20)
+    for sub in (page, bench):
+        sub.add_argument("--page-size", type=int, default=20)
+        sub.add_argument("--site", default=DEFAULT_PARAMS["site_id"])
+        sub.add_argument("--participant", default=DEFAULT_PARAMS["participant_id"])
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    if args.page_size <= 0:
+        raise ValueError("page-size must be > 0")
+    params = {"site_id": args.site, "participant_id": args.participant}
+    settings = get_settings()
+    db, client = get_db(settings)
+
+    if args.command == "page":
+        items, token = fetch_page(db, args.listing, params, args.page_size, args.token)
+        print(f"=== {PAGED_LISTINGS[args.listing]['title']} ({len(items)} docs) ===")
+        for doc in items:
+            print(dumps(doc, ensure_ascii=False))
+        print(f"next: {token or '-'}")
+    else:
+        depths = sorted({int(value) for value in args.depths.split(",") if value.strip()})
+        if not depths or depths[0] <= 0 or args.iterations <= 0:
+            raise ValueError("depths and iterations must be > 0")
+        print(f"{'listing':<18} {'page':>6} {'method':<7} {'p50':>9} {'p95':>9} {'keysExam':>10} {'docsExam':>10}")
+        for name in [value.strip() for value in args.listings.split(",") if value.strip()]:
+            for row in bench_listing(db, name, params, args.page_size, depths, args.iterations):
+                latency = row["latency_ms"]
+                print(
+                    f"{name:<18} {row['page']:>6} {row['method']:<7} {latency['p50']:>9.3f} {latency['p95']:>9.3f} "
+                    f"{row['keys_examined']:>10} {row['docs_examined']:>10}"
+                )
+
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,545 @@
+from __future__ import annotations
+
+import argparse
+
+CT_ATTACHMENTS = {
+    "$addFields": {
+        "ct_attachments": {
+            "$filter": {
+                "input": "$attachments",
+                "as": "attachment",
+                "cond": {"$eq": ["$$attachment.modality", "CT"]},
+            }
+        }
+    }
+}
+CT_PROJECTION = {
+    "$project": {
+        "_id": 0,
+        "visit_id": 1,
+        "participant_id": 1,
+        "site_id": 1,
+        "ct_count": {"$size": "$ct_attachments"},
+        "ct_uris": "$ct_attachments.storage_uri",
+    }
+}
+QUERY_SPECS = {
+    "Q1": {
+        "title": "Q1 structured filter participants",
+        "collection": "participants",
+        "filter": {"arm": "drug_a", "site_id": "SITE-03", "age": {"$gte": 40, "$lte": 65}},
+        "projection": {"_id": 0, "participant_id": 1, "age": 1, "arm": 1, "site_id": 1},
+        "sort": [("age", 1)],
+    },
+    "Q2": {
+        "title": "Q2 completion rate by arm",
+        "collection": "participants",
+        "pipeline": [
+            {
+                "$group": {
+                    "_id": "$arm",
+                    "total": {"$sum": 1},
+                    "completed": {"$sum": {"$cond": [{"$eq": ["$status", "completed"]}, 1, 0]}},
+                }
+            },
+            {
+                "$project": {
+                    "_id": 0,
+                    "arm": "$_id",
+                    "total": 1,
+                    "completed": 1,
+                    "completion_rate": {"$round": [{"$divide": ["$completed", "$total"]}, 3]},
+                }
+            },
+            {"$sort": {"arm": 1}},
+        ],
+    },
+    "Q2r": {
+        "title": "Q2r completion rate by arm (rollup)",
+        "collection": "rollup_completion_by_arm",
+        "pipeline": [
+            {
+                "$project": {
+                    "_id": 0,
+                    "arm": 1,
+                    "total": 1,
+                    "completed": 1,
+                    "completion_rate": {"$round": [{"$divide": ["$completed", "$total"]}, 3]},
+                }
+            },
+            {"$sort": {"arm": 1}},
+        ],
+    },
+    "Q3": {
+        "title": "Q3 symptom trend by arm",
+        "collection": "visits",
+        "pipeline": [
+            {
+                "$lookup": {
+                    "from": "participants",
+                    "localField": "participant_id",
+                    "foreignField": "participant_id",
+                    "as": "p",
+                }
+            },
+            {"$unwind": "$p"},
+            {
+                "$group": {
+                    "_id": {"arm": "$p.arm", "visit_no": "$visit_no"},
+                    "avg_symptom_score": {"$avg": "$symptom_score"},
+                    "n": {"$sum": 1},
+                }
+            },
+            {
+                "$project": {
+                    "_id": 0,
+                    "arm": "$_id.arm",
+                    "visit_no": "$_id.visit_no",
+                    "avg_symptom_score": {"$round": ["$avg_symptom_score", 2]},
+                    "n": 1,
+                }
+            },
+            {"$sort": {"arm": 1, "visit_no": 1}},
+        ],
+    },
+    "Q3b": {
+        "title": "Q3b symptom trend by arm (visit buckets)",
+        "collection": "visit_buckets",
+        "pipeline": [
+            # One join per bucket of up to 12 visits instead of one per visit.
+            {
+                "$lookup": {
+                    "from": "participants",
+                    "localField": "participant_id",
+                    "foreignField": "participant_id",
+                    "as": "p",
+                }
+            },
+            {"$unwind": "$p"},
+            {"$unwind": "$measurements"},
+            {
+                "$group": {
+                    "_id": {"arm": "$p.arm", "visit_no": "$measurements.visit_no"},
+                    "avg_symptom_score": {"$avg": "$measurements.symptom_score"},
+                    "n": {"$sum": 1},
+                }
+            },
+            {
+                "$project": {
+                    "_id": 0,
+                    "arm": "$_id.arm",
+                    "visit_no": "$_id.visit_no",
+                    "avg_symptom_score": {"$round": ["$avg_symptom_score", 2]},
+                    "n": 1,
+                }
+            },
+            {"$sort": {"arm": 1, "visit_no": 1}},
+        ],
+    },
+    "Q3t": {
+        "title": "Q3t symptom trend by arm (time-series visits)",
+        "collection": "visit_series",
+        "pipeline": [
+            {
+                "$lookup": {
+                    "from": "participants",
+                    "localField": "meta.participant_id",
+                    "foreignField": "participant_id",
+                    "as": "p",
+                }
+            },
+            {"$unwind": "$p"},
+            {
+                "$group": {
+                    "_id": {"arm": "$p.arm", "visit_no": "$visit_no"},
+                    "avg_symptom_score": {"$avg": "$symptom_score"},
+                    "n": {"$sum": 1},
+                }
+            },
+            {
+                "$project": {
+                    "_id": 0,
+                    "arm": "$_id.arm",
+                    "visit_no": "$_id.visit_no",
+                    "avg_symptom_score": {"$round": ["$avg_symptom_score", 2]},
+                    "n": 1,
+                }
+            },
+            {"$sort": {"arm": 1, "visit_no": 1}},
+        ],
+    },
+    "Q3d": {
+        "title": "Q3d symptom trend by arm (denormalized)",
+        "collection": "visits",
+        "pipeline": [
+            # Sorting on the idx_visit_arm_visitno_score prefix lets the group read only index keys.
+            {"$sort": {"participant.arm": 1, "visit_no": 1}},
+            {
+                "$group": {
+                    "_id": {"arm": "$participant.arm", "visit_no": "$visit_no"},
+                    "avg_symptom_score": {"$avg": "$symptom_score"},
+                    "n": {"$sum": 1},
+                }
+            },
+            {
+                "$project": {
+                    "_id": 0,
+                    "arm": "$_id.arm",
+                    "visit_no": "$_id.visit_no",
+                    "avg_symptom_score": {"$round": ["$avg_symptom_score", 2]},
+                    "n": 1,
+                }
+            },
+            {"$sort": {"arm": 1, "visit_no": 1}},
+        ],
+    },
+    "Q3r": {
+        "title": "Q3r symptom trend by arm (rollup)",
+        "collection": "rollup_symptom_by_arm_visit",
+        "pipeline": [
+            {
+                "$project": {
+                    "_id": 0,
+                    "arm": 1,
+                    "visit_no": 1,
+                    "avg_symptom_score": {"$round": [{"$divide": ["$symptom_sum", "$n"]}, 2]},
+                    "n": 1,
+                }
+            },
+            {"$sort": {"arm": 1, "visit_no": 1}},
+        ],
+    },
+    "Q4": {
+        "title": "Q4 text search notes",
+        "collection": "clinical_notes",
+        "filter": {"$text": {"$search": "fatigue nausea"}},
+        "projection": {
+            "_id": 0,
+            "participant_id": 1,
+            "visit_id": 1,
+            "note_text": 1,
+            "score": {"$meta": "textScore"},
+        },
+        "sort": [("score", {"$meta": "textScore"})],
+        "limit": 10,
+    },
+    "Q7": {
+        "title": "Q7 newest notes tagged fatigue or nausea (tags index)",
+        "collection": "clinical_notes",
+        # Matches the same notes as Q4 (symptom words only reach note_text through the tagged symptoms),
+        # but returns the newest ten instead of the ten best by text score, so it is not a Q4 variant.
+        "filter": {"tags": {"$in": ["fatigue", "nausea"]}},
+        "projection": {"_id": 0, "participant_id": 1, "visit_id": 1, "note_text": 1, "tags": 1},
+        "sort": [("created_at", -1)],
+        "limit": 10,
+    },
+    "Q5": {
+        "title": "Q5 hybrid text + structured filter",
+        "collection": "clinical_notes",
+        "pipeline": [
+            {"$match": {"$text": {"$search": "\"chest discomfort\" fatigue"}}},
+            {
+                "$lookup": {
+                    "from": "participants",
+                    "localField": "participant_id",
+                    "foreignField": "participant_id",
+                    "as": "p",
+                }
+            },
+            {"$unwind": "$p"},
+            {"$match": {"p.arm": "drug_a", "p.age": {"$gte": 50}}},
+            {
+                "$group": {
+                    "_id": "$p.site_id",
+                    "note_hits": {"$sum": 1},
+                    "participants": {"$addToSet": "$participant_id"},
+                }
+            },
+            {
+                "$project": {
+                    "_id": 0,
+                    "site_id": "$_id",
+                    "note_hits": 1,
+                    "unique_participants": {"$size": "$participants"},
+                }
+            },
+            {"$sort": {"note_hits": -1}},
+        ],
+    },
+    "Q5d": {
+        "title": "Q5d hybrid text + structured filter (denormalized)",
+        "collection": "clinical_notes",
+        "pipeline": [
+            {
+                "$match": {
+                    "$text": {"$search": "\"chest discomfort\" fatigue"},
+                    "participant.arm": "drug_a",
+                    "participant.age": {"$gte": 50},
+                }
+            },
+            {
+                "$group": {
+                    "_id": "$site_id",
+                    "note_hits": {"$sum": 1},
+                    "participants": {"$addToSet": "$participant_id"},
+                }
+            },
+            {
+                "$project": {
+                    "_id": 0,
+                    "site_id": "$_id",
+                    "note_hits": 1,
+                    "unique_participants": {"$size": "$participants"},
+                }
+            },
+            {"$sort": {"note_hits": -1}},
+        ],
+    },
+    "Q5k": {
+        "title": "Q5k hybrid keyword + structured filter (tags index)",
+        "collection": "clinical_notes",
+        "pipeline": [
+            # A $text search with a phrase only matches notes containing the phrase.
+            {"$match": {"tags": "chest discomfort"}},
+            {
+                "$lookup": {
+                    "from": "participants",
+                    "localField": "participant_id",
+                    "foreignField": "participant_id",
+                    "as": "p",
+                }
+            },
+            {"$unwind": "$p"},
+            {"$match": {"p.arm": "drug_a", "p.age": {"$gte": 50}}},
+            {
+                "$group": {
+                    "_id": "$p.site_id",
+                    "note_hits": {"$sum": 1},
+                    "participants": {"$addToSet": "$participant_id"},
+                }
+            },
+            {
+                "$project": {
+                    "_id": 0,
+                    "site_id": "$_id",
+                    "note_hits": 1,
+                    "unique_participants": {"$size": "$participants"},
+                }
+            },
+            {"$sort": {"note_hits": -1}},
+        ],
+    },
+    "Q6": {
+        "title": "Q6 visits with CT attachment links",
+        "collection": "visits",
+        # The leading $match runs on idx_visit_attachment_modality, so only CT visits are fetched
+        # and the $filter below touches just the 10 that survive the $limit.
+        "pipeline": [
+            {"$match": {"attachments.modality": "CT"}},
+            {"$sort": {"visit_id": 1}},
+            {"$limit": 10},
+            CT_ATTACHMENTS,
+            CT_PROJECTION,
+        ],
+    },
+    "Q6s": {
+        "title": "Q6s visits with CT attachment links ($filter before $match, full scan)",
+        "collection": "visits",
+        "pipeline": [
+            CT_ATTACHMENTS,
+            {"$match": {"ct_attachments.0": {"$exists": True}}},
+            CT_PROJECTION,
+            {"$sort": {"visit_id": 1}},
+            {"$limit": 10},
+        ],
+    },
+    "Q6c": {
+        "title": "Q6c CT imaging volume by site",
+        "collection": "visits",
+        # Reads only attachment_counts.CT and site_id, both keys of the partial idx_visit_ct_counts: no FETCH.
+        "pipeline": [
+            {"$match": {"attachment_counts.CT": {"$gte": 1}}},
+            {"$group": {"_id": "$site_id", "ct_visits": {"$sum": 1}, "ct_images": {"$sum": "$attachment_counts.CT"}}},
+            {"$project": {"_id": 0, "site_id": "$_id", "ct_visits": 1, "ct_images": 1}},
+            {"$sort": {"site_id": 1}},
+        ],
+    },
+}
+DEMO_QUERIES = ["Q1", "Q2", "Q3", "Q4", "Q5", "Q6"]
+# Alternative physical designs for the demo queries, in order of preference.
+QUERY_VARIANTS = {
+    "rollups": {"Q2": "Q2r", "Q3": "Q3r"},
+    "buckets": {"Q3": "Q3b"},
+    "timeseries": {"Q3": "Q3t"},
+    "denormalized": {"Q3": "Q3d", "Q5": "Q5d"},
+    "keywords": {"Q5": "Q5k"},
+}
+# Visit layouts answer Q3 on their own while they are current (see current_layout); their flags only insist on it.
+LAYOUT_VARIANTS = ("buckets", "timeseries")
+# One document in this collection records which layout was built and from how many visits (visit_layout.py).
+VISIT_LAYOUT_STATE = "visit_layout_state"
+VARIANT_HELP = {
+    "rollups": "Answer Q2/Q3 from the materialized rollups (Q2r/Q3r); run scripts/rollups.py refresh first.",
+    "buckets": "Require Q3 from the visit buckets (Q3b); Q3 uses them anyway while --visit-layout buckets is current.",
+    "timeseries": "Require Q3 from the visit time-series (Q3t); Q3 uses it anyway while that layout is current.",
+    "denormalized": "Run the join-free Q3d/Q5d variants (needs the participant snapshot on visits and notes).",
+    "keywords": "Answer Q5 from the tags index instead of $text (Q5k).",
+}
+
+
+def add_variant_arguments(parser: argparse.ArgumentParser) -> None:
+    for variant, help_text in VARIANT_HELP.items():
+        parser.add_argument(f"--{variant}", action="store_true", help=help_text)
+
+
+def selected_variants(args: argparse.Namespace) -> set[str]:
+    return {variant for variant in QUERY_VARIANTS if getattr(args, variant)}
+
+
+def layout_from_state(state: dict | None, visit_count: int, collection_names: list[str]) -> str:
+    # A layout answers Q3 only while it was built from the visits now stored. Every script that writes
+    # visits rebuilds it and records the visit count; a count that moved since, or a dropped layout
+    # collection, means Q3 falls back to visits.
+    if state is None or state["visits"] != visit_count:
+        return "documents"
+    if QUERY_SPECS[QUERY_VARIANTS[state["layout"]]["Q3"]]["collection"] not in collection_names:
+        return "documents"
+    return state["layout"]
+
+
+def current_layout(db) -> str:
+    state = db[VISIT_LAYOUT_STATE].find_one({"_id": "visits"})
+    return layout_from_state(state, db.visits.estimated_document_count(), db.list_collection_names())
+
+
+def route_variants(variants: set[str], layout: str) -> set[str]:
+    # Adds the current visit layout, unless another Q3 variant was asked for.
+    wanted = variants & set(LAYOUT_VARIANTS)
+    if len(wanted) > 1:
+        raise ValueError("choose at most one of --buckets and --timeseries")
+    if wanted and wanted != {layout}:
+        raise ValueError(f"--{wanted.pop()} needs that visit layout built and current; current layout is {layout!r}")
+    if layout in LAYOUT_VARIANTS and not any("Q3" in QUERY_VARIANTS[variant] for variant in variants):
+        return variants | {layout}
+    return variants
+
+
+def resolve_queries(names: list[str], variants: set[str]) -> list[str]:
+    resolved = []
+    for name in names:
+        for variant, replacements in QUERY_VARIANTS.items():
+            if variant in variants and name in replacements:
+                name = replacements[name]
+                break
+        resolved.append(name)
+    return resolved
+
+
+def run_query(db, spec: dict, batch_size: int = 0):
+    collection = db[spec["collection"]]
+    if "pipeline" in spec:
+        return collection.aggregate(spec["pipeline"], **({"batchSize": batch_size} if batch_size else {}))
+    cursor = collection.find(spec["filter"], spec.get("projection"))
+    if "hint" in spec:
+        cursor = cursor.hint(spec["hint"])
+    if "sort" in spec:
+        cursor = cursor.sort(spec["sort"])
+    if "skip" in spec:
+        cursor = cursor.skip(spec["skip"])
+    if "limit" in spec:
+        cursor = cursor.limit(spec["limit"])
+    if batch_size:
+        cursor = cursor.batch_size(batch_size)
+    return cursor
+
+
+def preview_query(db, spec: dict, preview: int = 5, batch_size: int = 0) -> tuple[list[dict], int]:
+    # Only the preview crosses the wire; the total is counted on the server, so client
+    # memory stays flat however large the full result is.
+    collection = db[spec["collection"]]
+    if "pipeline" in spec:
+        facet = {"$facet": {"preview": [{"$limit": preview}], "count": [{"$count": "n"}]}}
+        options = {"batchSize": batch_size} if batch_size else {}
+        result = next(collection.aggregate([*spec["pipeline"], facet], **options))
+        return result["preview"], result["count"][0]["n"] if result["count"] else 0
+    limit = min(preview, spec["limit"]) if "limit" in spec else preview
+    cursor = collection.find(spec["filter"], spec.get("projection"), limit=limit, batch_size=batch_size or limit)
+    if "sort" in spec:
+        cursor = cursor.sort(spec["sort"])
+    count_options = {"limit": spec["limit"]} if "limit" in spec else {}
+    return list(cursor), collection.count_documents(spec["filter"], **count_options)
+
+
+def query_command(spec: dict) -> dict:
+    if "pipeline" in spec:
+        return {"aggregate": spec["collection"], "pipeline": spec["pipeline"], "cursor": {}}
+    command = {"find": spec["collection"], "filter": spec["filter"]}
+    if "projection" in spec:
+        command["projection"] = spec["projection"]
+    if "sort" in spec:
+        command["sort"] = dict(spec["sort"])
+    for option in ("skip", "limit", "hint"):
+        if option in spec:
+            command[option] = spec[option]
+    return command
+
+
+def explain_query(db, spec: dict, verbosity: str = "executionStats") -> dict:
+    return db.command("explain", query_command(spec), verbosity=verbosity)
+
+
+def _walk(node):
+    if isinstance(node, dict):
+        yield node
+        for value in node.values():
+            yield from _walk(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from _walk(value)
+
+
+def _stage_tree(stage: dict) -> str:
+    label = stage.get("stage", "?")
+    if stage.get("indexName"):
+        label += f"({stage['indexName']})"
+    children = list(stage.get("inputStages", []))
+    if "inputStage" in stage:
+        children.insert(0, stage["inputStage"])
+    if not children:
+        return label
+    return f"{label} > " + " + ".join(_stage_tree(child) for child in children)
+
+
+def summarize_explain(explain: dict) -> dict:
+    docs_examined = keys_examined = returned = 0
+    trees = []
+    stages = []
+    indexes = set()
+    for node in _walk(explain):
+        stats = node.get("executionStats")
+        if isinstance(stats, dict) and "totalDocsExamined" in stats:
+            docs_examined += stats["totalDocsExamined"]
+            keys_examined += stats["totalKeysExamined"]
+            returned += stats["nReturned"]
+        winning = node.get("winningPlan")
+        if isinstance(winning, dict):
+            # Slot-based engine plans nest the classic stage tree under queryPlan.
+            plan = winning.get("queryPlan", winning)
+            trees.append(_stage_tree(plan))
+            stages.extend(stage["stage"] for stage in _walk(plan) if isinstance(stage.get("stage"), str))
+            indexes.update(stage["indexName"] for stage in _walk(plan) if stage.get("indexName"))
+        # $lookup stages report the work done against the joined collection alongside the stage.
+        if "$lookup" in node and "totalDocsExamined" in node:
+            docs_examined += node["totalDocsExamined"]
+            keys_examined += node.get("totalKeysExamined", 0)
+            indexes.update(node.get("indexesUsed", []))
+    pipeline_stages = [next(iter(stage)) for stage in explain.get("stages", []) if isinstance(stage, dict)]
+    return {
+        "docs_examined": docs_examined,
+        "keys_examined": keys_examined,
+        "n_returned": returned,
+        "indexes_used": sorted(indexes),
+        "stage_tree": trees,
+        "plan_stages": stages,
+        "pipeline_stages": pipeline_stages,
+    }
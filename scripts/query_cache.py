@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+import argparse
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import bson
+from bson.json_util import CANONICAL_JSON_OPTIONS, dumps
+
+from common import PROJECT_ROOT
+from manifest import MANIFEST_PATH, load_manifest
+from queries import preview_query, query_command
+
+CACHE_PATH = PROJECT_ROOT / "data" / "generated" / "query_cache.bson"
+CACHE_MODES = ("off", "memory", "disk")
+# Keys are sorted in query maps (find filters, $match stages and find projections) and in the operator maps
+# under them ({"$gte": 1, "$lte": 9}), where order is irrelevant. Embedded documents used as values keep
+# their order, since {"a": {"x": 1, "y": 2}} and {"a": {"y": 2, "x": 1}} match different documents, and so
+# does everything else ($sort and $group order, $project output order).
+UNORDERED_KEYS = {"filter", "projection", "$match"}
+CLAUSE_KEYS = {"$and", "$or", "$nor"}
+
+
+def normalize_query(query: dict) -> dict:
+    return {key: normalize_condition(key, item) for key, item in sorted(query.items())}
+
+
+def normalize_condition(key: str, value):
+    if key in CLAUSE_KEYS and isinstance(value, list):
+        return [normalize_query(clause) if isinstance(clause, dict) else normalize(clause) for clause in value]
+    if key == "$elemMatch" and isinstance(value, dict):
+        return normalize_query(value)
+    if isinstance(value, dict) and value and all(name.startswith("$") for name in value):
+        return {name: normalize_condition(name, item) for name, item in sorted(value.items())}
+    return normalize(value)
+
+
+def normalize(value):
+    if isinstance(value, dict):
+        return {
+            key: normalize_query(item) if key in UNORDERED_KEYS and isinstance(item, dict) else normalize(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [normalize(item) for item in value]
+    return value
+
+
+def query_key(spec: dict, **params) -> str:
+    # Canonical extended JSON keeps types apart (1 vs 1.0, string vs ObjectId) in the hash.
+    material = {"command": normalize(query_command(spec)), "params": normalize(params)}
+    return hashlib.sha256(dumps(material, json_options=CANONICAL_JSON_OPTIONS).encode("utf-8")).hexdigest()
+
+
+def data_version() -> str | None:
+    # Results are valid for one dataset sha256 and one write generation (see manifest.write_manifest).
+    if not MANIFEST_PATH.exists():
+        return None
+    manifest = load_manifest()
+    return f"{manifest['sha256']}:{manifest.get('generation', 0)}"
+
+
+class QueryCache:
+    # LRU over encoded BSON results, bounded by entry count and total bytes, with a TTL per entry.
+    # Every lookup compares the manifest version (re-read only when manifest.json changes on disk),
+    # so a reseed or any other recorded write empties the cache.
+    def __init__(
+        self, max_entries: int = 256, max_bytes: int = 64 * 1024 * 1024, ttl: float = 3600, path: Path | None = None
+    ) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.path = path
+        self.entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self.bytes = 0
+        self.metrics = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+        self._manifest_mtime: int | None = -1
+        self._version: str | None = None
+        self.version = self._current_version()
+        if path is not None:
+            self.load()
+
+    def _current_version(self) -> str | None:
+        mtime = os.stat(MANIFEST_PATH).st_mtime_ns if MANIFEST_PATH.exists() else None
+        if mtime != self._manifest_mtime:
+            self._manifest_mtime = mtime
+            self._version = data_version()
+        return self._version
+
+    def _check_version(self) -> None:
+        version = self._current_version()
+        if version != self.version:
+            if self.entries:
+                self.metrics["invalidations"] += 1
+            self.clear()
+            self.version = version
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.bytes = 0
+
+    def get(self, key: str):
+        self._check_version()
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] < time.time():
+            self._remove(key)
+            self.metrics["expirations"] += 1
+            entry = None
+        if entry is None:
+            self.metrics["misses"] += 1
+            return None
+        self.metrics["hits"] += 1
+        self.entries.move_to_end(key)
+        return bson.decode(entry[1])["value"]
+
+    def put(self, key: str, value) -> None:
+        if self.version is None:
+            # Without a manifest there is nothing to invalidate against, so nothing is kept.
+            return
+        encoded = bson.encode({"value": value})
+        if len(encoded) > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (time.time() + self.ttl, encoded)
+        self.bytes += len(encoded)
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.metrics["evictions"] += 1
+
+    def _remove(self, key: str) -> None:
+        _, encoded = self.entries.pop(key)
+        self.bytes -= len(encoded)
+
+    def preview(self, db, spec: dict, preview: int = 5, batch_size: int = 0) -> tuple[list[dict], int, bool]:
+        # Two databases can share a manifest version, so the database name is part of the key.
+        key = query_key(spec, database=db.name, preview=preview)
+        cached = self.get(key)
+        if cached is not None:
+            return cached["preview"], cached["count"], True
+        docs, count = preview_query(db, spec, preview, batch_size)
+        self.put(key, {"preview": docs, "count": count})
+        return docs, count, False
+
+    def load(self) -> None:
+        if not self.path.exists():
+            return
+        stored = bson.decode(self.path.read_bytes())
+        if stored["version"] != self.version:
+            self.metrics["invalidations"] += 1
+            return
+        now = time.time()
+        for entry in stored["entries"]:
+            if entry["expires_at"] >= now:
+                self.entries[entry["key"]] = (entry["expires_at"], bytes(entry["value"]))
+                self.bytes += len(entry["value"])
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        self._check_version()
+        stored = {
+            "version": self.version,
+            "entries": [
+                {"key": key, "expires_at": expires_at, "value": encoded}
+                for key, (expires_at, encoded) in self.entries.items()
+            ],
+        }
+        # Written in LRU order and swapped in whole, so a reader never sees a partial file.
+        partial = self.path.with_suffix(".tmp")
+        partial.parent.mkdir(parents=True, exist_ok=True)
+        partial.write_bytes(bson.encode(stored))
+        partial.replace(self.path)
+
+    def summary(self) -> str:
+        counts = ", ".join(f"{name}={value}" for name, value in self.metrics.items())
+        lookups = self.metrics["hits"] + self.metrics["misses"]
+        hit_rate = self.metrics["hits"] / lookups if lookups else 0.0
+        return f"{counts}, hit_rate={hit_rate:.2f}, entries={len(self.entries)}, bytes={self.bytes}"
+
+
+def add_cache_arguments(parser: argparse.ArgumentParser, defaults: dict) -> None:
+    parser.add_argument(
+        "--cache",
+        choices=CACHE_MODES,
+        default=defaults["query_cache"],
+        help=f"Cache query results in memory, or also persist them to {CACHE_PATH.relative_to(PROJECT_ROOT)}.",
+    )
+    parser.add_argument("--cache-ttl", type=float, default=defaults["query_cache_ttl"], help="Seconds per entry.")
+    parser.add_argument("--cache-entries", type=int, default=256)
+    parser.add_argument("--cache-mb", type=float, default=64)
+
+
+def open_cache(args: argparse.Namespace) -> QueryCache | None:
+    if args.cache == "off":
+        return None
+    if args.cache_ttl <= 0 or args.cache_entries <= 0 or args.cache_mb <= 0:
+        raise ValueError("cache-ttl, cache-entries and cache-mb must be > 0")
+    return QueryCache(
+        max_entries=args.cache_entries,
+        max_bytes=int(args.cache_mb * 1024 * 1024),
+        ttl=args.cache_ttl,
+        path=CACHE_PATH if args.cache == "disk" else None,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Inspect or clear the on-disk query result cache.")
+    parser.add_argument("command", choices=["stats", "clear"])
+    args = parser.parse_args()
+
+    if args.command == "clear":
+        CACHE_PATH.unlink(missing_ok=True)
+        print(f"Removed {CACHE_PATH}")
+        return
+    cache = QueryCache(path=CACHE_PATH)
+    state = "current" if cache.metrics["invalidations"] == 0 else "stale (dataset changed since it was written)"
+    print(f"Query cache {CACHE_PATH}: {len(cache.entries)} live entries, {cache.bytes} bytes, {state}")
+    print(f"Data version: {cache.version or 'no manifest.json'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import argparse
+import sys
+import time
+
+from bson_dump import DUMP_DIR, iter_dump, load_dump_meta, validate_dump
+from common import BulkWriter, get_db, get_settings, parse_write_concern
+from create_indexes import build_indexes, print_index_timings
+from manifest import write_manifest
+from rollups import rebuild_rollups, rollups_enabled
+from seed_data import NATURAL_KEYS
+from visit_layout import apply_visit_layout, detect_layout
+
+
+def fail(message: str) -> None:
+    print(f"SNAPSHOT MISMATCH: {message}")
+    sys.exit(1)
+
+
+def restore(db, args: argparse.Namespace) -> dict:
+    for collection_name in NATURAL_KEYS:
+        db[collection_name].drop()
+    writer = BulkWriter(
+        db,
+        NATURAL_KEYS,
+        batch_docs=args.batch_size,
+        write_concern=parse_write_concern(args.write_w, False),
+        max_in_flight=args.max_in_flight,
+    )
+    with writer:
+        for collection_name in NATURAL_KEYS:
+            for doc in iter_dump(collection_name):
+                writer.add(collection_name, doc)
+    return writer.stats.summary()
+
+
+def parse_args() -> argparse.Namespace:
+    defaults = get_settings()
+    parser = argparse.ArgumentParser(description="Validate and restore the raw BSON snapshot in data/generated/bson/.")
+    parser.add_argument(
+        "command",
+        choices=["verify", "restore"],
+        help="verify: rehash the snapshot against its manifest; restore: verify, then replace the collections.",
+    )
+    parser.add_argument("--no-verify", action="store_true", help="Skip the sha256 check before restoring.")
+    parser.add_argument(
+        "--shallow",
+        action="store_true",
+        help="Only rebuild the digest from the stored content_hash values; skip rehashing document bodies.",
+    )
+    parser.add_argument("--no-indexes", action="store_true", help="Do not rebuild the indexes after restoring.")
+    parser.add_argument("--batch-size", type=int, default=defaults["batch_size"] or 5000)
+    parser.add_argument("--write-w", default=defaults["write_w"])
+    parser.add_argument("--max-in-flight", type=int, default=defaults["max_in_flight"])
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    meta = load_dump_meta()
+    if meta is None:
+        raise FileNotFoundError(f"no snapshot in {DUMP_DIR}; run seed_data.py --dump first")
+    manifest = meta["manifest"]
+
+    if args.command == "verify" or not args.no_verify:
+        started = time.perf_counter()
+        problems = validate_dump(meta, args.shallow)
+        if problems:
+            fail("; ".join(problems))
+        print(f"SNAPSHOT OK sha256={manifest['sha256']} ({time.perf_counter() - started:.2f}s)")
+    if args.command == "verify":
+        return
+
+    db, client = get_db(get_settings())
+    layout = detect_layout(db)
+    writes = restore(db, args)
+    write_manifest(manifest)
+    print(
+        f"Restored {writes['docs']} docs in {writes['seconds']}s "
+        f"({writes['docs_per_s']} docs/s, {writes['mb_per_s']} MB/s) from {DUMP_DIR}"
+    )
+    if not args.no_indexes:
+        started = time.perf_counter()
+        timings = build_indexes(db)
+        print(f"Indexes rebuilt in {time.perf_counter() - started:.2f}s:")
+        print_index_timings(timings)
+    # Derived collections are rebuilt from the restored visits, as after seeding.
+    apply_visit_layout(db, layout)
+    if rollups_enabled(db):
+        # Every participant was replaced, so there is nothing to diff against.
+        rebuild_rollups(db)
+        print("Rollups rebuilt")
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
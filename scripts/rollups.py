@@ -0,0 +1,218 @@
+from __future__ import annotations
+
+import argparse
+import sys
+
+from common import get_db, get_settings
+from manifest import bump_generation
+from queries import QUERY_SPECS, run_query
+
+LEDGER = "rollup_ledger"
+REFRESH_CHUNK = 1000
+
+
+def completion_stages(sign: int) -> list[dict]:
+    return [
+        {
+            "$group": {
+                "_id": "$arm",
+                "total": {"$sum": sign},
+                "completed": {"$sum": {"$multiply": ["$completed", sign]}},
+            }
+        },
+        {"$set": {"arm": "$_id"}},
+    ]
+
+
+def symptom_stages(sign: int) -> list[dict]:
+    return [
+        {"$unwind": "$visits"},
+        {
+            "$group": {
+                "_id": {"arm": "$arm", "visit_no": "$visits.visit_no"},
+                "symptom_sum": {"$sum": {"$multiply": ["$visits.symptom_score", sign]}},
+                "n": {"$sum": sign},
+            }
+        },
+        {"$set": {"arm": "$_id.arm", "visit_no": "$_id.visit_no"}},
+    ]
+
+
+# Each rollup holds running sums/counts per group so a participant's old contribution can be
+# subtracted and the new one added; averages and rates are derived at read time (Q2r/Q3r).
+ROLLUPS = {
+    "rollup_completion_by_arm": {"stages": completion_stages, "counters": ("total", "completed"), "count": "total"},
+    "rollup_symptom_by_arm_visit": {"stages": symptom_stages, "counters": ("symptom_sum", "n"), "count": "n"},
+}
+ROLLUP_CHECKS = {"Q2": "Q2r", "Q3": "Q3r"}
+
+
+def contribution_pipeline(participant_filter: dict) -> list[dict]:
+    # One ledger document per participant: exactly what that participant adds to the rollups.
+    return [
+        {"$match": participant_filter},
+        {
+            "$lookup": {
+                "from": "visits",
+                "localField": "participant_id",
+                "foreignField": "participant_id",
+                "as": "visits",
+            }
+        },
+        {
+            "$project": {
+                "_id": "$participant_id",
+                "arm": "$arm",
+                "completed": {"$cond": [{"$eq": ["$status", "completed"]}, 1, 0]},
+                "visits": {
+                    "$map": {
+                        "input": "$visits",
+                        "as": "visit",
+                        "in": {"visit_no": "$$visit.visit_no", "symptom_score": "$$visit.symptom_score"},
+                    }
+                },
+            }
+        },
+    ]
+
+
+def merge_stage(collection_name: str, counters: tuple[str, ...]) -> dict:
+    return {
+        "$merge": {
+            "into": collection_name,
+            "on": "_id",
+            "whenMatched": [{"$set": {field: {"$add": [f"${field}", f"$$new.{field}"]} for field in counters}}],
+            "whenNotMatched": "insert",
+        }
+    }
+
+
+def apply_ledger(db, ledger_filter: dict, sign: int) -> None:
+    for collection_name, spec in ROLLUPS.items():
+        pipeline = [{"$match": ledger_filter}, *spec["stages"](sign), merge_stage(collection_name, spec["counters"])]
+        db[LEDGER].aggregate(pipeline)
+
+
+def refresh_scope(db, ledger_filter: dict, participant_filter: dict) -> None:
+    apply_ledger(db, ledger_filter, -1)
+    db[LEDGER].delete_many(ledger_filter)
+    db.participants.aggregate(
+        [
+            *contribution_pipeline(participant_filter),
+            {"$merge": {"into": LEDGER, "on": "_id", "whenMatched": "replace", "whenNotMatched": "insert"}},
+        ]
+    )
+    apply_ledger(db, ledger_filter, 1)
+    for collection_name, spec in ROLLUPS.items():
+        db[collection_name].delete_many({spec["count"]: {"$lte": 0}})
+
+
+def stale_participants(db) -> list[str]:
+    # Full O(participants) diff against the ledger; only verify uses it, writers pass the IDs they touched.
+    changed = db.participants.aggregate(
+        [
+            *contribution_pipeline({}),
+            {"$lookup": {"from": LEDGER, "localField": "_id", "foreignField": "_id", "as": "counted"}},
+            {"$set": {"counted": {"$arrayElemAt": ["$counted", 0]}}},
+            {
+                "$match": {
+                    "$expr": {
+                        "$or": [
+                            {"$ne": ["$arm", "$counted.arm"]},
+                            {"$ne": ["$completed", "$counted.completed"]},
+                            # Visits come back in lookup order, so compare them as sets.
+                            {"$not": {"$setEquals": ["$visits", {"$ifNull": ["$counted.visits", []]}]}},
+                        ]
+                    }
+                }
+            },
+            {"$project": {"_id": 1}},
+        ]
+    )
+    removed = db[LEDGER].aggregate(
+        [
+            {"$lookup": {"from": "participants", "localField": "_id", "foreignField": "participant_id", "as": "p"}},
+            {"$match": {"p": {"$size": 0}}},
+            {"$project": {"_id": 1}},
+        ]
+    )
+    return [doc["_id"] for doc in changed] + [doc["_id"] for doc in removed]
+
+
+def refresh_rollups(db, participant_ids: list[str]) -> int:
+    for start in range(0, len(participant_ids), REFRESH_CHUNK):
+        chunk = participant_ids[start : start + REFRESH_CHUNK]
+        refresh_scope(db, {"_id": {"$in": chunk}}, {"participant_id": {"$in": chunk}})
+    return len(participant_ids)
+
+
+def rebuild_rollups(db) -> None:
+    for collection_name in (LEDGER, *ROLLUPS):
+        db[collection_name].drop()
+    refresh_scope(db, {}, {})
+
+
+def rollups_enabled(db) -> bool:
+    return LEDGER in db.list_collection_names()
+
+
+def verify_rollups(db) -> list[str]:
+    problems = []
+    for full_name, rollup_name in ROLLUP_CHECKS.items():
+        expected = list(run_query(db, QUERY_SPECS[full_name]))
+        actual = list(run_query(db, QUERY_SPECS[rollup_name]))
+        if expected != actual:
+            problems.append(f"{rollup_name} differs from {full_name}: expected {expected}, got {actual}")
+    stale = stale_participants(db)
+    if stale:
+        problems.append(f"{len(stale)} participants changed since the last refresh (e.g. {stale[:5]})")
+    return problems
+
+
+def fail(message: str) -> None:
+    print(f"ROLLUPS STALE: {message}")
+    sys.exit(1)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Maintain the materialized rollups behind Q2r/Q3r.")
+    parser.add_argument(
+        "command",
+        choices=["refresh", "rebuild", "verify"],
+        help="refresh: build the rollups if missing, else apply --participant-ids only; "
+        "rebuild: recompute from scratch; verify: compare rollups with the full aggregations.",
+    )
+    parser.add_argument("--participant-ids", help="Comma-separated participants to refresh.")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    settings = get_settings()
+    db, client = get_db(settings)
+
+    if args.command == "rebuild":
+        rebuild_rollups(db)
+        bump_generation()
+        print("Rollups rebuilt: " + ", ".join(f"{name}={db[name].count_documents({})}" for name in ROLLUPS))
+    elif args.command == "refresh" and not rollups_enabled(db):
+        rebuild_rollups(db)
+        bump_generation()
+        print("Rollups built: " + ", ".join(f"{name}={db[name].count_documents({})}" for name in ROLLUPS))
+    elif args.command == "refresh":
+        ids = [value.strip() for value in (args.participant_ids or "").split(",") if value.strip()]
+        refreshed = refresh_rollups(db, ids)
+        if refreshed:
+            bump_generation()
+        print(f"Rollups refreshed for {refreshed} participants")
+    else:
+        problems = verify_rollups(db)
+        if problems:
+            fail("; ".join(problems))
+        print("ROLLUPS OK")
+
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
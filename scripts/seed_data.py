@@ -3,11 +3,31 @@ from __future__ import annotations
 import argparse
 import hashlib
 import json
+import multiprocessing
 import random
+import time
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta, timezone
-from pathlib import Path
-
-from common import PROJECT_ROOT, get_db, get_settings
+from functools import partial
+from operator import itemgetter
+
+from bson_dump import clear_dump, dump_matches, dump_records, iter_dump, load_dump_meta, validate_dump, write_dump_meta
+from common import BulkWriter, BulkWriteStats, get_db, get_settings, parse_write_concern
+from create_indexes import build_indexes, drop_secondary_indexes, print_index_timings
+from denormalize import participant_snapshot
+from instrumentation import drain_metrics, merge_metrics
+from manifest import ManifestBuilder, content_hash, encode_document, write_manifest
+from rollups import rebuild_rollups, refresh_rollups, rollups_enabled
+from sharding import (
+    SHARD_FIELD,
+    SHARD_STRATEGIES,
+    SPREAD_BLOCK_PARTICIPANTS,
+    ShardRouter,
+    shard_collections,
+    spread_records,
+)
+from visit_layout import VISIT_LAYOUTS, apply_visit_layout
 
 SITES = [f"SITE-{i:02d}" for i in range(1, 6)]
 ARMS = ["drug_a", "drug_b", "placebo"]
@@ -47,6 +67,24 @@ NOTE_TEMPLATES = [
     "participant denies severe events, mentions {symptom_1} after activity and brief {symptom_2}.",
     "clinical impression: stable condition with low-grade {symptom_1} and episodic {symptom_2}.",
 ]
+REFERENCE_DATE = datetime(2026, 1, 1, tzinfo=timezone.utc)
+TRIAL_ID = "TRIAL-SYN-2026-001"
+DEFAULT_WRITE_BATCH_SIZE = 1000
+SYNC_BLOCK_PARTICIPANTS = 500
+GENERATORS = ("python", "numpy")
+# Upsert/delete keys: uid_participant_id, uid_participant_visit, and participant_id + note_id
+# for notes (served by the idx_note_participant_created prefix).
+NATURAL_KEYS = {
+    "participants": ("participant_id",),
+    "visits": ("participant_id", "visit_no"),
+    "clinical_notes": ("participant_id", "note_id"),
+}
+CHANGE_KINDS = ("inserted", "updated", "deleted", "unchanged")
+# Participants per numpy generator chunk. Each chunk has its own stream seeded from (seed, chunk number),
+# so the output depends only on --seed and never on --batch-size, --workers or --shard-size.
+VECTOR_CHUNK = 1000
+# Participants whose documents an incremental seed inserted, updated or deleted, for the rollup refresh.
+CHANGED_PARTICIPANTS = "changed_participants"
 
 
 def weighted_choice(rng: random.Random, values: list[str], weights: list[float]) -> str:
@@ -64,6 +102,25 @@ def bounded_int(value: float, low: int, high: int) -> int:
     return max(low, min(high, int(round(value))))
 
 
+def attachment_doc(
+    *, participant_id: str, site_id: str, visit_id: str, visit_date: datetime, attachment_no: int, modality: str
+) -> dict:
+    extension = ATTACHMENT_FILE_EXTENSIONS[modality]
+    storage_uri = (
+        f"placeholder://imaging/{site_id.lower()}/{participant_id.lower()}/"
+        f"{visit_id.lower()}/{modality.lower()}_{attachment_no:02d}.{extension}"
+    )
+    return {
+        "attachment_id": f"ATT-{visit_id}-{attachment_no:02d}",
+        "modality": modality,
+        "file_type": ATTACHMENT_FILE_TYPES[modality],
+        "storage_uri": storage_uri,
+        "description": f"Synthetic {modality} image placeholder",
+        "captured_at": visit_date + timedelta(hours=2 + attachment_no),
+        "synthetic_flag": True,
+    }
+
+
 def build_attachments(
     *,
     participant_id: str,
@@ -84,65 +141,417 @@ def build_attachments(
             modality = "CT"
         else:
             modality = weighted_choice(rng, ATTACHMENT_MODALITIES, ATTACHMENT_MODALITY_WEIGHTS)
-
-        extension = ATTACHMENT_FILE_EXTENSIONS[modality]
-        file_type = ATTACHMENT_FILE_TYPES[modality]
-        lower_site = site_id.lower()
-        lower_participant = participant_id.lower()
-        lower_visit = visit_id.lower()
-        storage_uri = (
-            f"placeholder://imaging/{lower_site}/{lower_participant}/"
-            f"{lower_visit}/{modality.lower()}_{attachment_no:02d}.{extension}"
-        )
-
         attachments.append(
-            {
-                "attachment_id": f"ATT-{visit_id}-{attachment_no:02d}",
-                "modality": modality,
-                "file_type": file_type,
-                "storage_uri": storage_uri,
-                "description": f"Synthetic {modality} image placeholder",
-                "captured_at": visit_date + timedelta(hours=2 + attachment_no),
-                "synthetic_flag": True,
-            }
+            attachment_doc(
+                participant_id=participant_id,
+                site_id=site_id,
+                visit_id=visit_id,
+                visit_date=visit_date,
+                attachment_no=attachment_no,
+                modality=modality,
+            )
         )
     return attachments
 
 
-def build_manifest(db_name: str, participants: list[dict], visits: list[dict], notes: list[dict]) -> dict:
-    visits_with_attachments = sum(1 for visit in visits if visit.get("attachments"))
-    total_attachments = sum(len(visit.get("attachments", [])) for visit in visits)
-    ct_attachments = sum(
-        1
-        for visit in visits
-        for attachment in visit.get("attachments", [])
-        if attachment.get("modality") == "CT"
-    )
-    serializable = {
-        "db": db_name,
-        "collections": {
-            "participants": participants,
-            "visits": visits,
-            "clinical_notes": notes,
-        },
-    }
-    payload = json.dumps(serializable, default=str, sort_keys=True, separators=(",", ":"))
-    digest = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+def attachment_counts(attachments: list[dict]) -> dict:
+    # Per-modality counts kept next to the array so CT queries can run on idx_visit_ct_counts alone.
+    return {modality: sum(item["modality"] == modality for item in attachments) for modality in ATTACHMENT_MODALITIES}
+
+
+def participant_id_for(index: int) -> str:
+    return f"SYN-P-{index:04d}"
+
+
+def range_split_points(participants: int, pieces: int) -> list[str]:
+    # Boundaries for a ranged participant_id key that cut the ids about to be seeded into equal runs.
+    # Chunks follow string order, where SYN-P-10000 sorts before SYN-P-1001, so the ids are sorted first.
+    ids = sorted(participant_id_for(index) for index in range(1, participants + 1))
+    return [ids[len(ids) * i // pieces] for i in range(1, pieces)]
+
+
+def visit_id_for(participant_id: str, visit_no: int) -> str:
+    return f"{participant_id}-V{visit_no:02d}"
+
+
+def note_doc(
+    participant: dict, visit: dict, note_no: int, symptoms: tuple[str, str], template: str, note_type: str, role: str
+) -> dict:
+    text = template.format(symptom_1=symptoms[0], symptom_2=symptoms[1])
     return {
-        "db": db_name,
-        "generated_at_utc": datetime.now(timezone.utc).isoformat(),
-        "counts": {
-            "participants": len(participants),
-            "visits": len(visits),
-            "clinical_notes": len(notes),
-            "visits_with_attachments": visits_with_attachments,
-            "attachments": total_attachments,
-            "ct_attachments": ct_attachments,
-        },
-        "sha256": digest,
+        "note_id": f"NOTE-{visit['visit_id']}-{note_no:02d}",
+        "participant_id": participant["participant_id"],
+        "visit_id": visit["visit_id"],
+        "site_id": participant["site_id"],
+        "note_type": note_type,
+        "author_role": role,
+        "note_text": f"Synthetic note: {text}",
+        "tags": sorted(symptoms),
+        "created_at": visit["visit_date"] + timedelta(hours=note_no),
+        "synthetic_flag": True,
     }
 
 
+def finish_records(
+    participant: dict, visits: list[dict], notes: list[dict], args: argparse.Namespace
+) -> tuple[dict, list[dict], list[dict]]:
+    if args.denormalize:
+        snapshot = participant_snapshot(participant)
+        for doc in (*visits, *notes):
+            doc["participant"] = dict(snapshot)
+
+    if args.raw_bson:
+        return (
+            encode_document(participant),
+            [encode_document(doc) for doc in visits],
+            [encode_document(doc) for doc in notes],
+        )
+    for doc in (participant, *visits, *notes):
+        doc["content_hash"] = content_hash(doc)
+    return participant, visits, notes
+
+
+def build_participant_records(
+    index: int, args: argparse.Namespace, rng: random.Random
+) -> tuple[dict, list[dict], list[dict]]:
+    participant_id = participant_id_for(index)
+    enrollment_date = REFERENCE_DATE - timedelta(days=rng.randint(160, 360))
+    participant = {
+        "participant_id": participant_id,
+        "trial_id": TRIAL_ID,
+        "site_id": rng.choice(SITES),
+        "arm": rng.choice(ARMS),
+        "age": bounded_int(rng.gauss(52, 12), 18, 85),
+        "sex_at_birth": rng.choice(SEXES),
+        "enrollment_date": enrollment_date,
+        "status": weighted_choice(rng, STATUSES, STATUS_WEIGHTS),
+        "synthetic_flag": True,
+    }
+    visits: list[dict] = []
+    notes: list[dict] = []
+
+    visit_count = rng.randint(args.min_visits, args.max_visits)
+    for visit_no in range(1, visit_count + 1):
+        visit_id = visit_id_for(participant_id, visit_no)
+        visit_date = enrollment_date + timedelta(days=visit_no * 28 + rng.randint(-4, 4))
+        force_ct = visit_no == 1 and index % 9 == 0
+        attachments = build_attachments(
+            participant_id=participant_id,
+            site_id=participant["site_id"],
+            visit_id=visit_id,
+            visit_date=visit_date,
+            rng=rng,
+            force_ct=force_ct,
+        )
+
+        visit = {
+            "visit_id": visit_id,
+            "participant_id": participant_id,
+            "site_id": participant["site_id"],
+            "visit_no": visit_no,
+            "visit_date": visit_date,
+            "vitals": {
+                "systolic_bp": bounded_int(rng.gauss(122, 14), 90, 180),
+                "diastolic_bp": bounded_int(rng.gauss(78, 9), 55, 110),
+                "heart_rate": bounded_int(rng.gauss(74, 8), 45, 120),
+            },
+            "symptom_score": bounded_int(rng.gauss(4.2, 1.8), 0, 10),
+            "protocol_deviation": rng.random() < 0.1,
+            "synthetic_flag": True,
+        }
+        if attachments:
+            visit["attachments"] = attachments
+            visit["attachment_counts"] = attachment_counts(attachments)
+        visits.append(visit)
+
+        note_count = rng.randint(args.min_notes, args.max_notes)
+        for note_no in range(1, note_count + 1):
+            symptoms = tuple(rng.sample(SYMPTOMS, 2))
+            template = rng.choice(NOTE_TEMPLATES)
+            note_type, role = rng.choice(NOTE_TYPES), rng.choice(AUTHOR_ROLES)
+            notes.append(note_doc(participant, visit, note_no, symptoms, template, note_type, role))
+
+    return finish_records(participant, visits, notes, args)
+
+
+def participant_rng(seed: int, index: int) -> random.Random:
+    # One stream per participant, derived from --seed and the index, so a participant's documents do not
+    # depend on which process or shard generates them.
+    material = hashlib.sha256(f"{seed}:{index}".encode("utf-8")).digest()
+    return random.Random(int.from_bytes(material[:8], "big"))
+
+
+def iter_shard_records(
+    args: argparse.Namespace, start: int, stop: int
+) -> Iterator[tuple[dict, list[dict], list[dict]]]:
+    for index in range(start, stop):
+        yield build_participant_records(index, args, participant_rng(args.seed, index))
+
+
+def generate_records(
+    args: argparse.Namespace, start: int, stop: int
+) -> Iterator[tuple[dict, list[dict], list[dict]]]:
+    if args.generator == "numpy":
+        # NumPy is optional (requirements-analytics.txt); only the vectorized backend imports it.
+        from vector_gen import iter_vector_records
+
+        return iter_vector_records(args, start, stop)
+    return iter_shard_records(args, start, stop)
+
+
+def make_writer(db, args: argparse.Namespace) -> BulkWriter:
+    return BulkWriter(
+        db,
+        NATURAL_KEYS,
+        batch_docs=args.batch_size or DEFAULT_WRITE_BATCH_SIZE,
+        batch_bytes=args.batch_bytes,
+        write_concern=parse_write_concern(args.write_w, args.write_journal),
+        max_in_flight=args.max_in_flight,
+        max_retries=args.max_retries,
+    )
+
+
+def canonical_records(
+    records: Iterable[tuple[dict, list[dict], list[dict]]], builder: ManifestBuilder
+) -> Iterator[tuple[dict, list[dict], list[dict]]]:
+    # Hash before writing (inserts add a random _id to each dict in place) and in generation order,
+    # which the manifest digests depend on; write_order may reorder afterwards.
+    for record in records:
+        builder.add(*record)
+        yield record
+
+
+def write_order(
+    db, records: Iterable[tuple[dict, list[dict], list[dict]]], args: argparse.Namespace
+) -> Iterable[tuple[dict, list[dict], list[dict]]]:
+    if args.sharding == "off":
+        return records
+    # Rotate shards roughly once per notes batch, the collection with the most documents per participant.
+    turn = max(1, (args.batch_size or DEFAULT_WRITE_BATCH_SIZE) // max(1, args.max_visits * args.max_notes))
+    return spread_records(records, ShardRouter(db), turn)
+
+
+def seed_in_memory(
+    db, records: Iterable[tuple[dict, list[dict], list[dict]]], args: argparse.Namespace
+) -> tuple[dict, dict, dict]:
+    builder = ManifestBuilder(args.shard_size)
+    participants: list[dict] = []
+    visits: list[dict] = []
+    notes: list[dict] = []
+    records = write_order(db, canonical_records(records, builder), args)
+    for participant, participant_visits, participant_notes in records:
+        participants.append(participant)
+        visits.extend(participant_visits)
+        notes.extend(participant_notes)
+
+    if args.sharding == "off":
+        participants.sort(key=lambda d: d["participant_id"])
+        visits.sort(key=lambda d: (d["participant_id"], d["visit_no"]))
+        notes.sort(key=lambda d: d["note_id"])
+
+    with make_writer(db, args) as writer:
+        for collection_name, docs in (
+            ("participants", participants),
+            ("visits", visits),
+            ("clinical_notes", notes),
+        ):
+            for doc in docs:
+                writer.add(collection_name, doc)
+    changes = empty_changes()
+    changes["participants"]["inserted"] = len(participants)
+    changes["visits"]["inserted"] = len(visits)
+    changes["clinical_notes"]["inserted"] = len(notes)
+    return builder.build(db.name), writer.stats.summary(), changes
+
+
+def empty_changes() -> dict:
+    return {**{name: {kind: 0 for kind in CHANGE_KINDS} for name in NATURAL_KEYS}, CHANGED_PARTICIPANTS: set()}
+
+
+def merge_changes(total: dict, changes: dict) -> None:
+    for name in NATURAL_KEYS:
+        for kind, value in changes[name].items():
+            total[name][kind] += value
+    total[CHANGED_PARTICIPANTS] |= changes[CHANGED_PARTICIPANTS]
+
+
+def stream_records(
+    db, records: Iterable[tuple[dict, list[dict], list[dict]]], args: argparse.Namespace, builder: ManifestBuilder
+) -> tuple[dict, dict]:
+    changes = empty_changes()
+    records = write_order(db, canonical_records(records, builder), args)
+    with make_writer(db, args) as writer:
+        for participant, participant_visits, participant_notes in records:
+            writer.add("participants", participant)
+            for visit in participant_visits:
+                writer.add("visits", visit)
+            for note in participant_notes:
+                writer.add("clinical_notes", note)
+            changes["participants"]["inserted"] += 1
+            changes["visits"]["inserted"] += len(participant_visits)
+            changes["clinical_notes"]["inserted"] += len(participant_notes)
+    return writer.stats.summary(), changes
+
+
+def sync_block(db, writer: BulkWriter, block: list[tuple[dict, list[dict], list[dict]]], changes: dict) -> None:
+    participant_ids = [participant["participant_id"] for participant, _, _ in block]
+    targets: dict[str, list[dict]] = {name: [] for name in NATURAL_KEYS}
+    for participant, participant_visits, participant_notes in block:
+        targets["participants"].append(participant)
+        targets["visits"].extend(participant_visits)
+        targets["clinical_notes"].extend(participant_notes)
+
+    for collection_name, docs in targets.items():
+        key_fields = NATURAL_KEYS[collection_name]
+        projection = {"_id": 0, "content_hash": 1, **{field: 1 for field in key_fields}}
+        existing = {
+            tuple(doc.get(field) for field in key_fields): doc.get("content_hash")
+            for doc in db[collection_name].find({"participant_id": {"$in": participant_ids}}, projection)
+        }
+        tally = changes[collection_name]
+        touched = changes[CHANGED_PARTICIPANTS]
+        for doc in docs:
+            key = tuple(doc[field] for field in key_fields)
+            if key not in existing:
+                writer.upsert(collection_name, doc)
+                tally["inserted"] += 1
+            elif existing.pop(key) != doc["content_hash"]:
+                writer.upsert(collection_name, doc)
+                tally["updated"] += 1
+            else:
+                tally["unchanged"] += 1
+                continue
+            touched.add(doc["participant_id"])
+        for key in existing:
+            writer.delete(collection_name, dict(zip(key_fields, key)))
+            tally["deleted"] += 1
+            # Every natural key starts with participant_id.
+            touched.add(key[0])
+
+
+def sync_records(
+    db, records: Iterable[tuple[dict, list[dict], list[dict]]], args: argparse.Namespace, builder: ManifestBuilder
+) -> tuple[dict, dict]:
+    changes = empty_changes()
+    block: list[tuple[dict, list[dict], list[dict]]] = []
+    with make_writer(db, args) as writer:
+        for record in write_order(db, canonical_records(records, builder), args):
+            block.append(record)
+            if len(block) == SYNC_BLOCK_PARTICIPANTS:
+                sync_block(db, writer, block, changes)
+                block = []
+        if block:
+            sync_block(db, writer, block, changes)
+    return writer.stats.summary(), changes
+
+
+def is_target_participant(participant_id: str, participant_count: int) -> bool:
+    suffix = participant_id.removeprefix("SYN-P-")
+    return suffix != participant_id and suffix.isdigit() and 1 <= int(suffix) <= participant_count
+
+
+def delete_stale_participants(db, participant_count: int) -> dict:
+    changes = empty_changes()
+    stale: list[str] = []
+
+    def flush() -> None:
+        query = {"participant_id": {"$in": stale}}
+        for collection_name in NATURAL_KEYS:
+            changes[collection_name]["deleted"] += db[collection_name].delete_many(query).deleted_count
+        changes[CHANGED_PARTICIPANTS].update(stale)
+        stale.clear()
+
+    for doc in db.participants.find({}, {"_id": 0, "participant_id": 1}):
+        if not is_target_participant(doc["participant_id"], participant_count):
+            stale.append(doc["participant_id"])
+            if len(stale) == DEFAULT_WRITE_BATCH_SIZE:
+                flush()
+    if stale:
+        flush()
+    return changes
+
+
+def write_records(
+    db, records: Iterable[tuple[dict, list[dict], list[dict]]], args: argparse.Namespace, builder: ManifestBuilder
+) -> tuple[dict, dict]:
+    if args.incremental:
+        return sync_records(db, records, args, builder)
+    return stream_records(db, records, args, builder)
+
+
+def seed_streaming(
+    db, records: Iterable[tuple[dict, list[dict], list[dict]]], args: argparse.Namespace
+) -> tuple[dict, dict, dict]:
+    builder = ManifestBuilder(args.shard_size)
+    writes, changes = write_records(db, records, args, builder)
+    return builder.build(db.name), writes, changes
+
+
+def seed_shard(task: dict) -> dict:
+    args = task["args"]
+    # The cached client stays open between shards so each worker keeps its warm pool.
+    db, _ = get_db(task["settings"])
+    builder = ManifestBuilder(args.shard_size)
+    records = generate_records(args, task["start"], task["stop"])
+    if args.dump:
+        records = dump_records(records, task["start"], args.shard_size)
+    writes, changes = write_records(db, records, args, builder)
+    return {"manifest": builder.state(), "writes": writes, "changes": changes, "metrics": drain_metrics()}
+
+
+def seed_from_dump(db, args: argparse.Namespace) -> tuple[dict, dict, dict]:
+    # Raw documents go straight from the mapped dump files into insert batches: nothing is
+    # generated, decoded or re-encoded.
+    meta = load_dump_meta()
+    problems = validate_dump(meta)
+    if problems:
+        raise ValueError(f"dump in data/generated/bson/ is damaged ({'; '.join(problems)}); rerun with --dump")
+    changes = empty_changes()
+    counts = meta["manifest"]["counts"]
+    with make_writer(db, args) as writer:
+        for collection_name in NATURAL_KEYS:
+            docs = iter_dump(collection_name)
+            if args.sharding != "off":
+                # The dump holds one collection at a time in participant order; spread it like write_order
+                # does, over blocks covering the same number of participants, one batch per shard turn.
+                per_participant = max(1, counts[collection_name] // max(1, counts["participants"]))
+                docs = spread_records(
+                    docs,
+                    ShardRouter(db),
+                    args.batch_size or DEFAULT_WRITE_BATCH_SIZE,
+                    participant_id=itemgetter("participant_id"),
+                    block_size=SPREAD_BLOCK_PARTICIPANTS * per_participant,
+                )
+            for doc in docs:
+                writer.add(collection_name, doc)
+                changes[collection_name]["inserted"] += 1
+    return meta["manifest"], writer.stats.summary(), changes
+
+
+def seed_parallel(db_settings: dict, db_name: str, args: argparse.Namespace) -> tuple[dict, dict, dict]:
+    tasks = [
+        {
+            "settings": db_settings,
+            "args": args,
+            "start": start,
+            "stop": min(start + args.shard_size, args.participants + 1),
+        }
+        for start in range(1, args.participants + 1, args.shard_size)
+    ]
+    builder = ManifestBuilder(args.shard_size)
+    stats = BulkWriteStats()
+    changes = empty_changes()
+    # spawn keeps workers from inheriting the parent's MongoClient sockets.
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=context) as pool:
+        for result in pool.map(seed_shard, tasks):
+            builder.merge(result["manifest"])
+            stats.merge(result["writes"])
+            merge_changes(changes, result["changes"])
+            merge_metrics(db_settings, result["metrics"])
+    return builder.build(db_name), stats.summary(), changes
+
+
 def parse_args(defaults: dict) -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Seed synthetic clinical trial demo data into MongoDB.")
     parser.add_argument("--seed", type=int, default=defaults["seed"])
@@ -157,6 +566,100 @@ def parse_args(defaults: dict) -> argparse.Namespace:
         default=defaults["drop_existing"],
         help="Drop existing collections before insert.",
     )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        default=defaults["incremental"],
+        help="Upsert only new/changed documents and delete stale ones instead of dropping (overrides --drop-existing).",
+    )
+    parser.add_argument(
+        "--defer-indexes",
+        action="store_true",
+        default=defaults["defer_indexes"],
+        help="Drop secondary indexes before loading and rebuild them all concurrently afterwards. "
+        "With --sharding, indexes led by participant_id are kept: the shard key and unique indexes must exist "
+        "before a sharded load.",
+    )
+    parser.add_argument(
+        "--denormalize",
+        action="store_true",
+        default=defaults["denormalize"],
+        help="Embed a participant snapshot (arm, age, sex_at_birth, status) on each visit and note.",
+    )
+    parser.add_argument(
+        "--visit-layout",
+        choices=VISIT_LAYOUTS,
+        default=defaults["visit_layout"],
+        help="Also store visit measurements as per-participant buckets or a time-series collection for Q3 trends.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=defaults["batch_size"],
+        help="Stream generation and insert in batches of this many documents (0 = build everything in memory).",
+    )
+    parser.add_argument(
+        "--raw-bson",
+        action="store_true",
+        default=defaults["raw_bson"],
+        help="Encode each document to BSON once and reuse the bytes for content_hash and inserts.",
+    )
+    parser.add_argument(
+        "--dump",
+        action="store_true",
+        help="Also write the raw BSON documents to data/generated/bson/ (implies --raw-bson).",
+    )
+    parser.add_argument(
+        "--reuse-dump",
+        action="store_true",
+        help="Reload data/generated/bson/ if it was generated with the same settings; otherwise seed and --dump.",
+    )
+    parser.add_argument(
+        "--generator",
+        choices=GENERATORS,
+        default=defaults["generator"],
+        help="python: per-record random.Random loop; numpy: vectorized column draws in chunks (needs numpy).",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=defaults["workers"],
+        help="Seed participant shards in this many processes (0 = single process); the data is the same either way.",
+    )
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=1000,
+        help="Participants per worker shard and per manifest digest block.",
+    )
+    parser.add_argument(
+        "--batch-bytes",
+        type=int,
+        default=8 * 1024 * 1024,
+        help="Flush a write batch once its documents reach this many BSON bytes.",
+    )
+    parser.add_argument("--write-w", default=defaults["write_w"], help="Write concern w for the bulk load.")
+    parser.add_argument(
+        "--write-journal",
+        action=argparse.BooleanOptionalAction,
+        default=defaults["write_journal"],
+        help="Wait for the journal (write concern j) on each batch.",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=defaults["max_in_flight"],
+        help="Concurrent write batches per process.",
+    )
+    parser.add_argument("--max-retries", type=int, default=3, help="Retries per failed write batch.")
+    parser.add_argument(
+        "--sharding",
+        choices=("off", *SHARD_STRATEGIES),
+        default=defaults["sharding"],
+        help="Shard participants, visits and notes on participant_id (hashed or range) through mongos, "
+        "pre-split before the load, and order write batches across shards.",
+    )
+    parser.add_argument("--chunks-per-shard", type=int, default=defaults["shard_chunks"])
     return parser.parse_args()
 
 
@@ -170,106 +673,98 @@ def main() -> None:
         raise ValueError("min-notes must be <= max-notes")
     if args.participants <= 0:
         raise ValueError("participants must be > 0")
+    if args.batch_size < 0:
+        raise ValueError("batch-size must be >= 0")
+    if args.workers < 0:
+        raise ValueError("workers must be >= 0")
+    if args.shard_size <= 0:
+        raise ValueError("shard-size must be > 0")
+    if args.generator == "numpy" and args.shard_size % VECTOR_CHUNK:
+        raise ValueError(f"the numpy generator needs a shard-size that is a multiple of {VECTOR_CHUNK}")
+    if args.batch_bytes <= 0:
+        raise ValueError("batch-bytes must be > 0")
+    if args.max_in_flight <= 0:
+        raise ValueError("max-in-flight must be > 0")
+    if args.sharding not in ("off", *SHARD_STRATEGIES):
+        raise ValueError(f"sharding must be off or one of {SHARD_STRATEGIES}")
+    if args.incremental and args.defer_indexes:
+        raise ValueError("--incremental needs the unique indexes in place; drop --defer-indexes")
+    if args.incremental and args.reuse_dump:
+        raise ValueError("--reuse-dump reloads whole collections; drop --incremental")
+    from_dump = args.reuse_dump and dump_matches(args)
+    # A matching dump already holds this dataset: reload it instead of clearing it for --dump to rewrite.
+    args.dump = not from_dump and (args.dump or args.reuse_dump)
+    if args.dump:
+        args.raw_bson = True
+        clear_dump()
 
-    rng = random.Random(args.seed)
     db_settings = defaults.copy()
     db, client = get_db(db_settings)
 
-    if args.drop_existing:
+    if args.drop_existing and not args.incremental:
         db.participants.drop()
         db.visits.drop()
         db.clinical_notes.drop()
-
-    participants: list[dict] = []
-    visits: list[dict] = []
-    notes: list[dict] = []
-
-    reference_date = datetime(2026, 1, 1, tzinfo=timezone.utc)
-
-    for i in range(1, args.participants + 1):
-        participant_id = f"SYN-P-{i:04d}"
-        enrollment_date = reference_date - timedelta(days=rng.randint(160, 360))
-
-        participant = {
-            "participant_id": participant_id,
-            "trial_id": "TRIAL-SYN-2026-001",
-            "site_id": rng.choice(SITES),
-            "arm": rng.choice(ARMS),
-            "age": bounded_int(rng.gauss(52, 12), 18, 85),
-            "sex_at_birth": rng.choice(SEXES),
-            "enrollment_date": enrollment_date,
-            "status": weighted_choice(rng, STATUSES, STATUS_WEIGHTS),
-            "synthetic_flag": True,
-        }
-        participants.append(participant)
-
-        visit_count = rng.randint(args.min_visits, args.max_visits)
-        for visit_no in range(1, visit_count + 1):
-            visit_id = f"{participant_id}-V{visit_no:02d}"
-            visit_date = enrollment_date + timedelta(days=visit_no * 28 + rng.randint(-4, 4))
-            force_ct = visit_no == 1 and i % 9 == 0
-            attachments = build_attachments(
-                participant_id=participant_id,
-                site_id=participant["site_id"],
-                visit_id=visit_id,
-                visit_date=visit_date,
-                rng=rng,
-                force_ct=force_ct,
-            )
-
-            visit = {
-                "visit_id": visit_id,
-                "participant_id": participant_id,
-                "site_id": participant["site_id"],
-                "visit_no": visit_no,
-                "visit_date": visit_date,
-                "vitals": {
-                    "systolic_bp": bounded_int(rng.gauss(122, 14), 90, 180),
-                    "diastolic_bp": bounded_int(rng.gauss(78, 9), 55, 110),
-                    "heart_rate": bounded_int(rng.gauss(74, 8), 45, 120),
-                },
-                "symptom_score": bounded_int(rng.gauss(4.2, 1.8), 0, 10),
-                "protocol_deviation": rng.random() < 0.1,
-                "synthetic_flag": True,
-            }
-            if attachments:
-                visit["attachments"] = attachments
-            visits.append(visit)
-
-            note_count = rng.randint(args.min_notes, args.max_notes)
-            for note_no in range(1, note_count + 1):
-                symptom_1, symptom_2 = rng.sample(SYMPTOMS, 2)
-                template = rng.choice(NOTE_TEMPLATES)
-                text = template.format(symptom_1=symptom_1, symptom_2=symptom_2)
-                note = {
-                    "note_id": f"NOTE-{visit_id}-{note_no:02d}",
-                    "participant_id": participant_id,
-                    "visit_id": visit_id,
-                    "site_id": participant["site_id"],
-                    "note_type": rng.choice(NOTE_TYPES),
-                    "author_role": rng.choice(AUTHOR_ROLES),
-                    "note_text": f"Synthetic note: {text}",
-                    "tags": sorted([symptom_1, symptom_2]),
-                    "created_at": visit_date + timedelta(hours=note_no),
-                    "synthetic_flag": True,
-                }
-                notes.append(note)
-
-    participants.sort(key=lambda d: d["participant_id"])
-    visits.sort(key=lambda d: (d["participant_id"], d["visit_no"]))
-    notes.sort(key=lambda d: d["note_id"])
-
-    db.participants.insert_many(participants, ordered=True)
-    db.visits.insert_many(visits, ordered=True)
-    db.clinical_notes.insert_many(notes, ordered=True)
-
-    manifest = build_manifest(db.name, participants, visits, notes)
-    out_path = PROJECT_ROOT / "data" / "generated" / "manifest.json"
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    out_path.write_text(json.dumps(manifest, indent=2), encoding="utf-8")
-
-    print("Seed complete")
+    if args.defer_indexes:
+        dropped = drop_secondary_indexes(db, keep_field=SHARD_FIELD if args.sharding != "off" else None)
+        if dropped:
+            print(f"Dropped {len(dropped)} secondary indexes before load")
+    if args.sharding != "off":
+        range_points = partial(range_split_points, args.participants)
+        for row in shard_collections(db, args.sharding, args.chunks_per_shard, range_points):
+            state = "pre-split into" if row["new"] else "already sharded,"
+            print(f"{row['collection']}: {state} {row['chunks']} chunks on {args.sharding} participant_id")
+
+    if from_dump:
+        manifest, writes, changes = seed_from_dump(db, args)
+    elif args.workers:
+        manifest, writes, changes = seed_parallel(db_settings, db.name, args)
+    else:
+        records = generate_records(args, 1, args.participants + 1)
+        if args.dump:
+            records = dump_records(records, 1, args.shard_size)
+        if args.batch_size or args.incremental:
+            manifest, writes, changes = seed_streaming(db, records, args)
+        else:
+            manifest, writes, changes = seed_in_memory(db, records, args)
+    if args.dump:
+        write_dump_meta(args, manifest)
+    if args.incremental:
+        merge_changes(changes, delete_stale_participants(db, args.participants))
+    index_timings = build_indexes(db) if args.defer_indexes else []
+    layout_started = time.perf_counter()
+    apply_visit_layout(db, args.visit_layout)
+    layout_seconds = time.perf_counter() - layout_started
+    # Rollups, once built, are kept current: an incremental seed applies only the participants it changed,
+    # any other seed replaced every participant and rebuilds them.
+    rollup_status = None
+    if rollups_enabled(db) and args.incremental:
+        refreshed = refresh_rollups(db, sorted(changes[CHANGED_PARTICIPANTS]))
+        rollup_status = f"refreshed for {refreshed} changed participants"
+    elif rollups_enabled(db):
+        rebuild_rollups(db)
+        rollup_status = "rebuilt"
+
+    write_manifest(manifest)
+
+    print("Seed complete" + (" (reloaded from data/generated/bson/, nothing regenerated)" if from_dump else ""))
     print(json.dumps(manifest, indent=2))
+    print(
+        f"Wrote {writes['docs']} docs in {writes['seconds']}s "
+        f"({writes['docs_per_s']} docs/s, {writes['mb_per_s']} MB/s, "
+        f"{writes['batches']} batches, {writes['retried_batches']} retried)"
+    )
+    print("Changes:")
+    for collection_name in NATURAL_KEYS:
+        tally = changes[collection_name]
+        print(f"- {collection_name}: " + ", ".join(f"{kind}={value}" for kind, value in tally.items()))
+    if index_timings:
+        print("Index build times:")
+        print_index_timings(index_timings)
+    if args.visit_layout != "documents":
+        print(f"Visit layout '{args.visit_layout}' built in {layout_seconds:.2f}s")
+    if rollup_status is not None:
+        print(f"Rollups {rollup_status}")
 
     client.close()
 
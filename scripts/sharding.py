@@ -0,0 +1,337 @@
+from __future__ import annotations
+
+import argparse
+import re
+from bisect import bisect_right
+from collections.abc import Callable, Iterable, Iterator
+
+from bson.int64 import Int64
+from pymongo import HASHED
+
+from common import get_db, get_settings
+from create_indexes import INDEX_SPECS, build_index
+from queries import (
+    DEMO_QUERIES,
+    QUERY_SPECS,
+    add_variant_arguments,
+    current_layout,
+    explain_query,
+    resolve_queries,
+    route_variants,
+    selected_variants,
+)
+
+# Participants, their visits and their notes share one shard key, so a participant's documents live
+# on one shard and the participant_id $lookup of Q3/Q5 stays on it. A {site_id, participant_id} key
+# is not offered: the natural-key unique indexes (uid_participant_id, uid_participant_visit) would
+# then need site_id as their prefix. Rollups and visit layout collections stay unsharded.
+SHARD_FIELD = "participant_id"
+SHARD_KEYS = {
+    "hashed": {SHARD_FIELD: HASHED},
+    "range": {SHARD_FIELD: 1},
+}
+SHARD_STRATEGIES = tuple(SHARD_KEYS)
+SHARDED_COLLECTIONS = ("participants", "visits", "clinical_notes")
+DEFAULT_CHUNKS_PER_SHARD = 4
+SPREAD_BLOCK_PARTICIPANTS = 2000
+# Point lookups that show what a targeted query looks like next to Q1-Q6.
+ROUTING_PROBES = {
+    "P1": {
+        "title": "P1 one participant's visits",
+        "collection": "visits",
+        "filter": {"participant_id": "SYN-P-0001"},
+        "sort": [("visit_no", 1)],
+    },
+    "P2": {
+        "title": "P2 one participant's notes, newest first",
+        "collection": "clinical_notes",
+        "filter": {"participant_id": "SYN-P-0001"},
+        "sort": [("created_at", -1)],
+    },
+}
+
+
+def require_mongos(db) -> list[str]:
+    if db.client.admin.command("hello").get("msg") != "isdbgrid":
+        raise ValueError("MONGO_URI does not point at a mongos; start docker-compose.sharded.yml (make up-sharded)")
+    return [shard["_id"] for shard in db.client.admin.command("listShards")["shards"]]
+
+
+def collection_meta(db, collection_name: str) -> dict | None:
+    return db.client.config.collections.find_one({"_id": f"{db.name}.{collection_name}"})
+
+
+def chunks(db, collection_name: str) -> list[dict]:
+    meta = collection_meta(db, collection_name)
+    if meta is None:
+        return []
+    return list(db.client.config.chunks.find({"uuid": meta["uuid"]}).sort("min", 1))
+
+
+def hashed_split_points(pieces: int) -> list[Int64]:
+    # Hashed keys are spread over the signed 64-bit range; equal slices hold about equal data.
+    return [Int64(-(2**63) + (2**64) * i // pieces) for i in range(1, pieces)]
+
+
+def presplit(db, collection_name: str, points: list, shards: list[str]) -> int:
+    # Splits the single initial chunk at `points` and hands out contiguous runs of chunks to the shards,
+    # so the first batches already land on every shard instead of waiting for the balancer.
+    admin = db.client.admin
+    namespace = f"{db.name}.{collection_name}"
+    existing = {chunk["min"][SHARD_FIELD] for chunk in chunks(db, collection_name)}
+    for point in points:
+        if point not in existing:
+            admin.command("split", namespace, middle={SHARD_FIELD: point})
+    layout = chunks(db, collection_name)
+    for position, chunk in enumerate(layout):
+        target = shards[position * len(shards) // len(layout)]
+        if chunk["shard"] != target:
+            admin.command("moveChunk", namespace, bounds=[chunk["min"], chunk["max"]], to=target)
+    return len(layout)
+
+
+def shard_collections(
+    db,
+    strategy: str,
+    chunks_per_shard: int = DEFAULT_CHUNKS_PER_SHARD,
+    range_points: Callable[[int], list] | None = None,
+) -> list[dict]:
+    # range_points(pieces) returns the participant_id boundaries for a ranged key; the seeder derives them
+    # from the ids it is about to write. Collections already sharded on the same key are left alone.
+    if strategy not in SHARD_KEYS:
+        raise ValueError(f"unknown shard strategy {strategy!r}; choose from {SHARD_STRATEGIES}")
+    if chunks_per_shard <= 0:
+        raise ValueError("chunks-per-shard must be > 0")
+    shards = require_mongos(db)
+    key = SHARD_KEYS[strategy]
+    pieces = len(shards) * chunks_per_shard
+    db.client.admin.command("enableSharding", db.name)
+    results = []
+    for collection_name in SHARDED_COLLECTIONS:
+        meta = collection_meta(db, collection_name)
+        if meta is not None:
+            if dict(meta["key"]) != key:
+                raise ValueError(
+                    f"{collection_name} is already sharded on {dict(meta['key'])}; drop it or seed with --drop-existing"
+                )
+            results.append({"collection": collection_name, "chunks": len(chunks(db, collection_name)), "new": False})
+            continue
+        # Unique indexes must start with the shard key; building them first also lets a ranged key
+        # reuse them instead of adding a duplicate participant_id index.
+        for spec in INDEX_SPECS[collection_name]:
+            if spec["keys"][0][0] == SHARD_FIELD:
+                build_index(db, collection_name, spec)
+        if strategy == "hashed":
+            db[collection_name].create_index(list(key.items()))
+        empty = db[collection_name].estimated_document_count() == 0
+        db.client.admin.command("shardCollection", f"{db.name}.{collection_name}", key=key)
+        count = len(chunks(db, collection_name))
+        if empty:
+            # Chunks of a non-empty collection are split and balanced by the server as usual.
+            if strategy == "hashed":
+                points = hashed_split_points(pieces)
+            else:
+                points = sorted(set(range_points(pieces) if range_points else []))
+            count = presplit(db, collection_name, points, shards)
+        results.append({"collection": collection_name, "chunks": count, "new": True})
+    return results
+
+
+def data_range_points(db) -> Callable[[int], list]:
+    # For `setup` on loaded data: boundaries at participant_id quantiles of the participants collection.
+    def points(pieces: int) -> list:
+        buckets = db.participants.aggregate(
+            [{"$project": {"participant_id": 1}}, {"$bucketAuto": {"groupBy": "$participant_id", "buckets": pieces}}]
+        )
+        return [bucket["_id"]["min"] for bucket in buckets][1:]
+
+    return points
+
+
+class ShardRouter:
+    # Maps participant_id values to the shard owning their chunk, from the chunk table of one collection.
+    # Hashed key values come from the server ($toHashedIndexKey), so they match its routing exactly.
+    def __init__(self, db, collection_name: str = "visits") -> None:
+        meta = collection_meta(db, collection_name)
+        if meta is None:
+            raise ValueError(f"{collection_name} is not sharded; run scripts/sharding.py setup")
+        self.db = db
+        self.field, kind = next(iter(meta["key"].items()))
+        self.hashed = kind == HASHED
+        layout = chunks(db, collection_name)
+        self.bounds = [chunk["max"][self.field] for chunk in layout[:-1]]
+        self.owners = [chunk["shard"] for chunk in layout]
+
+    def keys(self, values: list) -> list:
+        if not self.hashed:
+            return list(values)
+        documents = [{"value": value} for value in values]
+        pipeline = [{"$documents": documents}, {"$project": {"_id": 0, "key": {"$toHashedIndexKey": "$value"}}}]
+        return [doc["key"] for doc in self.db.aggregate(pipeline)]
+
+    def shard_for(self, key) -> str:
+        return self.owners[bisect_right(self.bounds, key)]
+
+
+def record_participant_id(record: tuple[dict, list[dict], list[dict]]) -> str:
+    return record[0]["participant_id"]
+
+
+def spread_records(
+    records: Iterable,
+    router: ShardRouter,
+    turn: int,
+    participant_id: Callable[[object], str] = record_participant_id,
+    block_size: int = SPREAD_BLOCK_PARTICIPANTS,
+) -> Iterator:
+    # Reorders blocks of participants so consecutive write batches alternate between shards: each block is
+    # grouped by owning shard and sorted by shard key, then `turn` participants are taken from each shard in
+    # rotation. With a ranged key this avoids loading one shard at a time in participant_id order.
+    # participant_id/block_size let the same reordering run over single documents, e.g. a raw dump.
+    def interleave(block: list) -> Iterator:
+        keys = router.keys([participant_id(record) for record in block])
+        groups: dict[str, list] = {}
+        for key, record in sorted(zip(keys, block), key=lambda item: item[0]):
+            groups.setdefault(router.shard_for(key), []).append(record)
+        queues = list(groups.values())
+        for start in range(0, max(len(queue) for queue in queues), turn):
+            for queue in queues:
+                yield from queue[start : start + turn]
+
+    block = []
+    for record in records:
+        block.append(record)
+        if len(block) == block_size:
+            yield from interleave(block)
+            block = []
+    if block:
+        yield from interleave(block)
+
+
+def shard_names(node) -> set[str]:
+    # mongos explain lists the shards it sent a find to under winningPlan.shards[].shardName and an
+    # aggregate's per-shard parts under a "shards" document keyed by shard name.
+    names = set()
+    if isinstance(node, dict):
+        if isinstance(node.get("shardName"), str):
+            names.add(node["shardName"])
+        shards = node.get("shards")
+        if isinstance(shards, dict):
+            names.update(shards)
+        for value in node.values():
+            names |= shard_names(value)
+    elif isinstance(node, list):
+        for value in node:
+            names |= shard_names(value)
+    return names
+
+
+def lookup_routing(spec: dict, keys: dict[str, dict]) -> list[str]:
+    notes = []
+    for stage in spec.get("pipeline", []):
+        lookup = stage.get("$lookup")
+        if lookup is None:
+            continue
+        key = keys.get(lookup["from"])
+        if key is None:
+            notes.append(f"$lookup {lookup['from']}: unsharded")
+        elif list(key) == [lookup.get("foreignField")]:
+            notes.append(f"$lookup {lookup['from']}: targeted per document")
+        else:
+            notes.append(f"$lookup {lookup['from']}: scatter-gather per document")
+    return notes
+
+
+def routing_report(db, names: list[str]) -> list[dict]:
+    shards = require_mongos(db)
+    pattern = "^" + re.escape(f"{db.name}.")
+    keys = {
+        meta["_id"].split(".", 1)[1]: dict(meta["key"])
+        for meta in db.client.config.collections.find({"_id": {"$regex": pattern}})
+    }
+    specs = {**QUERY_SPECS, **ROUTING_PROBES}
+    rows = []
+    for name in names:
+        spec = specs[name]
+        hit = sorted(shard_names(explain_query(db, spec, verbosity="queryPlanner")))
+        if spec["collection"] not in keys:
+            routing = "unsharded"
+        elif not hit:
+            routing = "unknown"
+        elif len(hit) < len(shards):
+            routing = "targeted"
+        else:
+            routing = "scatter-gather"
+        rows.append(
+            {
+                "query": name,
+                "collection": spec["collection"],
+                "shard_key": keys.get(spec["collection"]),
+                "routing": routing,
+                "shards": hit,
+                "lookups": lookup_routing(spec, keys),
+            }
+        )
+    return rows
+
+
+def parse_args(defaults: dict) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Shard the clinical collections and check how queries are routed.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    setup = subparsers.add_parser("setup", help="Shard participants, visits and clinical_notes (pre-split if empty).")
+    strategy = defaults["sharding"] if defaults["sharding"] in SHARD_KEYS else "hashed"
+    setup.add_argument("--strategy", choices=SHARD_STRATEGIES, default=strategy)
+    setup.add_argument("--chunks-per-shard", type=int, default=defaults["shard_chunks"])
+    subparsers.add_parser("status", help="Shard key, chunks and documents per shard for each collection.")
+    routing = subparsers.add_parser("routing", help="Report which queries are targeted and which scatter-gather.")
+    routing.add_argument("--queries", default=",".join([*DEMO_QUERIES, *ROUTING_PROBES]))
+    add_variant_arguments(routing)
+    return parser.parse_args()
+
+
+def main() -> None:
+    settings = get_settings()
+    args = parse_args(settings)
+    db, client = get_db(settings)
+
+    if args.command == "setup":
+        for row in shard_collections(db, args.strategy, args.chunks_per_shard, data_range_points(db)):
+            state = "sharded" if row["new"] else "already sharded"
+            print(f"{row['collection']}: {state} on {SHARD_KEYS[args.strategy]}, {row['chunks']} chunks")
+    elif args.command == "status":
+        require_mongos(db)
+        for collection_name in SHARDED_COLLECTIONS:
+            meta = collection_meta(db, collection_name)
+            if meta is None:
+                print(f"{collection_name}: unsharded")
+                continue
+            per_shard: dict[str, int] = {}
+            for chunk in chunks(db, collection_name):
+                per_shard[chunk["shard"]] = per_shard.get(chunk["shard"], 0) + 1
+            counts = {
+                stats["shard"]: stats["count"]
+                for stats in db[collection_name].aggregate([{"$collStats": {"count": {}}}])
+            }
+            print(f"{collection_name}: key {dict(meta['key'])}")
+            for shard in sorted(per_shard.keys() | counts.keys()):
+                print(f"  {shard:<10} chunks={per_shard.get(shard, 0):<4} docs={counts.get(shard, 0)}")
+    else:
+        names = [name.strip() for name in args.queries.split(",") if name.strip()]
+        names = resolve_queries(names, route_variants(selected_variants(args), current_layout(db)))
+        unknown = [name for name in names if name not in QUERY_SPECS and name not in ROUTING_PROBES]
+        if unknown:
+            raise ValueError(f"unknown queries: {unknown}")
+        print(f"{'query':<5} {'collection':<15} {'routing':<15} {'shards':<18} shard key")
+        for row in routing_report(db, names):
+            print(
+                f"{row['query']:<5} {row['collection']:<15} {row['routing']:<15} {','.join(row['shards']) or '-':<18} "
+                f"{row['shard_key'] or '-'}"
+            )
+            for note in row["lookups"]:
+                print(f"      {note}")
+
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
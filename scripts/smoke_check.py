@@ -3,14 +3,10 @@ from __future__ import annotations
 import sys
 
 from common import get_db, get_settings
+from index_advisor import analyze_workload, workload_queries
 
 
 REQUIRED_COLLECTIONS = ["participants", "visits", "clinical_notes"]
-REQUIRED_INDEXES = {
-    "participants": {"uid_participant_id", "idx_site_arm_age"},
-    "visits": {"uid_participant_visit", "idx_visit_site_date", "idx_visit_attachment_modality"},
-    "clinical_notes": {"txt_note_text", "idx_note_participant_created"},
-}
 
 
 def fail(msg: str) -> None:
@@ -27,11 +23,16 @@ def main() -> None:
         if count == 0:
             fail(f"collection {col} is empty")
 
-    for col, idx_names in REQUIRED_INDEXES.items():
-        existing = set(db[col].index_information().keys())
-        missing = idx_names - existing
-        if missing:
-            fail(f"collection {col} missing indexes: {sorted(missing)}")
+    # The demo workload must be served by indexes: a filtered COLLSCAN or a failing query fails the check,
+    # in-memory sorts and high examined/returned ratios are printed as warnings.
+    report = analyze_workload(db, workload_queries(db), repeat=0)
+    for finding in report["findings"]:
+        if finding["severity"] == "warn":
+            print(f"SMOKE WARN: {finding['query']}: {finding['detail']}")
+    errors = [f"{item['query']}: {item['detail']}" for item in report["findings"] if item["severity"] == "error"]
+    if errors:
+        fix = "; run `make indexes` or `python scripts/index_advisor.py`"
+        fail("; ".join(errors) + fix)
 
     text_hits = db.clinical_notes.count_documents({"$text": {"$search": "fatigue"}})
     if text_hits == 0:
@@ -0,0 +1,419 @@
+from __future__ import annotations
+
+import argparse
+import statistics
+import sys
+import time
+from collections import Counter
+from collections.abc import Iterator
+from datetime import datetime, timezone
+from itertools import accumulate, compress
+
+import numpy as np
+
+from common import get_settings
+from manifest import content_hash
+from seed_data import (
+    ARMS,
+    ATTACHMENT_MODALITIES,
+    ATTACHMENT_MODALITY_WEIGHTS,
+    AUTHOR_ROLES,
+    NOTE_TEMPLATES,
+    NOTE_TYPES,
+    REFERENCE_DATE,
+    SEXES,
+    SITES,
+    STATUS_WEIGHTS,
+    STATUSES,
+    SYMPTOMS,
+    TRIAL_ID,
+    VECTOR_CHUNK,
+    attachment_counts,
+    attachment_doc,
+    finish_records,
+    iter_shard_records,
+    participant_id_for,
+    visit_id_for,
+)
+
+CT = ATTACHMENT_MODALITIES.index("CT")
+# Every note text and tag pair, indexed by (template, symptom_1, symptom_2) and (symptom_1, symptom_2), so
+# notes pick a prebuilt string instead of formatting one each.
+NOTE_TEXTS = [
+    f"Synthetic note: {template.format(symptom_1=first, symptom_2=second)}"
+    for template in NOTE_TEMPLATES
+    for first in SYMPTOMS
+    for second in SYMPTOMS
+]
+TAG_PAIRS = [tuple(sorted((first, second))) for first in SYMPTOMS for second in SYMPTOMS]
+
+
+def probabilities(weights: list[float]) -> np.ndarray:
+    values = np.asarray(weights, dtype=float)
+    return values / values.sum()
+
+
+def bounded(values: np.ndarray, low: int, high: int) -> np.ndarray:
+    # np.rint rounds half to even like round() in bounded_int.
+    return np.clip(np.rint(values), low, high).astype(np.int64)
+
+
+def positions(counts: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # Owner row and 1-based position for every child row, e.g. counts [2, 3] -> [0 0 1 1 1], [1 2 1 2 3].
+    owners = np.repeat(np.arange(len(counts)), counts)
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    return owners, np.arange(len(owners)) - starts + 1
+
+
+def utc_dates(values: np.ndarray) -> list[datetime]:
+    # datetime64 has no time zone; tolist() gives naive datetimes, which are UTC like REFERENCE_DATE.
+    return [value.replace(tzinfo=timezone.utc) for value in values.tolist()]
+
+
+def draw_columns(chunk_no: int, args: argparse.Namespace) -> dict[str, list]:
+    rng = np.random.default_rng([args.seed, chunk_no])
+    first = chunk_no * VECTOR_CHUNK + 1
+    count = VECTOR_CHUNK
+
+    visit_counts = rng.integers(args.min_visits, args.max_visits + 1, size=count)
+    columns = {
+        "index": np.arange(first, first + count),
+        "site": rng.integers(len(SITES), size=count),
+        "arm": rng.integers(len(ARMS), size=count),
+        "age": bounded(rng.normal(52, 12, count), 18, 85),
+        "sex": rng.integers(len(SEXES), size=count),
+        "enrollment_days": rng.integers(160, 361, size=count),
+        "status": rng.choice(len(STATUSES), size=count, p=probabilities(STATUS_WEIGHTS)),
+        "visit_count": visit_counts,
+    }
+
+    visit_owner, visit_no = positions(visit_counts)
+    visits = len(visit_no)
+    force_ct = (visit_no == 1) & (columns["index"][visit_owner] % 9 == 0)
+    has_attachments = force_ct | (rng.random(visits) < 0.35)
+    modality = rng.choice(len(ATTACHMENT_MODALITIES), size=(visits, 2), p=probabilities(ATTACHMENT_MODALITY_WEIGHTS))
+    modality[force_ct, 0] = CT
+    note_counts = rng.integers(args.min_notes, args.max_notes + 1, size=visits)
+    columns.update(
+        {
+            "visit_owner": visit_owner,
+            "visit_no": visit_no,
+            "day_offset": visit_no * 28 + rng.integers(-4, 5, size=visits),
+            "systolic_bp": bounded(rng.normal(122, 14, visits), 90, 180),
+            "diastolic_bp": bounded(rng.normal(78, 9, visits), 55, 110),
+            "heart_rate": bounded(rng.normal(74, 8, visits), 45, 120),
+            "symptom_score": bounded(rng.normal(4.2, 1.8, visits), 0, 10),
+            "protocol_deviation": rng.random(visits) < 0.1,
+            "attachment_count": np.where(has_attachments, np.where(rng.random(visits) < 0.8, 1, 2), 0),
+            "modality_1": modality[:, 0],
+            "modality_2": modality[:, 1],
+            "note_count": note_counts,
+        }
+    )
+
+    note_owner, note_no = positions(note_counts)
+    notes = len(note_no)
+    # Two distinct symptoms per note, like rng.sample(SYMPTOMS, 2): skip over the first pick.
+    symptom_1 = rng.integers(len(SYMPTOMS), size=notes)
+    symptom_2 = rng.integers(len(SYMPTOMS) - 1, size=notes)
+    symptom_2 += symptom_2 >= symptom_1
+    columns.update(
+        {
+            "note_owner": note_owner,
+            "note_no": note_no,
+            "symptom_1": symptom_1,
+            "symptom_2": symptom_2,
+            "template": rng.integers(len(NOTE_TEMPLATES), size=notes),
+            "note_type": rng.integers(len(NOTE_TYPES), size=notes),
+            "author_role": rng.integers(len(AUTHOR_ROLES), size=notes),
+        }
+    )
+    reference = np.datetime64(REFERENCE_DATE.replace(tzinfo=None), "us")
+    enrollment_dates = reference - columns["enrollment_days"].astype("timedelta64[D]")
+    visit_dates = enrollment_dates[visit_owner] + columns["day_offset"].astype("timedelta64[D]")
+    template = columns["template"]
+    columns.update(
+        {
+            "enrollment_date": enrollment_dates,
+            "visit_date": visit_dates,
+            "created_at": visit_dates[note_owner] + note_no.astype("timedelta64[h]"),
+            "note_text": (template * len(SYMPTOMS) + symptom_1) * len(SYMPTOMS) + symptom_2,
+            "tags": symptom_1 * len(SYMPTOMS) + symptom_2,
+        }
+    )
+    # Plain Python values: BSON cannot encode NumPy scalars.
+    return {
+        name: utc_dates(values) if values.dtype.kind == "M" else values.tolist() for name, values in columns.items()
+    }
+
+
+def chunk_records(
+    chunk_no: int, args: argparse.Namespace, rows: int = VECTOR_CHUNK
+) -> Iterator[tuple[dict, list[dict], list[dict]]]:
+    # Each document field is built for the whole chunk by one comprehension over the columns, then the
+    # flat visit and note lists are sliced per participant. rows trims a final, partial chunk.
+    columns = draw_columns(chunk_no, args)
+    # Row offsets into the flat lists; the leading 0 keeps participants without visits (and visits
+    # without notes) to empty slices.
+    visit_ends = [0, *accumulate(columns["visit_count"][:rows])]
+    note_ends = [0, *accumulate(columns["note_count"][: visit_ends[-1]])]
+    visit_count, note_count = visit_ends[-1], note_ends[-1]
+
+    participant_ids = [participant_id_for(index) for index in columns["index"][:rows]]
+    site_ids = [SITES[site] for site in columns["site"][:rows]]
+    participants = [
+        {
+            "participant_id": participant_id,
+            "trial_id": TRIAL_ID,
+            "site_id": site_id,
+            "arm": ARMS[arm],
+            "age": age,
+            "sex_at_birth": SEXES[sex],
+            "enrollment_date": enrollment_date,
+            "status": STATUSES[status],
+            "synthetic_flag": True,
+        }
+        for participant_id, site_id, arm, age, sex, enrollment_date, status in zip(
+            participant_ids,
+            site_ids,
+            columns["arm"],
+            columns["age"],
+            columns["sex"],
+            columns["enrollment_date"],
+            columns["status"],
+        )
+    ]
+
+    visit_owners = columns["visit_owner"][:visit_count]
+    visit_ids = [
+        visit_id_for(participant_ids[owner], visit_no) for owner, visit_no in zip(visit_owners, columns["visit_no"])
+    ]
+    visits = [
+        {
+            "visit_id": visit_id,
+            "participant_id": participant_ids[owner],
+            "site_id": site_ids[owner],
+            "visit_no": visit_no,
+            "visit_date": visit_date,
+            "vitals": {"systolic_bp": systolic, "diastolic_bp": diastolic, "heart_rate": heart_rate},
+            "symptom_score": symptom_score,
+            "protocol_deviation": deviation,
+            "synthetic_flag": True,
+        }
+        for visit_id, owner, visit_no, visit_date, systolic, diastolic, heart_rate, symptom_score, deviation in zip(
+            visit_ids,
+            visit_owners,
+            columns["visit_no"],
+            columns["visit_date"],
+            columns["systolic_bp"],
+            columns["diastolic_bp"],
+            columns["heart_rate"],
+            columns["symptom_score"],
+            columns["protocol_deviation"],
+        )
+    ]
+    # About a third of visits carry attachments, so these are built only where the count is non-zero.
+    for row in compress(range(visit_count), columns["attachment_count"]):
+        visit = visits[row]
+        modalities = (columns["modality_1"][row], columns["modality_2"][row])
+        attachments = [
+            attachment_doc(
+                participant_id=visit["participant_id"],
+                site_id=visit["site_id"],
+                visit_id=visit["visit_id"],
+                visit_date=visit["visit_date"],
+                attachment_no=attachment_no,
+                modality=ATTACHMENT_MODALITIES[modalities[attachment_no - 1]],
+            )
+            for attachment_no in range(1, columns["attachment_count"][row] + 1)
+        ]
+        visit["attachments"] = attachments
+        visit["attachment_counts"] = attachment_counts(attachments)
+
+    # The same fields as seed_data.note_doc, built column-wise.
+    notes = [
+        {
+            "note_id": f"NOTE-{visit_ids[owner]}-{note_no:02d}",
+            "participant_id": visits[owner]["participant_id"],
+            "visit_id": visit_ids[owner],
+            "site_id": visits[owner]["site_id"],
+            "note_type": NOTE_TYPES[note_type],
+            "author_role": AUTHOR_ROLES[author_role],
+            "note_text": NOTE_TEXTS[text],
+            "tags": list(TAG_PAIRS[tags]),
+            "created_at": created_at,
+            "synthetic_flag": True,
+        }
+        for owner, note_no, text, tags, created_at, note_type, author_role in zip(
+            columns["note_owner"][:note_count],
+            columns["note_no"],
+            columns["note_text"],
+            columns["tags"],
+            columns["created_at"],
+            columns["note_type"],
+            columns["author_role"],
+        )
+    ]
+
+    for row, participant in enumerate(participants):
+        visit_start, visit_end = visit_ends[row], visit_ends[row + 1]
+        yield finish_records(
+            participant, visits[visit_start:visit_end], notes[note_ends[visit_start] : note_ends[visit_end]], args
+        )
+
+
+def iter_vector_records(
+    args: argparse.Namespace, start: int, stop: int
+) -> Iterator[tuple[dict, list[dict], list[dict]]]:
+    # Shards start on a chunk boundary (seed_data rejects other --shard-size values), so no chunk is
+    # drawn twice; only the last one may be cut short at stop.
+    if (start - 1) % VECTOR_CHUNK:
+        raise ValueError(f"the numpy generator needs shards aligned to {VECTOR_CHUNK} participants")
+    for first in range(start, stop, VECTOR_CHUNK):
+        yield from chunk_records((first - 1) // VECTOR_CHUNK, args, min(VECTOR_CHUNK, stop - first))
+
+
+def generate(backend: str, args: argparse.Namespace) -> tuple[float, list[tuple[dict, list[dict], list[dict]]]]:
+    started = time.perf_counter()
+    if backend == "numpy":
+        records = list(iter_vector_records(args, 1, args.participants + 1))
+    else:
+        records = list(iter_shard_records(args, 1, args.participants + 1))
+    return time.perf_counter() - started, records
+
+
+def describe(records: list[tuple[dict, list[dict], list[dict]]]) -> dict[str, str]:
+    participants = [participant for participant, _, _ in records]
+    visits = [visit for _, participant_visits, _ in records for visit in participant_visits]
+    notes = [note for _, _, participant_notes in records for note in participant_notes]
+    attachments = [attachment for visit in visits for attachment in visit.get("attachments", [])]
+    statuses = Counter(participant["status"] for participant in participants)
+    modalities = Counter(attachment["modality"] for attachment in attachments)
+
+    def mean_sd(values: list[float]) -> str:
+        return f"{statistics.fmean(values):.2f} / {statistics.pstdev(values):.2f}"
+
+    return {
+        "age mean / sd": mean_sd([participant["age"] for participant in participants]),
+        "systolic mean / sd": mean_sd([visit["vitals"]["systolic_bp"] for visit in visits]),
+        "symptom mean / sd": mean_sd([visit["symptom_score"] for visit in visits]),
+        "visits / participant": f"{len(visits) / len(participants):.2f}",
+        "notes / visit": f"{len(notes) / len(visits):.2f}",
+        "status mix": " ".join(f"{status}={statuses[status] / len(participants):.2f}" for status in STATUSES),
+        "visits with attachments": f"{sum('attachments' in visit for visit in visits) / len(visits):.3f}",
+        "modality mix": " ".join(
+            f"{modality}={modalities[modality] / len(attachments):.2f}" for modality in ATTACHMENT_MODALITIES
+        ),
+        "protocol deviations": f"{sum(visit['protocol_deviation'] for visit in visits) / len(visits):.3f}",
+    }
+
+
+def hash_seconds(records: list[tuple[dict, list[dict], list[dict]]]) -> float:
+    started = time.perf_counter()
+    for participant, visits, notes in records:
+        for doc in (participant, *visits, *notes):
+            content_hash(doc)
+    return time.perf_counter() - started
+
+
+def ownership_problems(records: list[tuple[dict, list[dict], list[dict]]], args: argparse.Namespace) -> list[str]:
+    # Every visit and note must belong to the participant it was sliced to, and each visit's notes must be
+    # numbered 1..n with nothing missing.
+    problems = []
+    for participant, visits, notes in records:
+        participant_id = participant["participant_id"]
+        if not args.min_visits <= len(visits) <= args.max_visits:
+            problems.append(f"{participant_id}: {len(visits)} visits")
+        visit_ids = [visit["visit_id"] for visit in visits]
+        if any(visit["participant_id"] != participant_id for visit in visits):
+            problems.append(f"{participant_id}: holds visits of another participant")
+        if any(note["participant_id"] != participant_id or note["visit_id"] not in visit_ids for note in notes):
+            problems.append(f"{participant_id}: holds notes of another participant")
+        per_visit = Counter(note["visit_id"] for note in notes)
+        expected = {
+            f"NOTE-{visit_id}-{note_no:02d}" for visit_id in visit_ids for note_no in range(1, per_visit[visit_id] + 1)
+        }
+        if {note["note_id"] for note in notes} != expected or len(notes) != len(expected):
+            problems.append(f"{participant_id}: note numbering has gaps or repeats")
+    return problems
+
+
+def run_check(args: argparse.Namespace) -> None:
+    # The given visit range plus ranges with participants that have no visits at all.
+    ranges = [(args.min_visits, args.max_visits), (0, 2), (0, 0)]
+    failed = False
+    for min_visits, max_visits in ranges:
+        case = argparse.Namespace(**{**vars(args), "min_visits": min_visits, "max_visits": max_visits})
+        records = generate("numpy", case)[1]
+        problems = ownership_problems(records, case)
+        visits = sum(len(participant_visits) for _, participant_visits, _ in records)
+        print(
+            f"visits {min_visits}..{max_visits}: {len(records)} participants, {visits} visits, {len(problems)} problems"
+        )
+        for problem in problems[:5]:
+            print(f"  {problem}")
+        failed = failed or bool(problems)
+    if failed:
+        print("VECTOR CHECK FAIL")
+        sys.exit(1)
+    print("VECTOR CHECK PASS")
+
+
+def run_bench(args: argparse.Namespace) -> None:
+    results = {backend: generate(backend, args) for backend in ("python", "numpy")}
+    # Both backends stamp the same content_hash; time it separately so the draw/build cost is visible.
+    print(
+        f"{'backend':<8} {'docs':>10} {'total s':>9} {'hash s':>9} {'build s':>9} {'docs/s':>10} {'build docs/s':>13}"
+    )
+    build = {}
+    for backend, (seconds, records) in results.items():
+        docs = sum(1 + len(visits) + len(notes) for _, visits, notes in records)
+        hashing = min(hash_seconds(records), seconds)
+        build[backend] = seconds - hashing
+        print(
+            f"{backend:<8} {docs:>10} {seconds:>9.2f} {hashing:>9.2f} {build[backend]:>9.2f} "
+            f"{docs / seconds:>10.0f} {docs / max(build[backend], 1e-9):>13.0f}"
+        )
+    print(
+        f"speedup: {results['python'][0] / results['numpy'][0]:.1f}x overall, "
+        f"{build['python'] / max(build['numpy'], 1e-9):.1f}x excluding content_hash"
+    )
+
+    # Same distributions, different random streams: compare summary statistics, not documents.
+    summaries = {backend: describe(records) for backend, (_, records) in results.items()}
+    print(f"\n{'statistic':<24} {'python':<34} {'numpy':<34}")
+    for name in summaries["python"]:
+        print(f"{name:<24} {summaries['python'][name]:<34} {summaries['numpy'][name]:<34}")
+
+
+def parse_args() -> argparse.Namespace:
+    defaults = get_settings()
+    parser = argparse.ArgumentParser(description="Benchmark the NumPy generator backend against the per-record loop.")
+    parser.add_argument(
+        "command",
+        choices=["bench", "check"],
+        help="check verifies that every visit and note lands with its own participant, including with zero visits.",
+    )
+    parser.add_argument("--seed", type=int, default=defaults["seed"])
+    parser.add_argument("--participants", type=int, default=20000)
+    parser.add_argument("--min-visits", type=int, default=defaults["min_visits"])
+    parser.add_argument("--max-visits", type=int, default=defaults["max_visits"])
+    parser.add_argument("--min-notes", type=int, default=defaults["min_notes"])
+    parser.add_argument("--max-notes", type=int, default=defaults["max_notes"])
+    parser.add_argument("--denormalize", action="store_true", default=defaults["denormalize"])
+    parser.set_defaults(raw_bson=False)
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    if args.participants <= 0:
+        raise ValueError("participants must be > 0")
+    if args.command == "check":
+        run_check(args)
+    else:
+        run_bench(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import sys
+from collections import defaultdict
+from collections.abc import Iterator
+
+from bson.codec_options import CodecOptions
+
+from common import get_db, get_settings
+from manifest import MANIFEST_COLLECTIONS, ManifestBuilder, load_manifest
+from seed_data import participant_id_for
+
+# Read datetimes back as aware UTC so they serialize exactly like the generated values.
+READ_OPTIONS = CodecOptions(tz_aware=True)
+
+
+def note_order(note: dict) -> tuple[int, int]:
+    _, visit_part, note_part = note["note_id"].rsplit("-", 2)
+    return int(visit_part.lstrip("V")), int(note_part)
+
+
+def strip_stored_hash(doc: dict) -> dict:
+    # Recompute content hashes from what is actually stored rather than trusting the field.
+    doc.pop("content_hash", None)
+    return doc
+
+
+def iter_block_records(db, start: int, stop: int) -> Iterator[tuple[dict, list[dict], list[dict]]]:
+    ids = [participant_id_for(index) for index in range(start, stop)]
+    query = {"participant_id": {"$in": ids}}
+
+    participants = {
+        doc["participant_id"]: strip_stored_hash(doc)
+        for doc in db.get_collection("participants", codec_options=READ_OPTIONS).find(query)
+    }
+    visits: dict[str, list[dict]] = defaultdict(list)
+    for doc in db.get_collection("visits", codec_options=READ_OPTIONS).find(query):
+        visits[doc["participant_id"]].append(strip_stored_hash(doc))
+    notes: dict[str, list[dict]] = defaultdict(list)
+    for doc in db.get_collection("clinical_notes", codec_options=READ_OPTIONS).find(query):
+        notes[doc["participant_id"]].append(strip_stored_hash(doc))
+
+    for participant_id in ids:
+        participant = participants.get(participant_id)
+        if participant is None:
+            continue
+        yield (
+            participant,
+            sorted(visits[participant_id], key=lambda d: d["visit_no"]),
+            sorted(notes[participant_id], key=note_order),
+        )
+
+
+def main() -> None:
+    settings = get_settings()
+    expected = load_manifest()
+    db, client = get_db(settings)
+
+    block_participants = expected["digest"]["block_participants"]
+    participant_count = expected["counts"]["participants"]
+    builder = ManifestBuilder(block_participants)
+    for start in range(1, participant_count + 1, block_participants):
+        stop = min(start + block_participants, participant_count + 1)
+        for participant, visits, notes in iter_block_records(db, start, stop):
+            builder.add(participant, visits, notes)
+        builder.finish_block()
+    actual = builder.build(db.name)
+
+    problems = []
+    for name in MANIFEST_COLLECTIONS:
+        stored = db[name].count_documents({})
+        if stored != expected["counts"][name]:
+            problems.append(f"{name}: {stored} documents in database, manifest expects {expected['counts'][name]}")
+        if actual["digest"]["collections"][name] != expected["digest"]["collections"][name]:
+            problems.append(f"{name}: digest mismatch")
+    for key, value in expected["counts"].items():
+        if actual["counts"][key] != value:
+            problems.append(f"count {key}: recomputed {actual['counts'][key]}, manifest expects {value}")
+
+    client.close()
+
+    if problems or actual["sha256"] != expected["sha256"]:
+        print("MANIFEST DRIFT")
+        for problem in problems:
+            print(f"- {problem}")
+        print(f"- sha256 recomputed {actual['sha256']}, manifest {expected['sha256']}")
+        sys.exit(1)
+    print(f"MANIFEST OK sha256={actual['sha256']}")
+
+
+if __name__ == "__main__":
+    main()
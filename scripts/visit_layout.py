@@ -0,0 +1,276 @@
+from __future__ import annotations
+
+import argparse
+import time
+from datetime import datetime, timezone
+
+from pymongo import ASCENDING, DESCENDING
+
+from bench_queries import time_calls
+from common import get_db, get_settings
+from create_indexes import build_indexes
+from manifest import bump_generation
+from queries import QUERY_SPECS, VISIT_LAYOUT_STATE, current_layout, run_query
+
+VISIT_LAYOUTS = ("documents", "buckets", "timeseries")
+BUCKET_COLLECTION = "visit_buckets"
+SERIES_COLLECTION = "visit_series"
+LAYOUT_COLLECTIONS = {"buckets": BUCKET_COLLECTION, "timeseries": SERIES_COLLECTION}
+# A year of 4-weekly visits per bucket document.
+BUCKET_VISITS = 12
+YEAR_SECONDS = 365 * 24 * 3600
+SERIES_INSERT_BATCH = 5000
+LAYOUT_INDEX_SPECS = {
+    BUCKET_COLLECTION: [
+        {
+            "name": "uid_bucket_participant",
+            "keys": [("participant_id", ASCENDING), ("bucket_no", ASCENDING)],
+            "unique": True,
+        },
+        {
+            "name": "idx_bucket_site_dates",
+            "keys": [("site_id", ASCENDING), ("last_date", DESCENDING), ("first_date", ASCENDING)],
+        },
+    ],
+}
+MEASUREMENT_FIELDS = ("visit_no", "visit_date", "symptom_score", "vitals")
+
+
+def bucket_pipeline(participant_ids: list[str] | None = None) -> list[dict]:
+    match = [] if participant_ids is None else [{"$match": {"participant_id": {"$in": participant_ids}}}]
+    return match + [
+        {"$sort": {"participant_id": 1, "visit_no": 1}},
+        {
+            "$group": {
+                "_id": {
+                    "participant_id": "$participant_id",
+                    "bucket_no": {"$floor": {"$divide": [{"$subtract": ["$visit_no", 1]}, BUCKET_VISITS]}},
+                },
+                "site_id": {"$first": "$site_id"},
+                "first_date": {"$min": "$visit_date"},
+                "last_date": {"$max": "$visit_date"},
+                "count": {"$sum": 1},
+                "measurements": {"$push": {field: f"${field}" for field in MEASUREMENT_FIELDS}},
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "participant_id": "$_id.participant_id",
+                "bucket_no": "$_id.bucket_no",
+                "site_id": 1,
+                "first_date": 1,
+                "last_date": 1,
+                "count": 1,
+                "measurements": 1,
+            }
+        },
+    ]
+
+
+def build_buckets(db, participant_ids: list[str] | None = None) -> None:
+    if participant_ids is None:
+        # $out swaps the rebuilt collection in atomically and keeps its indexes.
+        db.visits.aggregate(bucket_pipeline() + [{"$out": BUCKET_COLLECTION}])
+        build_indexes(db, LAYOUT_INDEX_SPECS)
+        return
+    db[BUCKET_COLLECTION].delete_many({"participant_id": {"$in": participant_ids}})
+    merge = {"into": BUCKET_COLLECTION, "on": ["participant_id", "bucket_no"], "whenMatched": "replace"}
+    db.visits.aggregate(bucket_pipeline(participant_ids) + [{"$merge": merge}])
+
+
+def build_series(db, participant_ids: list[str] | None = None) -> None:
+    query = {}
+    if participant_ids is None:
+        db[SERIES_COLLECTION].drop()
+        # Visits are ~4 weeks apart, so the preset granularities would give every measurement its own
+        # bucket; a one-year span keeps a participant's series together (MongoDB 6.3+).
+        db.create_collection(
+            SERIES_COLLECTION,
+            timeseries={
+                "timeField": "visit_date",
+                "metaField": "meta",
+                "bucketMaxSpanSeconds": YEAR_SECONDS,
+                "bucketRoundingSeconds": YEAR_SECONDS,
+            },
+        )
+    else:
+        query = {"participant_id": {"$in": participant_ids}}
+        db[SERIES_COLLECTION].delete_many({"meta.participant_id": {"$in": participant_ids}})
+    projection = {"_id": 0, "participant_id": 1, "site_id": 1, **{field: 1 for field in MEASUREMENT_FIELDS}}
+    batch: list[dict] = []
+    for visit in db.visits.find(query, projection).sort([("participant_id", 1), ("visit_no", 1)]):
+        meta = {"participant_id": visit.pop("participant_id"), "site_id": visit.pop("site_id")}
+        batch.append({"meta": meta, **visit})
+        if len(batch) == SERIES_INSERT_BATCH:
+            db[SERIES_COLLECTION].insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        db[SERIES_COLLECTION].insert_many(batch, ordered=False)
+
+
+def record_layout(db, layout: str) -> None:
+    # Marks the layout current for queries.current_layout, which then routes Q3 to it.
+    state = {"layout": layout, "visits": db.visits.estimated_document_count(), "built_at": datetime.now(timezone.utc)}
+    db[VISIT_LAYOUT_STATE].replace_one({"_id": "visits"}, state, upsert=True)
+
+
+def apply_visit_layout(db, layout: str) -> None:
+    # The layout collections are copies derived from visits, which stay the system of record
+    # (attachments, note links, manifest and incremental sync all key on them). Anything that
+    # writes visits afterwards must call refresh_visit_layout.
+    if layout not in VISIT_LAYOUTS:
+        raise ValueError(f"unknown visit layout {layout!r}; choose from {VISIT_LAYOUTS}")
+    # Q3 reads visits until the rebuild has finished.
+    db[VISIT_LAYOUT_STATE].delete_many({})
+    for other, collection_name in LAYOUT_COLLECTIONS.items():
+        if other != layout:
+            db[collection_name].drop()
+    if layout == "buckets":
+        build_buckets(db)
+    elif layout == "timeseries":
+        build_series(db)
+    if layout != "documents":
+        record_layout(db, layout)
+
+
+def detect_layout(db) -> str:
+    existing = set(db.list_collection_names())
+    for layout, collection_name in LAYOUT_COLLECTIONS.items():
+        if collection_name in existing:
+            return layout
+    return "documents"
+
+
+def refresh_visit_layout(db, participant_ids: list[str] | None = None) -> str:
+    # Rebuilds the existing layout, or only the given participants' part of it, after a visit write.
+    # A layout that was already stale is rebuilt whole, since patching a few participants cannot fix it.
+    layout = detect_layout(db)
+    if layout == "documents" or (participant_ids is not None and not participant_ids):
+        return layout
+    if current_layout(db) != layout:
+        participant_ids = None
+    if layout == "buckets":
+        build_buckets(db, participant_ids)
+    else:
+        build_series(db, participant_ids)
+    record_layout(db, layout)
+    return layout
+
+
+def range_pipeline(layout: str, site_id: str, start: datetime, end: datetime) -> tuple[str, list[dict]]:
+    if layout == "buckets":
+        return BUCKET_COLLECTION, [
+            {"$match": {"site_id": site_id, "last_date": {"$gte": start}, "first_date": {"$lte": end}}},
+            {"$unwind": "$measurements"},
+            {"$match": {"measurements.visit_date": {"$gte": start, "$lte": end}}},
+            {
+                "$project": {
+                    "_id": 0,
+                    "participant_id": 1,
+                    **{field: f"$measurements.{field}" for field in MEASUREMENT_FIELDS},
+                }
+            },
+        ]
+    if layout == "timeseries":
+        return SERIES_COLLECTION, [
+            {"$match": {"meta.site_id": site_id, "visit_date": {"$gte": start, "$lte": end}}},
+            {
+                "$project": {
+                    "_id": 0,
+                    "participant_id": "$meta.participant_id",
+                    **{field: 1 for field in MEASUREMENT_FIELDS},
+                }
+            },
+        ]
+    return "visits", [
+        {"$match": {"site_id": site_id, "visit_date": {"$gte": start, "$lte": end}}},
+        {"$project": {"_id": 0, "participant_id": 1, **{field: 1 for field in MEASUREMENT_FIELDS}}},
+    ]
+
+
+def storage_stats(db, collection_name: str) -> dict:
+    stats = db.command("collStats", collection_name)
+    # Time-series collections store measurements in internal bucket documents; count those.
+    count = stats.get("timeseries", {}).get("bucketCount", stats.get("count", 0))
+    return {"count": count, "size": stats.get("size", 0), "index_bytes": stats.get("totalIndexSize", 0)}
+
+
+def run_bench(db, site_id: str, start: datetime, end: datetime, iterations: int) -> None:
+    layout = current_layout(db)
+    if layout == "documents":
+        raise ValueError("no current bucket or time-series layout; seed with --visit-layout or run 'build' first")
+    layout_collection = LAYOUT_COLLECTIONS[layout]
+    # Trend and range reads move from visits to the layout; the layout itself is stored next to visits,
+    # so the storage footprint is the sum of both.
+    before, extra = storage_stats(db, "visits"), storage_stats(db, layout_collection)
+    after = {field: before[field] + extra[field] for field in before}
+    print(f"{'collection':<22} {'docs':>10} {'data bytes':>12} {'index bytes':>12}")
+    for name, stats in (("before: visits", before), (f"+ {layout_collection}", extra), ("after: total", after)):
+        print(f"{name:<22} {stats['count']:>10} {stats['size']:>12} {stats['index_bytes']:>12}")
+    read = {field: before[field] / extra[field] if extra[field] else 0.0 for field in before}
+    growth = {field: after[field] / before[field] if before[field] else 0.0 for field in before}
+    print(
+        f"Q3 and range reads: {read['count']:.2f}x fewer documents, {read['index_bytes']:.2f}x fewer index bytes "
+        f"than visits"
+    )
+    print(
+        f"storage growth: {growth['count']:.2f}x documents, {growth['size']:.2f}x data bytes, "
+        f"{growth['index_bytes']:.2f}x index bytes"
+    )
+
+    trend = {"buckets": "Q3b", "timeseries": "Q3t"}[layout]
+    print(f"\n{'workload':<22} {'p50':>9} {'p95':>9} {'rows':>8}")
+    for name in ("Q3", trend):
+        rows = len(list(run_query(db, QUERY_SPECS[name])))
+        latency = time_calls(lambda: list(run_query(db, QUERY_SPECS[name])), iterations)
+        print(f"{name:<22} {latency['p50']:>9.3f} {latency['p95']:>9.3f} {rows:>8}")
+    for current in ("documents", layout):
+        collection_name, pipeline = range_pipeline(current, site_id, start, end)
+        rows = len(list(db[collection_name].aggregate(pipeline)))
+        latency = time_calls(lambda: list(db[collection_name].aggregate(pipeline)), iterations)
+        print(f"{'range ' + current:<22} {latency['p50']:>9.3f} {latency['p95']:>9.3f} {rows:>8}")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Build and compare bucketed / time-series visit layouts.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build", help="(Re)build a layout collection from visits.")
+    build.add_argument("layout", choices=VISIT_LAYOUTS)
+    commands = {
+        "range": "Count visit measurements for one site and date range, from the layout while it is current.",
+        "bench": "Compare document count, index size, Q3 and range scans against plain visits.",
+    }
+    for name, help_text in commands.items():
+        sub = subparsers.add_parser(name, help=help_text)
+        sub.add_argument("--site", default="SITE-03")
+        sub.add_argument("--start", type=datetime.fromisoformat, default=datetime(2025, 3, 1))
+        sub.add_argument("--end", type=datetime.fromisoformat, default=datetime(2025, 6, 1))
+        if name == "bench":
+            sub.add_argument("--iterations", type=int, default=20)
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    settings = get_settings()
+    db, client = get_db(settings)
+
+    if args.command == "build":
+        started = time.perf_counter()
+        apply_visit_layout(db, args.layout)
+        bump_generation()
+        print(f"Visit layout '{args.layout}' built in {time.perf_counter() - started:.2f}s")
+    elif args.command == "bench":
+        run_bench(db, args.site, args.start, args.end, args.iterations)
+    else:
+        layout = current_layout(db)
+        collection_name, pipeline = range_pipeline(layout, args.site, args.start, args.end)
+        rows = list(db[collection_name].aggregate(pipeline))
+        print(f"{len(rows)} measurements for {args.site} from {collection_name} ({layout} layout)")
+
+    client.close()
+
+
+if __name__ == "__main__":
+    main()